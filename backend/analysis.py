@@ -0,0 +1,203 @@
+"""Post-game analysis: a fixed-depth evaluation of every position in a game.
+
+GET /games/<game_id>/analysis replays the game's history from its starting
+position and evaluates each position before an action, and the final one, in a
+process pool. The response is a Server-Sent Events stream with one `ply` event
+per position, in the order they finish, then a `done` event with a summary:
+
+    event: ply
+    data: {"ply": 12, "turn": "white", "played": {...}, "score": -140, "best": {...}, "cached": false}
+
+Scores are in centipawns from White's point of view. `best` is the action the
+search prefers in that position, the alternative to `played`. The summary lists
+the actions that lost at least MISTAKE_THRESHOLD compared with the position
+before them. Evaluations are cached by position hash and depth, so positions
+shared by many games (openings above all) are only searched once per process.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from api import move_to_dict
+from engine import Engine, MATE
+from game import SymbioticChessGame, Move, STALEMATE
+
+# Search depth per position, unless the request asks for another one
+ANALYSIS_DEPTH = 3
+MAX_ANALYSIS_DEPTH = 5
+# Node budget per position, so one wild position can't hold up the whole analysis
+ANALYSIS_NODES = 200_000
+# Evaluations kept in the cache, least recently used dropped first
+CACHE_SIZE = 100_000
+# Centipawns an action must lose to be listed as a mistake
+MISTAKE_THRESHOLD = 150
+
+# One position of a game: the action played from it (None for the final
+# position) and, for the final position, how the game ended
+Ply = namedtuple('Ply', ['ply', 'turn', 'fen', 'key', 'played', 'outcome'])
+
+_cache = OrderedDict()  # (position hash, depth) -> (score for the side to move, packed best Move or None)
+_cache_lock = threading.Lock()
+_pool = None
+_engine = None
+
+
+def game_plies(game):
+    """Every position of the game, replayed from its starting position, as Ply tuples."""
+    if game.start_fen:
+        replay = SymbioticChessGame.from_fen(game.start_fen, headless=True)
+    else:
+        replay = SymbioticChessGame(headless=True)
+        replay.max_merges = game.max_merges
+    plies = []
+    for ply, undo in enumerate(game.history):
+        plies.append(Ply(ply, replay.current_turn, replay.to_fen(), replay.position_hash, undo.move, None))
+        replay.make(undo.move)
+    plies.append(Ply(len(game.history), replay.current_turn, replay.to_fen(), replay.position_hash, None,
+                     game.outcome))
+    return plies
+
+
+def evaluate_fen(fen, depth, max_nodes=ANALYSIS_NODES):
+    """Searches a position to a fixed depth; returns (score for the side to move, packed best Move or None).
+
+    Runs in a worker process, with one engine per process.
+    """
+    global _engine
+    if _engine is None:
+        _engine = Engine(time_limit=None, tt_size=1 << 16)
+    _engine.tt.clear()  # So an evaluation doesn't depend on what the worker searched before
+    result = _engine.search(SymbioticChessGame.from_fen(fen, headless=True), max_depth=depth, max_nodes=max_nodes)
+    return result.score, result.move.pack() if result.move else None
+
+
+def final_evaluation(ply):
+    # A finished game isn't searched: the side to move has lost, unless it's stalemate
+    return (0 if ply.outcome == STALEMATE else -MATE), None
+
+
+def cached(ply, depth):
+    with _cache_lock:
+        evaluation = _cache.get((ply.key, depth))
+        if evaluation is not None:
+            _cache.move_to_end((ply.key, depth))
+        return evaluation
+
+
+def store(ply, depth, evaluation):
+    with _cache_lock:
+        _cache[(ply.key, depth)] = evaluation
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def get_pool():
+    # The Flask server's analysis workers; the ASGI server passes its AI pool instead
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+    return _pool
+
+
+def event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+class Analysis:
+    """One analysis request: the game's positions, evaluated with a cache in front of the pool."""
+
+    def __init__(self, game, depth=ANALYSIS_DEPTH):
+        self.plies = game_plies(game)
+        self.depth = depth
+        self.scores = {}  # ply -> score for White
+        self.hits = 0
+        self.started = time.perf_counter()
+
+    def pending(self):
+        # Yields the events of positions that need no search, and returns those that do
+        searches = []
+        for ply in self.plies:
+            evaluation = final_evaluation(ply) if ply.outcome else cached(ply, self.depth)
+            if evaluation is None:
+                searches.append(ply)
+            else:
+                self.hits += ply.outcome is None
+                yield self.ply_event(ply, evaluation, True)
+        return searches
+
+    def ply_event(self, ply, evaluation, from_cache=False):
+        score, best = evaluation
+        if not from_cache and ply.outcome is None:
+            store(ply, self.depth, evaluation)
+        score = score if ply.turn == 'white' else -score
+        self.scores[ply.ply] = score
+        return event('ply', {
+            'ply': ply.ply,
+            'turn': ply.turn,
+            'played': move_to_dict(ply.played) if ply.played else None,
+            'score': score,
+            'best': move_to_dict(Move.unpack(best)) if best is not None else None,
+            'cached': from_cache,
+        })
+
+    def done_event(self):
+        mistakes = []
+        for ply in self.plies[:-1]:
+            # What the action cost the side that played it, from the positions before and after it
+            sign = 1 if ply.turn == 'white' else -1
+            loss = sign * (self.scores[ply.ply] - self.scores[ply.ply + 1])
+            if loss >= MISTAKE_THRESHOLD:
+                mistakes.append({'ply': ply.ply, 'turn': ply.turn, 'played': str(ply.played), 'loss': loss})
+        return event('done', {
+            'plies': len(self.plies) - 1,
+            'depth': self.depth,
+            'cached': self.hits,
+            'seconds': round(time.perf_counter() - self.started, 3),
+            'mistakes': mistakes,
+        })
+
+    def events(self, executor):
+        """Server-Sent Events for every position as the pool finishes it, then the summary."""
+        searches = yield from self.pending()
+        futures = {executor.submit(evaluate_fen, ply.fen, self.depth): ply for ply in searches}
+        for future in as_completed(futures):
+            yield self.ply_event(futures[future], future.result())
+        yield self.done_event()
+
+    async def async_events(self, executor):
+        """events() for an event loop."""
+        pending = self.pending()
+        try:
+            while True:
+                yield next(pending)
+        except StopIteration as stop:
+            searches = stop.value
+        loop = asyncio.get_running_loop()
+
+        async def search(ply):
+            # asyncio.as_completed doesn't say which future finished, so each result carries its ply
+            return ply, await loop.run_in_executor(executor, evaluate_fen, ply.fen, self.depth)
+
+        for finished in asyncio.as_completed([search(ply) for ply in searches]):
+            ply, evaluation = await finished
+            yield self.ply_event(ply, evaluation)
+        yield self.done_event()
+
+
+def start(session, depth=None):
+    """GET /analysis: an Analysis of the session's game, or an error payload, with the HTTP status.
+
+    Takes the game's positions, so the caller holds the game's lock; the
+    evaluations run after it is released.
+    """
+    try:
+        depth = int(depth) if depth else ANALYSIS_DEPTH
+    except ValueError:
+        return {'error': f"Invalid depth: {depth}"}, 400
+    if not 1 <= depth <= MAX_ANALYSIS_DEPTH:
+        return {'error': f"Depth must be between 1 and {MAX_ANALYSIS_DEPTH}"}, 400
+    return Analysis(session.game, depth), 200
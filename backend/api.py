@@ -0,0 +1,510 @@
+"""The game API shared by the Flask server (server.py) and the ASGI server (asgi.py).
+
+Both servers only parse requests and build responses; the registry, the state
+encodings and every action live here. Action handlers take a GameSession that
+the caller has locked and return (payload, HTTP status). They log the action
+and push it to the game's event streams before returning.
+"""
+import atexit
+import functools
+import json
+import math
+import os
+import secrets
+import threading
+
+import engine
+import metrics
+from book import OpeningBook
+from engine import Engine, SearchResult
+from encoding import encode_state, to_base64
+from game import PIECES, PROMOTION_CHOICES, SQUARE_NAMES, SymbioticChessGame
+from handoff import worker_for
+from persistence import GameStore, CREATE, ACTION, UNDO, RESET, LOAD, DELETE
+from registry import GameRegistry
+from tablebase import Tablebases
+
+# Every table is a game in the registry; the original un-prefixed routes
+# (/state, /move, ...) keep working on the game with DEFAULT_GAME_ID.
+DEFAULT_GAME_ID = 'default'
+registry = GameRegistry(game_factory=functools.partial(SymbioticChessGame, headless=True))
+metrics.gauge('symbiotic_games', "Games open in this process.", lambda: len(registry))
+
+# Time budget per AI move in seconds; clients may ask for less, never for more
+AI_TIME_LIMIT = 1.0
+# Seconds between keep-alive comments on idle event streams
+EVENT_KEEPALIVE = 15
+# Versions restart with the process, so ETags carry a per-process token
+BOOT_ID = secrets.token_hex(4)
+# /state?format=: the JSON state, or the binary one from encoding.py, raw or base64
+STATE_FORMATS = ('json', 'binary', 'base64')
+# Action log and snapshots; set by enable_persistence() when run as a server
+store = None
+# Opening book (book.py); set by enable_book() when run as a server
+book = None
+# Store games are handed off through between workers (handoff.py); set by enable_handoff() behind router.py
+handoff = None
+_handoff_lock = threading.Lock()
+
+def get_session(game_id):
+    # The session for game_id, or None if there is no such game
+    session = registry.get(game_id)
+    if session is None and handoff is not None:
+        session = take_over(game_id)
+    if session is None and game_id == DEFAULT_GAME_ID:
+        session = registry.get_or_create(game_id)
+    return session
+
+def _piece_dict(piece):
+    return {
+        'piece_type': piece.piece_type,
+        'color': piece.color,
+        'combined_pieces': piece.combined_pieces,
+        'display_info': piece.get_display_info()
+    }
+
+# The board only holds the shared PIECES, so their dicts are built once
+PIECE_DICTS = [None] + [_piece_dict(piece) for piece in PIECES[1:]]
+
+def piece_to_dict(piece):
+    if piece is None:
+        return None
+    if piece.code is not None:
+        return PIECE_DICTS[piece.code]
+    return _piece_dict(piece)
+
+def board_to_json(board):
+    json_board = []
+    for row in board:
+        json_row = [piece_to_dict(p) for p in row]
+        json_board.append(json_row)
+    return json_board
+
+def move_to_dict(move):
+    return {
+        'kind': move.kind,
+        'from': SQUARE_NAMES[move.start],
+        'to': SQUARE_NAMES[move.end],
+        'promotion': move.promotion,
+        'notation': str(move)
+    }
+
+def state_to_dict(game):
+    return {
+        'version': game.version,
+        'board': board_to_json(game.board),
+        'current_turn': game.current_turn,
+        'merge_count': game.merge_count,
+        'last_move': game.last_move,
+        'captured_pieces': captured_to_dict(game),
+        'status_message': game.status_message,
+        'last_merge_info': game.last_merge_info,
+        'winner': game.winner,
+        'outcome': game.outcome,
+        'in_check': game.is_in_check(),
+        'fen': game.to_fen()
+    }
+
+def captured_to_dict(game):
+    return {
+        'white': [piece_to_dict(p) for p in game.captured_pieces['white']],
+        'black': [piece_to_dict(p) for p in game.captured_pieces['black']]
+    }
+
+def changes_to_dict(game, since):
+    # Only what changed after version `since`: squares, plus captured lists if they changed
+    changes = {
+        'version': game.version,
+        'since': since,
+        'squares': {SQUARE_NAMES[sq]: piece_to_dict(game.board[sq >> 3][sq & 7])
+                    for sq in game.changed_since(since)},
+        'current_turn': game.current_turn,
+        'merge_count': game.merge_count,
+        'last_move': game.last_move,
+        'status_message': game.status_message,
+        'last_merge_info': game.last_merge_info,
+        'winner': game.winner,
+        'outcome': game.outcome,
+        'in_check': game.is_in_check()
+    }
+    if game.captured_version > since:
+        changes['captured_pieces'] = captured_to_dict(game)
+    return changes
+
+def state_body(session):
+    # The full state is encoded once per version. Call with the session locked.
+    game = session.game
+    if session.state_cache is None or session.state_cache[0] != game.version:
+        session.state_cache = (game.version, json.dumps(state_to_dict(game)))
+    return session.state_cache[1]
+
+def etag_matches(etag, if_none_match):
+    # Whether an If-None-Match header value lists our (unquoted) ETag
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag.strip('"') == etag:
+            return True
+    return False
+
+def state(session, since=None, state_format='json', if_none_match=None):
+    """Returns (status, body, mimetype, etag) for a /state request."""
+    if state_format not in STATE_FORMATS:
+        return 400, json.dumps({'error': f"Unknown format: {state_format}"}), 'application/json', None
+    game = session.game
+    etag = f"{BOOT_ID}-{game.version}" if state_format == 'json' else f"{BOOT_ID}-{game.version}-{state_format}"
+    if etag_matches(etag, if_none_match):
+        return 304, b'', None, etag
+    with metrics.phase('serialize'):
+        if state_format == 'binary':
+            return 200, encode_state(game), 'application/octet-stream', etag
+        if state_format == 'base64':
+            return 200, to_base64(encode_state(game)), 'text/plain', etag
+        # A version from the future (e.g. before a restart) gets the full state
+        if since is not None and since <= game.version:
+            return 200, json.dumps(changes_to_dict(game, since)), 'application/json', etag
+        return 200, state_body(session), 'application/json', etag
+
+def legal_moves(session, square):
+    game = session.game
+    pos = None
+    if square:
+        pos = game.parse_square(square)
+        if pos is None:
+            return {'error': f"Invalid square: {square}"}, 400
+    return {
+        'square': square,
+        'current_turn': game.current_turn,
+        'moves': [move_to_dict(m) for m in game.generate_moves(pos)]
+    }, 200
+
+def publish_update(session):
+    # Pushes what changed since the last update to the game's event streams.
+    # Call with the session locked, after every action.
+    game = session.game
+    if session.subscribers and game.version != session.published_version:
+        with metrics.phase('serialize'):
+            update = json.dumps(changes_to_dict(game, session.published_version))
+        session.publish(update)
+    session.published_version = game.version
+
+def log_actions(session):
+    # Appends the actions applied since the last call to the action log.
+    # Call with the session locked, after every action.
+    if store is None:
+        return
+    history = session.game.history
+    while session.logged_plies > len(history):
+        store.append(session.game_id, UNDO)
+        session.logged_plies -= 1
+    while session.logged_plies < len(history):
+        store.append(session.game_id, ACTION, history[session.logged_plies].move)
+        session.logged_plies += 1
+
+def action_done(session):
+    log_actions(session)
+    publish_update(session)
+
+def rebuild_game(fen, moves):
+    # A game replayed from its start FEN (None for the start position) and actions
+    game = registry.game_factory()
+    if fen:
+        game.load_fen(fen)
+    for move in moves:
+        game.make(move)
+    game.update_outcome()
+    return game
+
+def enable_persistence(directory):
+    # Rebuilds the games found in `directory`, then logs every change to it.
+    # Behind router.py, call enable_handoff() first: games this worker no longer owns are handed off.
+    global store
+    store = GameStore(directory)
+    registry.on_remove = lambda game_id: store.append(game_id, DELETE)
+    moved = {}
+    for game_id, (fen, moves) in store.load().items():
+        if registry.owns is not None and not registry.owns(game_id):
+            moved[game_id] = (fen, moves)
+            store.append(game_id, DELETE)
+            continue
+        session = registry.create(game_id, rebuild_game(fen, moves))
+        session.logged_plies = len(session.game.history)
+    if handoff is not None:
+        handoff.put(moved)
+        # A copy left over from a shutdown that stopped half-way; the log is as recent
+        handoff.remove(list(registry.sessions))
+    registry.on_create = log_created
+    store.start()
+    atexit.register(store.close)
+    return store
+
+def log_created(session):
+    # Called with the registry lock held, so a game taken over from another worker
+    # has its whole history logged before any request can reach it
+    store.append(session.game_id, CREATE)
+    if session.game.start_fen:
+        store.append(session.game_id, LOAD, fen=session.game.start_fen)
+    log_actions(session)
+
+def enable_handoff(handoff_store, index, workers):
+    # Makes this process worker `index` of `workers` behind router.py: it only creates
+    # games it owns, and takes over its games from `handoff_store` when they are first requested
+    global handoff
+    handoff = handoff_store
+    registry.owns = lambda game_id: worker_for(game_id, workers) == index
+
+def take_over(game_id):
+    # Rebuilds a game another worker (or this one, before a restart) handed off, or returns None.
+    # Reads SQLite and fsyncs the log, so the ASGI server calls it from a thread.
+    with _handoff_lock:
+        session = registry.get(game_id)
+        if session is not None:
+            return session
+        handed_off = handoff.get(game_id)
+        if handed_off is None:
+            return None
+        session = registry.create(game_id, rebuild_game(*handed_off))
+        if store is not None:
+            store.flush()  # In this worker's log before the handed-off copy goes
+        handoff.remove([game_id])
+        return session
+
+def hand_off_games():
+    # Moves every game to the handoff store, for its owner after a restart or a new
+    # number of workers. Call at shutdown, once requests have stopped.
+    with registry.lock:
+        sessions = list(registry.sessions.values())
+    games = {}
+    for session in sessions:
+        with session.lock:
+            game = session.game
+            games[session.game_id] = (game.start_fen, [undo.move for undo in game.history])
+    handoff.put(games)
+    for game_id in games:
+        registry.remove(game_id)
+    return len(games)
+
+def enable_book(path):
+    # Maps the opening book at `path` for AI moves, if there is one
+    global book
+    if os.path.exists(path):
+        book = OpeningBook(path)
+    return book
+
+def enable_tablebases(directory):
+    # Lets every engine in this process (and worker processes started after) probe the endgame tables
+    if os.path.isdir(directory):
+        engine.use_tablebases(Tablebases(directory))
+
+OK = {'status': 'ok'}
+
+def text_field(data, name):
+    # A string field of the request body; any other type reads as '', which no parser accepts
+    value = data.get(name, '')
+    return value if isinstance(value, str) else ''
+
+def move(session, data):
+    game = session.game
+    start_pos, end_pos = game.parse_move(text_field(data, 'move'))
+    promotion = data.get('promotion') or 'Q'
+    promotion = promotion.upper() if isinstance(promotion, str) else None
+
+    with metrics.phase('validate'):
+        if start_pos is None:
+            error = "Invalid move format."
+        elif promotion not in PROMOTION_CHOICES:
+            error = "Invalid promotion choice."
+        else:
+            error = game.move_error(start_pos, end_pos)
+    if error:
+        game.status_message = error
+    else:
+        with metrics.phase('mutate'):
+            game.move_piece(start_pos, end_pos, promotion)
+    metrics.count_action('move', not error)
+    action_done(session)
+    return OK, 200
+
+def merge(session, data):
+    game = session.game
+    pos1 = game.parse_square(text_field(data, 'pos1'))
+    pos2 = game.parse_square(text_field(data, 'pos2'))
+    if pos1 is None or pos2 is None:
+        error = game.status_message = "Invalid merge command."
+    else:
+        with metrics.phase('validate'):
+            error = game.merge_error(pos1, pos2)
+        # attempt_merge sets the status message either way
+        with metrics.phase('mutate'):
+            game.attempt_merge(pos1, pos2)
+    metrics.count_action('merge', not error)
+    action_done(session)
+    return OK, 200
+
+def disintegrate(session, data):
+    game = session.game
+    pos = game.parse_square(text_field(data, 'pos'))
+    target_pos = game.parse_square(text_field(data, 'target_pos'))
+    if pos is None or target_pos is None:
+        error = game.status_message = "Invalid disintegrate command."
+    else:
+        with metrics.phase('validate'):
+            error = game.disintegrate_error(pos, target_pos)
+        with metrics.phase('mutate'):
+            game.attempt_disintegrate(pos, target_pos)
+    metrics.count_action('disintegrate', not error)
+    action_done(session)
+    return OK, 200
+
+def undo(session, data=None):
+    session.game.attempt_undo()
+    action_done(session)
+    return OK, 200
+
+def reset(session, data=None):
+    session.reset()
+    if store is not None:
+        store.append(session.game_id, RESET)
+    action_done(session)
+    return OK, 200
+
+def fen(session, data=None):
+    return {'fen': session.game.to_fen()}, 200
+
+def load(session, data):
+    # Restarts the game from a Symbiotic FEN position
+    try:
+        session.game.load_fen(text_field(data, 'fen'))
+    except ValueError as e:
+        return {'error': f"Invalid FEN: {e}"}, 400
+    session.logged_plies = 0
+    if store is not None:
+        store.append(session.game_id, LOAD, fen=session.game.to_fen())
+    action_done(session)
+    return OK, 200
+
+# Most actions accepted in one /batch request
+MAX_BATCH_ACTIONS = 1000
+
+def batch(session, data):
+    """Applies a list of actions in notation ("e2e4", "e7e8n", "merge b1 c1", ...) in order.
+
+    Stops at the first action that can't be played. Unless "atomic" is false,
+    the actions applied before it are then taken back, so the batch is
+    all-or-nothing. Returns a result per action and the final game version.
+    """
+    actions = data.get('actions')
+    if not isinstance(actions, list) or not all(isinstance(a, str) for a in actions):
+        return {'error': "'actions' must be a list of action strings"}, 400
+    if len(actions) > MAX_BATCH_ACTIONS:
+        return {'error': f"At most {MAX_BATCH_ACTIONS} actions per batch"}, 400
+    atomic = data.get('atomic', True)
+    if not isinstance(atomic, bool):
+        return {'error': "'atomic' must be true or false"}, 400
+
+    game = session.game
+    messages = game.status_message, game.last_merge_info
+    results, applied, failed = [], 0, False
+    for action in actions:
+        if failed:
+            results.append({'action': action, 'status': 'skipped'})
+            continue
+        move = game.parse_action(action)
+        with metrics.phase('validate'):
+            error = "Invalid action format." if move is None else game.action_error(move)
+        metrics.count_action(move.kind if move else 'invalid', not error)
+        if error:
+            results.append({'action': action, 'status': 'error', 'error': error})
+            failed = True
+            continue
+        with metrics.phase('mutate'):
+            game.apply_move(move)
+        applied += 1
+        results.append({'action': action, 'status': 'ok', 'notation': str(game.history[-1].move)})
+
+    if failed and atomic and applied:
+        for _ in range(applied):
+            game.unmake()
+        game.status_message, game.last_merge_info = messages
+        for result in results:
+            if result['status'] == 'ok':
+                result['status'] = 'rolled_back'
+        applied = 0
+    action_done(session)
+    return {
+        'status': 'error' if failed else 'ok',
+        'applied': applied,
+        'version': game.version,
+        'results': results
+    }, 422 if failed else 200
+
+def start_profile(data):
+    # POST /metrics/profile: cProfile the next N requests
+    if not metrics.enabled:
+        return {'error': "Metrics are disabled; set SYMBIOTIC_CHESS_METRICS=1"}, 404
+    try:
+        requests = int(data.get('requests', 100))
+    except (TypeError, ValueError):
+        return {'error': "'requests' must be a number"}, 400
+    metrics.start_profile(max(requests, 0))
+    return {'status': 'ok', 'requests': requests}, 200
+
+def ai_time_limit(data):
+    # The search time for an /ai_move request, or an error payload, with the HTTP status
+    try:
+        time_limit = float(data.get('time_limit', AI_TIME_LIMIT))
+    except (TypeError, ValueError):
+        time_limit = None
+    if time_limit is None or not math.isfinite(time_limit) or time_limit <= 0:
+        return {'error': "'time_limit' must be a positive number of seconds"}, 400
+    return min(time_limit, AI_TIME_LIMIT), 200
+
+def book_result(game, data):
+    # The AI's move from the opening book as a SearchResult, or None to search
+    if book is None or game.outcome or data.get('book') is False:
+        return None
+    move = book.choose(game)
+    return SearchResult(move, 0, 0, 0, 0.0) if move else None
+
+def book_moves(session):
+    # GET /book: the book's actions for the current position
+    game = session.game
+    moves = book.legal_moves(game) if book is not None else []
+    return {
+        'current_turn': game.current_turn,
+        'moves': [dict(move_to_dict(m.move), games=m.games, wins=m.wins, draws=m.draws, losses=m.losses)
+                  for m in moves]
+    }, 200
+
+def ai_move(session, result, from_book=False):
+    # Plays the engine's (or the book's) SearchResult for the side to move
+    game = session.game
+    if result.move is None:
+        game.status_message = "The game is over." if game.outcome else "No legal moves."
+        action_done(session)
+        return {'status': 'ok', 'move': None}, 200
+    with metrics.phase('mutate'):
+        game.apply_move(result.move)
+    metrics.count_action('ai_' + result.move.kind, True)
+    action_done(session)
+    return {
+        'status': 'ok',
+        'move': move_to_dict(result.move),
+        'score': result.score,
+        'depth': result.depth,
+        'nodes': result.nodes,
+        'book': from_book
+    }, 200
+
+# One engine per worker process, reused across requests (see search_fen)
+_worker_engine = None
+
+def search_fen(fen, time_limit):
+    """AI search on a position given as FEN, for running in a worker process."""
+    global _worker_engine
+    if _worker_engine is None:
+        _worker_engine = Engine()
+    return _worker_engine.search(SymbioticChessGame.from_fen(fen, headless=True), time_limit=time_limit)
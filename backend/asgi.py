@@ -0,0 +1,273 @@
+"""ASGI server for the game API (see api.py), the recommended way to run the backend.
+
+    python asgi.py                      # uvicorn on port 5000
+    uvicorn asgi:app --port 5000        # the same, from the command line
+
+One process serves every game from a single event loop. Actions on a game are
+serialized by the game's asyncio lock; actions on different games never wait
+for each other. AI searches run in a process pool, so a long search doesn't
+stall other games. Games live in memory, so don't start several uvicorn
+workers on the same port: router.py runs several processes of this app, each
+owning its share of the games.
+"""
+import asyncio
+import contextlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import analysis
+import api
+import metrics
+from api import DEFAULT_GAME_ID, EVENT_KEEPALIVE, registry
+from encoding import piece_table
+from engine import SearchResult
+from handoff import SQLiteHandoff
+from registry import SUBSCRIBER_QUEUE_SIZE
+
+# Worker processes for AI searches; router.py shares the cores out between its workers
+AI_WORKERS = int(os.environ.get('SYMBIOTIC_CHESS_AI_WORKERS', 0)) or os.cpu_count() or 1
+
+ai_pool = None
+
+
+async def get_session(request):
+    game_id = request.path_params.get('game_id', DEFAULT_GAME_ID)
+    session = registry.get(game_id)
+    if session is None:
+        # Taking over a handed-off game reads SQLite and fsyncs the log, so not on the event loop
+        session = await run_in_threadpool(api.get_session, game_id)
+    if session is None:
+        raise HTTPException(404)
+    return session
+
+
+async def request_data(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def action_endpoint(handler):
+    # A POST endpoint that runs an api action handler under the game's asyncio lock
+    async def endpoint(request):
+        session = await get_session(request)
+        data = await request_data(request)
+        async with metrics.timed_lock(session.async_lock):
+            payload, status = handler(session, data)
+        return JSONResponse(payload, status)
+    endpoint.__name__ = handler.__name__
+    return endpoint
+
+
+async def create_game(request):
+    session = registry.create()
+    return JSONResponse({'game_id': session.game_id}, 201)
+
+
+async def delete_game(request):
+    if not registry.remove(request.path_params['game_id']):
+        raise HTTPException(404)
+    return JSONResponse({'status': 'ok'})
+
+
+async def get_state(request):
+    session = await get_session(request)
+    since = request.query_params.get('since')
+    since = int(since) if since and since.lstrip('-').isdigit() else None
+    async with metrics.timed_lock(session.async_lock):
+        status, body, mimetype, etag = api.state(session, since, request.query_params.get('format', 'json'),
+                                                 request.headers.get('if-none-match'))
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'} if etag else None
+    return Response(body, status, headers, mimetype)
+
+
+async def piece_codes(request):
+    return JSONResponse(piece_table())
+
+
+async def get_metrics(request):
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+async def get_profile(request):
+    return PlainTextResponse(metrics.profile_report())
+
+
+async def start_profile(request):
+    payload, status = api.start_profile(await request_data(request))
+    return JSONResponse(payload, status)
+
+
+async def events(request):
+    # Server-Sent Events: the full state once, then one small update per action
+    session = await get_session(request)
+    subscriber = session.subscribe(asyncio.Queue(SUBSCRIBER_QUEUE_SIZE))
+    async with metrics.timed_lock(session.async_lock):
+        initial = api.state_body(session)
+
+    async def stream():
+        try:
+            yield f"event: state\ndata: {initial}\n\n"
+            while subscriber in session.subscribers:
+                try:
+                    message = await asyncio.wait_for(subscriber.get(), EVENT_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {message}\n\n"
+        finally:
+            session.unsubscribe(subscriber)
+
+    return StreamingResponse(stream(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def legal_moves(request):
+    session = await get_session(request)
+    async with metrics.timed_lock(session.async_lock):
+        payload, status = api.legal_moves(session, request.query_params.get('square'))
+    return JSONResponse(payload, status)
+
+
+async def get_fen(request):
+    session = await get_session(request)
+    async with metrics.timed_lock(session.async_lock):
+        payload, status = api.fen(session)
+    return JSONResponse(payload, status)
+
+
+async def ai_move(request):
+    session = await get_session(request)
+    data = await request_data(request)
+    time_limit, status = api.ai_time_limit(data)
+    if status != 200:
+        return JSONResponse(time_limit, status)
+    async with metrics.timed_lock(session.async_lock):
+        game = session.game
+        result = api.book_result(game, data)
+        if game.outcome:
+            payload, status = api.ai_move(session, SearchResult(None, 0, 0, 0, 0.0))
+        elif result is not None:
+            payload, status = api.ai_move(session, result, from_book=True)
+        else:
+            # The worker only needs the position; the lock keeps the game unchanged meanwhile
+            result = await asyncio.get_running_loop().run_in_executor(
+                ai_pool, api.search_fen, game.to_fen(), time_limit)
+            payload, status = api.ai_move(session, result)
+    return JSONResponse(payload, status)
+
+
+async def analyze(request):
+    # Evaluations run in the AI pool, after the game's lock is released
+    session = await get_session(request)
+    async with metrics.timed_lock(session.async_lock):
+        job, status = analysis.start(session, request.query_params.get('depth'))
+    if status != 200:
+        return JSONResponse(job, status)
+    return StreamingResponse(job.async_events(ai_pool), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+async def book_moves(request):
+    session = await get_session(request)
+    async with metrics.timed_lock(session.async_lock):
+        payload, status = api.book_moves(session)
+    return JSONResponse(payload, status)
+
+
+def game_routes(rule, endpoint, methods):
+    # The route for the default game and the one under /games/{game_id}
+    return [Route(rule, endpoint, methods=methods),
+            Route(f"/games/{{game_id}}{rule}", endpoint, methods=methods)]
+
+
+class MetricsMiddleware:
+    # Times each HTTP request (up to the start of its response) by endpoint
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not metrics.enabled or scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        profiler = metrics.profile_begin()
+        started = time.perf_counter()
+
+        async def send_timed(message):
+            if message['type'] == 'http.response.start':
+                endpoint = scope.get('endpoint')
+                metrics.observe_request(getattr(endpoint, '__name__', None), message['status'],
+                                        time.perf_counter() - started)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            if profiler:
+                metrics.profile_end(profiler)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global ai_pool
+    # Set by router.py for each of its workers
+    handoff_path = os.environ.get('SYMBIOTIC_CHESS_HANDOFF')
+    if handoff_path:
+        api.enable_handoff(SQLiteHandoff(handoff_path), int(os.environ.get('SYMBIOTIC_CHESS_WORKER', 0)),
+                           int(os.environ.get('SYMBIOTIC_CHESS_WORKERS', 1)))
+    api.enable_persistence(os.environ.get('SYMBIOTIC_CHESS_DATA', 'data'))
+    api.enable_book(os.environ.get('SYMBIOTIC_CHESS_BOOK', 'book.bin'))
+    api.enable_tablebases(os.environ.get('SYMBIOTIC_CHESS_TABLEBASES', 'tablebases'))
+    ai_pool = ProcessPoolExecutor(max_workers=AI_WORKERS)
+    try:
+        yield
+    finally:
+        ai_pool.shutdown(cancel_futures=True)
+        if api.handoff is not None:
+            api.hand_off_games()
+            api.handoff.close()
+        api.store.close()
+
+
+routes = [
+    Route('/games', create_game, methods=['POST']),
+    Route('/games/{game_id}', delete_game, methods=['DELETE']),
+    Route('/piece_codes', piece_codes, methods=['GET']),
+    Route('/metrics', get_metrics, methods=['GET']),
+    Route('/metrics/profile', get_profile, methods=['GET']),
+    Route('/metrics/profile', start_profile, methods=['POST']),
+    *game_routes('/state', get_state, ['GET']),
+    *game_routes('/events', events, ['GET']),
+    *game_routes('/legal_moves', legal_moves, ['GET']),
+    *game_routes('/fen', get_fen, ['GET']),
+    *game_routes('/ai_move', ai_move, ['POST']),
+    *game_routes('/book', book_moves, ['GET']),
+    *game_routes('/analysis', analyze, ['GET']),
+    *game_routes('/move', action_endpoint(api.move), ['POST']),
+    *game_routes('/merge', action_endpoint(api.merge), ['POST']),
+    *game_routes('/disintegrate', action_endpoint(api.disintegrate), ['POST']),
+    *game_routes('/undo', action_endpoint(api.undo), ['POST']),
+    *game_routes('/reset', action_endpoint(api.reset), ['POST']),
+    *game_routes('/load', action_endpoint(api.load), ['POST']),
+    *game_routes('/batch', action_endpoint(api.batch), ['POST']),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan, middleware=[
+    Middleware(MetricsMiddleware),
+    Middleware(CORSMiddleware, allow_origins=['*'], allow_headers=['Content-Type', 'Authorization'],
+               allow_methods=['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'])
+])
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5000, workers=1)
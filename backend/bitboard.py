@@ -0,0 +1,271 @@
+# Bitboard primitives for SymbioticChessGame.
+#
+# Squares are numbered the same way the board list is indexed: sq = row * 8 + col,
+# where row 0 is rank 8 and col 0 is file a. A bitboard is a plain Python int with
+# bit `sq` set for every occupied square.
+
+WHITE, BLACK = 0, 1
+COLOR_INDEX = {'white': WHITE, 'black': BLACK}
+
+# One bit per component type. A merged piece is the union of its components'
+# bits, e.g. a Chancellor is ROOK | KNIGHT.
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = 1, 2, 4, 8, 16, 32
+PIECE_TYPES = 'PNBRQK'
+TYPE_BITS = {'P': PAWN, 'N': KNIGHT, 'B': BISHOP, 'R': ROOK, 'Q': QUEEN, 'K': KING}
+# Indexes into Position.pieces[color], in the same order as the bits
+PAWNS, KNIGHTS, BISHOPS, ROOKS, QUEENS, KINGS = range(6)
+
+
+def square(row, col):
+    return row * 8 + col
+
+
+def types_mask(piece_types):
+    mask = 0
+    for piece_type in piece_types:
+        mask |= TYPE_BITS[piece_type]
+    return mask
+
+
+def iter_bits(bb):
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+
+def _offsets_table(offsets):
+    table = []
+    for sq in range(64):
+        row, col = divmod(sq, 8)
+        bb = 0
+        for d_row, d_col in offsets:
+            r, c = row + d_row, col + d_col
+            if 0 <= r < 8 and 0 <= c < 8:
+                bb |= 1 << square(r, c)
+        table.append(bb)
+    return table
+
+
+def _ray_table(d_row, d_col):
+    table = []
+    for sq in range(64):
+        row, col = divmod(sq, 8)
+        bb = 0
+        r, c = row + d_row, col + d_col
+        while 0 <= r < 8 and 0 <= c < 8:
+            bb |= 1 << square(r, c)
+            r += d_row
+            c += d_col
+        table.append(bb)
+    return table
+
+
+KNIGHT_ATTACKS = _offsets_table([(-2, -1), (-2, 1), (-1, -2), (-1, 2),
+                                 (1, -2), (1, 2), (2, -1), (2, 1)])
+KING_ATTACKS = _offsets_table([(-1, -1), (-1, 0), (-1, 1), (0, -1),
+                               (0, 1), (1, -1), (1, 0), (1, 1)])
+# White pawns move towards row 0, black pawns towards row 7.
+PAWN_ATTACKS = [_offsets_table([(-1, -1), (-1, 1)]), _offsets_table([(1, -1), (1, 1)])]
+PAWN_DIRECTION = [-8, 8]
+PAWN_START_ROW = [6, 1]
+
+# Rays leaving each square. "Positive" rays run towards higher square numbers, so
+# the nearest blocker on them is the lowest set bit; on negative rays it is the
+# highest set bit.
+RAY_N = _ray_table(-1, 0)
+RAY_S = _ray_table(1, 0)
+RAY_W = _ray_table(0, -1)
+RAY_E = _ray_table(0, 1)
+RAY_NW = _ray_table(-1, -1)
+RAY_NE = _ray_table(-1, 1)
+RAY_SW = _ray_table(1, -1)
+RAY_SE = _ray_table(1, 1)
+
+ROOK_LINES = [RAY_N[sq] | RAY_S[sq] | RAY_W[sq] | RAY_E[sq] for sq in range(64)]
+BISHOP_LINES = [RAY_NW[sq] | RAY_NE[sq] | RAY_SW[sq] | RAY_SE[sq] for sq in range(64)]
+
+# Squares strictly between two squares on a common line, 0 when they don't share one.
+BETWEEN = [[0] * 64 for _ in range(64)]
+for _rays in (RAY_N, RAY_S, RAY_W, RAY_E, RAY_NW, RAY_NE, RAY_SW, RAY_SE):
+    for _start in range(64):
+        _bb = _rays[_start]
+        while _bb:
+            _end = (_bb & -_bb).bit_length() - 1
+            BETWEEN[_start][_end] = _rays[_start] & ~_rays[_end] & ~(1 << _end)
+            _bb &= _bb - 1
+
+
+def _empty_board_reach(mask, sq):
+    bb = 0
+    if mask & KNIGHT:
+        bb |= KNIGHT_ATTACKS[sq]
+    if mask & KING:
+        bb |= KING_ATTACKS[sq]
+    if mask & (ROOK | QUEEN):
+        bb |= ROOK_LINES[sq]
+    if mask & (BISHOP | QUEEN):
+        bb |= BISHOP_LINES[sq]
+    return bb
+
+
+# Non-pawn reach on an empty board for every combination of component bits,
+# so ruling out a target for any merged piece is a single lookup.
+EMPTY_BOARD_REACH = [[_empty_board_reach(mask, sq) for sq in range(64)] for mask in range(64)]
+
+
+def _positive_ray(rays, sq, occupied):
+    ray = rays[sq]
+    blockers = ray & occupied
+    if blockers:
+        ray ^= rays[(blockers & -blockers).bit_length() - 1]
+    return ray
+
+
+def _negative_ray(rays, sq, occupied):
+    ray = rays[sq]
+    blockers = ray & occupied
+    if blockers:
+        ray ^= rays[blockers.bit_length() - 1]
+    return ray
+
+
+def rook_attacks(sq, occupied):
+    return (_positive_ray(RAY_S, sq, occupied) | _positive_ray(RAY_E, sq, occupied) |
+            _negative_ray(RAY_N, sq, occupied) | _negative_ray(RAY_W, sq, occupied))
+
+
+def bishop_attacks(sq, occupied):
+    return (_positive_ray(RAY_SE, sq, occupied) | _positive_ray(RAY_SW, sq, occupied) |
+            _negative_ray(RAY_NE, sq, occupied) | _negative_ray(RAY_NW, sq, occupied))
+
+
+class Position:
+    """Bitboard view of the board: occupancy per color plus one bitboard per component type.
+
+    A merged piece sets its square in the bitboard of every component it is made of,
+    so the move set of a Chancellor is simply the OR of the rook and knight sets.
+    """
+
+    def __init__(self):
+        self.occupied = [0, 0]
+        self.pieces = [[0] * 6, [0] * 6]
+        self.masks = [0] * 64
+        self.colors = [None] * 64
+
+    def clear(self):
+        self.__init__()
+
+    def remove(self, sq):
+        mask = self.masks[sq]
+        if not mask:
+            return
+        color = self.colors[sq]
+        bit = 1 << sq
+        self.occupied[color] &= ~bit
+        pieces = self.pieces[color]
+        for index in range(6):
+            if mask >> index & 1:
+                pieces[index] &= ~bit
+        self.masks[sq] = 0
+        self.colors[sq] = None
+
+    def place(self, sq, color, mask):
+        self.remove(sq)
+        if not mask:
+            return
+        bit = 1 << sq
+        self.occupied[color] |= bit
+        pieces = self.pieces[color]
+        for index in range(6):
+            if mask >> index & 1:
+                pieces[index] |= bit
+        self.masks[sq] = mask
+        self.colors[sq] = color
+
+    def pawn_pushes(self, sq, color):
+        occupied = self.occupied[WHITE] | self.occupied[BLACK]
+        step = sq + PAWN_DIRECTION[color]
+        if not 0 <= step < 64 or occupied >> step & 1:
+            return 0
+        bb = 1 << step
+        if sq >> 3 == PAWN_START_ROW[color]:
+            double = step + PAWN_DIRECTION[color]
+            if not occupied >> double & 1:
+                bb |= 1 << double
+        return bb
+
+    def can_move(self, start, end, color, mask):
+        """Whether the piece on `start` may move to (or capture on) `end`."""
+        bit = 1 << end
+        if self.occupied[color] & bit:
+            return False
+        if EMPTY_BOARD_REACH[mask][start] & bit:
+            if mask & KNIGHT and KNIGHT_ATTACKS[start] & bit:
+                return True
+            if mask & KING and KING_ATTACKS[start] & bit:
+                return True
+            # Sliders: on an empty board the target is on one of our lines, so only
+            # the squares in between have to be free
+            if not BETWEEN[start][end] & (self.occupied[WHITE] | self.occupied[BLACK]):
+                if mask & (ROOK | QUEEN) and ROOK_LINES[start] & bit:
+                    return True
+                if mask & (BISHOP | QUEEN) and BISHOP_LINES[start] & bit:
+                    return True
+        if mask & PAWN:
+            if PAWN_ATTACKS[color][start] & self.occupied[color ^ 1] & bit:
+                return True
+            return bool(self.pawn_pushes(start, color) & bit)
+        return False
+
+    def attackers(self, sq, color, occupied=None, exclude=0):
+        """Pieces of `color` that could capture on `sq`, as a bitboard.
+
+        A merged piece is in the bitboard of each of its components, so it is found
+        through whichever of them reaches `sq`. `occupied` and `exclude` (pieces
+        taken off the board) let callers ask about the position after an action
+        without playing it.
+        """
+        if occupied is None:
+            occupied = self.occupied[WHITE] | self.occupied[BLACK]
+        pieces = self.pieces[color]
+        bb = (PAWN_ATTACKS[color ^ 1][sq] & pieces[PAWNS] | KNIGHT_ATTACKS[sq] & pieces[KNIGHTS] |
+              KING_ATTACKS[sq] & pieces[KINGS])
+        rooks = (pieces[ROOKS] | pieces[QUEENS]) & ROOK_LINES[sq]
+        if rooks:
+            bb |= rook_attacks(sq, occupied) & rooks
+        bishops = (pieces[BISHOPS] | pieces[QUEENS]) & BISHOP_LINES[sq]
+        if bishops:
+            bb |= bishop_attacks(sq, occupied) & bishops
+        return bb & ~exclude
+
+    def pinned(self, king, color):
+        """Pieces of `color` that are the only piece between their King on `king` and an enemy slider."""
+        enemy = self.pieces[color ^ 1]
+        snipers = (ROOK_LINES[king] & (enemy[ROOKS] | enemy[QUEENS]) |
+                   BISHOP_LINES[king] & (enemy[BISHOPS] | enemy[QUEENS]))
+        occupied = self.occupied[WHITE] | self.occupied[BLACK]
+        pinned = 0
+        for sniper in iter_bits(snipers):
+            between = BETWEEN[king][sniper] & occupied
+            if between and not between & (between - 1):
+                pinned |= between & self.occupied[color]
+        return pinned
+
+    def targets(self, sq, color, mask):
+        """Every square the piece on `sq` may move to (or capture on) under the game's rules."""
+        occupied = self.occupied[WHITE] | self.occupied[BLACK]
+        enemy = self.occupied[color ^ 1]
+        bb = 0
+        if mask & KNIGHT:
+            bb |= KNIGHT_ATTACKS[sq]
+        if mask & KING:
+            bb |= KING_ATTACKS[sq]
+        if mask & (ROOK | QUEEN):
+            bb |= rook_attacks(sq, occupied)
+        if mask & (BISHOP | QUEEN):
+            bb |= bishop_attacks(sq, occupied)
+        bb &= ~self.occupied[color]
+        if mask & PAWN:
+            bb |= (PAWN_ATTACKS[color][sq] & enemy) | self.pawn_pushes(sq, color)
+        return bb
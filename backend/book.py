@@ -0,0 +1,219 @@
+"""Opening book: position hash -> candidate actions with game counts and results.
+
+Built from self-play, from simulate.py output recorded with --record-moves, or
+from the games a server has persisted:
+
+    python book.py build book.bin --selfplay 2000            # AI vs AI on every core
+    python book.py build book.bin --records results.jsonl --data data
+    python book.py probe book.bin                            # candidates from the start position
+    python book.py probe book.bin "<fen>"
+
+The file is a header followed by fixed-size entries sorted by (position hash,
+packed action), little-endian:
+
+    header  4s magic b'SCBK', H format version, H plies per game indexed, I entry count
+    entry   Q SymbioticChessGame.position_hash, H Move.pack(), I games,
+            I games won by the side to move, I games drawn
+
+OpeningBook memory-maps the file read-only and binary-searches it, so every
+server process shares one copy through the page cache and a probe only reads
+the few entries it touches. Hashes are Zobrist keys (zobrist.py) with a fixed
+seed, so a book stays valid across processes and restarts.
+"""
+import argparse
+import json
+import mmap
+import os
+import random
+import struct
+import sys
+from collections import namedtuple
+
+from game import SymbioticChessGame, Move, START_FEN
+
+MAGIC = b'SCBK'
+BOOK_FORMAT = 1
+# Actions past this ply aren't indexed
+BOOK_PLIES = 16
+# Actions played in fewer games than this are left out of the book
+MIN_GAMES = 2
+# Chance of a random move in self-play; the search alone plays the same game every time
+SELF_PLAY_RANDOM = 0.1
+
+_HEADER = struct.Struct('<4sHHI')
+_ENTRY = struct.Struct('<QHIII')
+
+BookMove = namedtuple('BookMove', ['move', 'games', 'wins', 'draws', 'losses'])
+
+
+class OpeningBook:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.plies, self.count = _HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != BOOK_FORMAT:
+            self.data.close()
+            raise ValueError(f"{path} is not an opening book in format {BOOK_FORMAT}")
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.data.close()
+
+    def _key(self, index):
+        return struct.unpack_from('<Q', self.data, _HEADER.size + index * _ENTRY.size)[0]
+
+    def probe(self, position_hash):
+        """The book's actions for a position, most played first ([] if it isn't in the book)."""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < position_hash:
+                lo = mid + 1
+            else:
+                hi = mid
+        moves = []
+        offset = _HEADER.size + lo * _ENTRY.size
+        while lo < self.count:
+            key, packed, games, wins, draws = _ENTRY.unpack_from(self.data, offset)
+            if key != position_hash:
+                break
+            moves.append(BookMove(Move.unpack(packed), games, wins, draws, games - wins - draws))
+            lo += 1
+            offset += _ENTRY.size
+        moves.sort(key=lambda m: -m.games)
+        return moves
+
+    def legal_moves(self, game):
+        # probe() for the game's position, keeping only legal actions in case of a hash collision
+        moves = self.probe(game.position_hash)
+        if moves:
+            legal = set(game.generate_moves())
+            moves = [m for m in moves if m.move in legal]
+        return moves
+
+    def choose(self, game, rng=random):
+        """A book action for the game, picked in proportion to how often it was played, or None."""
+        moves = self.legal_moves(game)
+        if not moves:
+            return None
+        return rng.choices([m.move for m in moves], weights=[m.games for m in moves])[0]
+
+
+def book_stats(games, plies=BOOK_PLIES):
+    """Counts (games, wins, draws) per (position hash, packed action) over (start FEN, [action], winner) games."""
+    stats = {}
+    for fen, actions, winner in games:
+        game = SymbioticChessGame.from_fen(fen or START_FEN, headless=True)
+        for action in actions[:plies]:
+            move = game.parse_action(action) if isinstance(action, str) else action
+            if move is None or game.action_error(move):
+                break
+            key = (game.position_hash, move.pack())
+            counts = stats.get(key)
+            if counts is None:
+                counts = stats[key] = [0, 0, 0]
+            counts[0] += 1
+            if winner == game.current_turn:
+                counts[1] += 1
+            elif winner is None:
+                counts[2] += 1
+            game.apply_move(move)
+            if game.outcome:
+                break
+    return stats
+
+
+def write_book(path, stats, plies=BOOK_PLIES, min_games=MIN_GAMES):
+    """Writes the entries played at least min_games times, sorted, and returns how many there are."""
+    entries = sorted((key, packed, *counts) for (key, packed), counts in stats.items() if counts[0] >= min_games)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, BOOK_FORMAT, plies, len(entries)))
+        for entry in entries:
+            f.write(_ENTRY.pack(*entry))
+    os.replace(tmp_path, path)  # A server never maps a half-written book
+    return len(entries)
+
+
+def self_play_games(count, workers=None, seed=0, ai_nodes=2000, ai_random=SELF_PLAY_RANDOM):
+    import simulate
+    options = {'white': 'ai', 'black': 'ai', 'max_merges': 3, 'max_plies': simulate.MAX_PLIES,
+               'ai_nodes': ai_nodes, 'ai_depth': 32, 'ai_random': ai_random, 'record_moves': True}
+    for result in simulate.run(count, options, workers, seed):
+        yield None, result['moves'], result['winner']
+
+
+def recorded_games(path):
+    # Games from a simulate.py --record-moves file
+    with open(path) as f:
+        for line in f:
+            result = json.loads(line)
+            if 'moves' in result:
+                yield None, result['moves'], result['winner']
+
+
+def persisted_games(directory):
+    # Games a server has persisted (persistence.py); unfinished games count as draws
+    from persistence import GameStore
+    for game_id, (fen, moves) in GameStore(directory).load().items():
+        game = SymbioticChessGame.from_fen(fen or START_FEN, headless=True)
+        for move in moves:
+            game.make(move)
+        game.update_outcome()
+        yield fen, moves, game.winner
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or query a Symbiotic Chess opening book")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build = commands.add_parser('build', help="build a book file")
+    build.add_argument('path', help="book file to write")
+    build.add_argument('--selfplay', type=int, default=0, help="AI vs AI games to play")
+    build.add_argument('--ai-nodes', type=int, default=2000, help="search nodes per self-play move")
+    build.add_argument('--ai-random', type=float, default=SELF_PLAY_RANDOM,
+                       help="chance of a random self-play move, for variety")
+    build.add_argument('--records', action='append', default=[], help="simulate.py --record-moves output")
+    build.add_argument('--data', action='append', default=[], help="a server's persistence directory")
+    build.add_argument('--plies', type=int, default=BOOK_PLIES, help="actions indexed per game")
+    build.add_argument('--min-games', type=int, default=MIN_GAMES, help="games an action needs to be kept")
+    build.add_argument('-j', '--workers', type=int, help="self-play worker processes (default: all cores)")
+    build.add_argument('--seed', type=int, default=0)
+    probe = commands.add_parser('probe', help="list the book's actions for a position")
+    probe.add_argument('path', help="book file")
+    probe.add_argument('fen', nargs='?', default=START_FEN, help="position (default: the start position)")
+    args = parser.parse_args(argv)
+
+    if args.command == 'probe':
+        book = OpeningBook(args.path)
+        game = SymbioticChessGame.from_fen(args.fen, headless=True)
+        moves = book.legal_moves(game)
+        for m in moves:
+            print(f"{str(m.move):<20}{m.games:>8} games  +{m.wins} ={m.draws} -{m.losses}")
+        print(f"{len(moves)} book actions ({len(book)} entries in the book)")
+        return 0
+
+    sources = []
+    if args.selfplay:
+        sources.append(self_play_games(args.selfplay, args.workers, args.seed, args.ai_nodes,
+                                       args.ai_random))
+    sources += [recorded_games(path) for path in args.records]
+    sources += [persisted_games(directory) for directory in args.data]
+    if not sources:
+        parser.error("nothing to build from: use --selfplay, --records or --data")
+    stats = {}
+    for source in sources:
+        for key, counts in book_stats(source, args.plies).items():
+            total = stats.setdefault(key, [0, 0, 0])
+            for i in range(3):
+                total[i] += counts[i]
+    entries = write_book(args.path, stats, args.plies, args.min_games)
+    print(f"{entries} entries ({entries * _ENTRY.size + _HEADER.size:,} bytes) written to {args.path}",
+          file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""Compact binary forms of a game, for the API and for stored games.
+
+A square is one byte, the piece code from game.PIECES (0 is an empty square),
+so a board is 64 bytes. An action is two bytes (Move.pack), so a game record
+is two bytes per action. Little-endian throughout.
+
+State, as served by /state?format=binary (or base64-encoded with format=base64):
+
+    offset  size  field
+    0       1     format version (STATE_FORMAT)
+    1       8     game version
+    9       64    board, one piece code per square, a8 first (square index order)
+    73      1     side to move (0 white, 1 black)
+    74      2     merges made by white, by black
+    76      1     max_merges
+    77      1     winner (0 none, 1 white, 2 black, 3 draw by stalemate)
+    78      2     last action (Move.pack), 0xFFFF if none
+    80      1+n   pieces captured by white: count, then piece codes
+    ..      1+n   pieces captured by black: count, then piece codes
+
+Status and merge messages are only sent in the JSON state.
+"""
+import base64
+import struct
+
+from game import PIECES, STALEMATE, Move, piece_code
+
+STATE_FORMAT = 1
+NO_MOVE = 0xFFFF
+
+_HEADER = struct.Struct('<BQ64sBBBBBH')
+_COLORS = ('white', 'black')
+_RESULTS = (None, 'white', 'black', STALEMATE)
+
+
+# Color bit (64 for black) plus component bits (bitboard.PAWN ... KING) of every piece code
+PIECE_MASKS = bytes(0 if p is None else (p.color == 'black') << 6 | p.types_mask() for p in PIECES)
+
+
+def piece_table():
+    """The code table as JSON-ready dicts, for clients decoding the binary board."""
+    return [{
+        'code': piece.code,
+        'mask': PIECE_MASKS[piece.code],
+        'piece_type': piece.piece_type,
+        'color': piece.color,
+        'combined_pieces': piece.combined_pieces,
+        'display_info': piece.get_display_info()
+    } for piece in PIECES[1:]]
+
+
+def encode_board(game):
+    return bytes(game.codes)
+
+
+def decode_board(data):
+    # 64 piece codes to an 8x8 board of shared Pieces
+    return [[PIECES[code] for code in data[row * 8:row * 8 + 8]] for row in range(8)]
+
+
+def encode_state(game):
+    last = game.history[-1].move.pack() if game.history else NO_MOVE
+    data = bytearray(_HEADER.pack(
+        STATE_FORMAT, game.version, bytes(game.codes), _COLORS.index(game.current_turn),
+        game.merge_count['white'], game.merge_count['black'], game.max_merges,
+        _RESULTS.index(game.winner if game.outcome != STALEMATE else STALEMATE), last))
+    for color in _COLORS:
+        captured = game.captured_pieces[color]
+        data.append(len(captured))
+        data += bytes(piece_code(p) for p in captured)
+    return bytes(data)
+
+
+def decode_state(data):
+    """Inverse of encode_state; returns a dict shaped like the JSON state (without messages)."""
+    fmt, version, board, turn, white_merges, black_merges, max_merges, winner, last = _HEADER.unpack_from(data)
+    if fmt != STATE_FORMAT:
+        raise ValueError(f"Unknown state format {fmt}")
+    offset = _HEADER.size
+    captured = {}
+    for color in _COLORS:
+        count = data[offset]
+        captured[color] = [PIECES[code] for code in data[offset + 1:offset + 1 + count]]
+        offset += 1 + count
+    return {
+        'version': version,
+        'board': decode_board(board),
+        'current_turn': _COLORS[turn],
+        'merge_count': {'white': white_merges, 'black': black_merges},
+        'max_merges': max_merges,
+        'winner': _RESULTS[winner] if winner in (1, 2) else None,
+        'stalemate': winner == 3,
+        'last_move': None if last == NO_MOVE else Move.unpack(last),
+        'captured_pieces': captured
+    }
+
+
+def encode_moves(moves):
+    """A game record: two bytes per action."""
+    return struct.pack(f'<{len(moves)}H', *(move.pack() for move in moves))
+
+
+def decode_moves(data):
+    return [Move.unpack(value) for value in struct.unpack(f'<{len(data) // 2}H', data)]
+
+
+def to_base64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def from_base64(text):
+    return base64.b64decode(text)
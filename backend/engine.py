@@ -0,0 +1,302 @@
+"""Search engine for single-player mode.
+
+Iterative-deepening negamax with alpha-beta pruning, a bounded transposition
+table keyed by SymbioticChessGame.position_hash and a hard time/node budget.
+The search runs on the game itself through make()/unmake() and always leaves
+it as it found it.
+"""
+import time
+from collections import namedtuple
+
+from bitboard import PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, iter_bits
+from game import SPECIAL_PIECE_INFO, SPECIAL_PIECE_MASKS, MOVE, MERGE
+from tablebase import WIN, LOSS
+
+INFINITY = 1_000_000
+MATE = 100_000
+
+COMPONENT_VALUES = {PAWN: 100, KNIGHT: 300, BISHOP: 320, ROOK: 500, QUEEN: 900, KING: 0}
+
+# Merged pieces are worth more than their parts: they strike from one square in
+# several ways. Keys match SPECIAL_PIECE_INFO.
+SPECIAL_PIECE_VALUES = {'G': 1350, 'M': 1250, 'A': 850, 'C': 900, 'Q': 900}
+assert set(SPECIAL_PIECE_VALUES) == set(SPECIAL_PIECE_INFO)
+
+# Each unspent merge is an option worth keeping; spending one has to gain more than this
+MERGE_VALUE = 40
+PAWN_ADVANCE_VALUE = 8
+
+
+def _mask_value(mask):
+    # Same precedence as Piece.display_info
+    for symbol, special in SPECIAL_PIECE_MASKS:
+        if mask & special == special:
+            rest = mask & ~special
+            return SPECIAL_PIECE_VALUES[symbol] + sum(v for bit, v in COMPONENT_VALUES.items() if rest & bit)
+    return sum(v for bit, v in COMPONENT_VALUES.items() if mask & bit)
+
+
+MASK_VALUES = [_mask_value(mask) for mask in range(64)]
+
+
+def evaluate(game):
+    """Static score in centipawns from the point of view of the side to move."""
+    position = game.position
+    masks = position.masks
+    score = 0
+    for sq in iter_bits(position.occupied[0]):
+        mask = masks[sq]
+        score += MASK_VALUES[mask]
+        if mask & PAWN:
+            score += (6 - (sq >> 3)) * PAWN_ADVANCE_VALUE
+    for sq in iter_bits(position.occupied[1]):
+        mask = masks[sq]
+        score -= MASK_VALUES[mask]
+        if mask & PAWN:
+            score -= ((sq >> 3) - 1) * PAWN_ADVANCE_VALUE
+    score += (game.merge_count['black'] - game.merge_count['white']) * MERGE_VALUE
+    return score if game.current_turn == 'white' else -score
+
+
+EXACT, LOWER, UPPER = 0, 1, 2
+
+TTEntry = namedtuple('TTEntry', ['key', 'depth', 'score', 'flag', 'move', 'generation'])
+
+
+class TranspositionTable:
+    """Fixed number of slots indexed by the low bits of the position hash.
+
+    An entry is replaced when it comes from an earlier search or when the new
+    result was searched at least as deep.
+    """
+
+    def __init__(self, size=1 << 18):
+        self.size = 1 << (size - 1).bit_length()
+        self.slots = [None] * self.size
+        self.generation = 0
+
+    def new_search(self):
+        self.generation += 1
+
+    def probe(self, key):
+        entry = self.slots[key & (self.size - 1)]
+        if entry is not None and entry.key == key:
+            return entry
+        return None
+
+    def store(self, key, depth, score, flag, move):
+        index = key & (self.size - 1)
+        entry = self.slots[index]
+        if entry is None or entry.generation != self.generation or depth >= entry.depth or entry.key == key:
+            self.slots[index] = TTEntry(key, depth, score, flag, move, self.generation)
+
+    def clear(self):
+        self.slots = [None] * self.size
+
+
+SearchResult = namedtuple('SearchResult', ['move', 'score', 'depth', 'nodes', 'elapsed'])
+
+# Endgame tablebases (tablebase.Tablebases) that new engines probe; see use_tablebases()
+default_tablebases = None
+
+
+def use_tablebases(tablebases):
+    global default_tablebases
+    default_tablebases = tablebases
+
+
+def _tablebase_score(wdl, dtm, ply):
+    # A tablebase result as a search score, with mates counted from the root like -MATE + ply
+    if wdl == WIN:
+        return MATE - ply - dtm
+    if wdl == LOSS:
+        return -MATE + ply + dtm
+    return 0
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class Engine:
+    def __init__(self, time_limit=1.0, max_nodes=None, tt_size=1 << 18, tablebases=None):
+        self.time_limit = time_limit
+        self.max_nodes = max_nodes
+        # Positions the tablebases cover are scored from them instead of searched
+        self.tablebases = tablebases if tablebases is not None else default_tablebases
+        self.tt = TranspositionTable(tt_size)
+        self.nodes = 0
+        self.deadline = None
+        self.node_limit = None
+
+    def search(self, game, max_depth=32, time_limit=None, max_nodes=None):
+        """Returns the best Move found within the budget (None if there are no legal moves)."""
+        started = time.perf_counter()
+        limit = self.time_limit if time_limit is None else time_limit
+        self.deadline = started + limit if limit else None
+        self.node_limit = max_nodes or self.max_nodes
+        self.nodes = 0
+        self.tt.new_search()
+
+        moves = list(game.generate_moves())
+        if not moves:
+            return SearchResult(None, 0, 0, 0, 0.0)
+        if self.tablebases is not None:
+            hit = self.tablebases.best_move(game)
+            if hit is not None:
+                move, wdl, dtm = hit
+                return SearchResult(move, _tablebase_score(wdl, dtm, 0), 0, 0, time.perf_counter() - started)
+        best = SearchResult(self.order(game, moves, None)[0], 0, 0, 0, 0.0)
+
+        for depth in range(1, max_depth + 1):
+            try:
+                move, score = self.search_root(game, moves, depth, best.move)
+            except SearchTimeout:
+                break
+            best = SearchResult(move, score, depth, self.nodes, time.perf_counter() - started)
+            if abs(score) >= MATE - max_depth:
+                break
+        return best._replace(nodes=self.nodes, elapsed=time.perf_counter() - started)
+
+    def search_root(self, game, moves, depth, previous_best):
+        alpha, beta = -INFINITY, INFINITY
+        best_move = None
+        for move in self.order(game, moves, previous_best):
+            game.make(move)
+            try:
+                score = -self.negamax(game, depth - 1, -beta, -alpha, 1)
+            finally:
+                game.unmake()
+            if score > alpha or best_move is None:
+                alpha, best_move = score, move
+        self.tt.store(game.position_hash, depth, alpha, EXACT, best_move)
+        return best_move, alpha
+
+    def check_limits(self):
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise SearchTimeout()
+        if self.node_limit is not None and self.nodes >= self.node_limit:
+            raise SearchTimeout()
+
+    def negamax(self, game, depth, alpha, beta, ply):
+        self.nodes += 1
+        if not self.nodes & 1023:
+            self.check_limits()
+        if game.winner:
+            # The side that just moved captured our King
+            return -MATE + ply
+        if self.tablebases is not None:
+            result = self.tablebases.probe(game)
+            if result is not None:
+                return _tablebase_score(result[0], result[1], ply)
+        if depth <= 0:
+            return self.quiesce(game, alpha, beta, ply)
+
+        key = game.position_hash
+        entry = self.tt.probe(key)
+        tt_move = None
+        if entry is not None:
+            tt_move = entry.move
+            if entry.depth >= depth:
+                score = _score_from_tt(entry.score, ply)
+                if entry.flag == EXACT:
+                    return score
+                if entry.flag == LOWER and score >= beta:
+                    return score
+                if entry.flag == UPPER and score <= alpha:
+                    return score
+
+        moves = list(game.generate_moves())
+        if not moves:
+            # Checkmate, or a draw by stalemate
+            return -MATE + ply if game.is_in_check() else 0
+
+        original_alpha = alpha
+        best_score, best_move = -INFINITY, None
+        for move in self.order(game, moves, tt_move):
+            game.make(move)
+            try:
+                score = -self.negamax(game, depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                game.unmake()
+            if score > best_score:
+                best_score, best_move = score, move
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+
+        if best_score <= original_alpha:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.tt.store(key, depth, _score_to_tt(best_score, ply), flag, best_move)
+        return best_score
+
+    def quiesce(self, game, alpha, beta, ply):
+        # Resolves captures and promotions so the static score isn't taken mid-exchange
+        self.nodes += 1
+        if not self.nodes & 1023:
+            self.check_limits()
+        if game.winner:
+            return -MATE + ply
+        stand_pat = evaluate(game)
+        if stand_pat >= beta:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+
+        for move in self.order(game, list(game.generate_moves(captures_only=True)), None):
+            game.make(move)
+            try:
+                score = -self.quiesce(game, -beta, -alpha, ply + 1)
+            finally:
+                game.unmake()
+            if score >= beta:
+                return score
+            alpha = max(alpha, score)
+        return alpha
+
+    def order(self, game, moves, first):
+        # Best move from the table first, then captures (most valuable victim,
+        # least valuable attacker), promotions, merges, quiet moves, disintegrations
+        masks = game.position.masks
+
+        def key(move):
+            if move == first:
+                return -10_000_000
+            if move.kind == MOVE:
+                victim = masks[move.end]
+                if victim:
+                    if victim & KING:
+                        return -5_000_000
+                    return -1_000_000 - MASK_VALUES[victim] * 16 + MASK_VALUES[masks[move.start]] // 16
+                if move.promotion:
+                    return -500_000 - COMPONENT_VALUES[_PROMOTION_BITS[move.promotion]]
+                return 0
+            if move.kind == MERGE:
+                return -100_000
+            return 100_000
+
+        return sorted(moves, key=key)
+
+
+_PROMOTION_BITS = {'Q': QUEEN, 'R': ROOK, 'B': BISHOP, 'N': KNIGHT}
+
+
+def _score_to_tt(score, ply):
+    # Mate scores are stored relative to the node, not the root
+    if score >= MATE - 1000:
+        return score + ply
+    if score <= -MATE + 1000:
+        return score - ply
+    return score
+
+
+def _score_from_tt(score, ply):
+    if score >= MATE - 1000:
+        return score - ply
+    if score <= -MATE + 1000:
+        return score + ply
+    return score
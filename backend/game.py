@@ -1,6 +1,10 @@
-import copy
+import itertools
+from collections import namedtuple
 from colorama import Fore, Style, init
 import os
+from bitboard import Position, COLOR_INDEX, KING_ATTACKS, PIECE_TYPES, TYPE_BITS, iter_bits, types_mask
+from bitboard import KNIGHT, BISHOP, ROOK, QUEEN, KING, KINGS
+from zobrist import BLACK_TO_MOVE_KEY, MAX_MERGE_LIMIT, merge_key, piece_key
 
 # Function to clear the console screen - No longer needed for the API
 # def clear_screen():
@@ -16,39 +20,113 @@ SPECIAL_PIECE_INFO = {
     'Q': {'name': 'Queen', 'moves': 'as a Rook and a Bishop'}
 }
 
+# The components each special piece needs, in order of precedence: a combined
+# piece is the first one whose components it has (R+N+B is a Grand Chancellor,
+# not a Chancellor)
+SPECIAL_PIECE_MASKS = [('G', ROOK | KNIGHT | BISHOP), ('M', QUEEN | KNIGHT), ('A', BISHOP | KNIGHT),
+                       ('C', ROOK | KNIGHT), ('Q', BISHOP | ROOK)]
+# Special piece (a SPECIAL_PIECE_INFO key) of every component mask, or None
+SPECIAL_BY_MASK = [next((symbol for symbol, special in SPECIAL_PIECE_MASKS if mask & special == special), None)
+                   for mask in range(64)]
+# Component types of every mask, in PIECE_TYPES order
+MASK_TYPES = [tuple(t for t in PIECE_TYPES if mask & TYPE_BITS[t]) for mask in range(64)]
+
+PIECE_SYMBOLS = {
+    'P': '♙', 'R': '♖', 'N': '♘', 'B': '♗', 'Q': '♕', 'K': '♔',
+    'p': '♟', 'r': '♜', 'n': '♞', 'b': '♝', 'q': '♛', 'k': '♚',
+    'A': 'A', 'C': 'C', 'M': 'M', 'G': 'G', # Archbishop, Chancellor, Amazon, Grand Chancellor
+    'a': 'a', 'c': 'c', 'm': 'm', 'g': 'g'
+}
+
+SQUARE_NAMES = [f"{chr(97 + sq % 8)}{8 - sq // 8}" for sq in range(64)]
+
+MOVE, MERGE, DISINTEGRATE = 'move', 'merge', 'disintegrate'
+PROMOTION_CHOICES = ['Q', 'R', 'B', 'N']
+
+# How a game ended (SymbioticChessGame.outcome). A King is only ever captured in
+# a position loaded with the side to move able to take it.
+CHECKMATE, STALEMATE, KING_CAPTURED = 'checkmate', 'stalemate', 'king_captured'
+IN_CHECK_ERROR = "That would leave your King in check."
+
+class Move(namedtuple('Move', ['kind', 'start', 'end', 'promotion'])):
+    """One action for the side to move. Squares are 0-63 indexes (row * 8 + col).
+
+    For a merge `end` is merged into `start`; for a disintegration the primary
+    piece moves from `start` to the empty square `end`.
+    """
+    __slots__ = ()
+
+    def __new__(cls, kind, start, end, promotion=None):
+        return super().__new__(cls, kind, start, end, promotion)
+
+    def __str__(self):
+        # Same notation as SymbioticChessGame.last_move, plus a promotion suffix
+        if self.kind == MOVE:
+            return f"{SQUARE_NAMES[self.start]}{SQUARE_NAMES[self.end]}{(self.promotion or '').lower()}"
+        return f"{self.kind} {SQUARE_NAMES[self.start]} {SQUARE_NAMES[self.end]}"
+
+    def pack(self):
+        # 16 bits: kind (move, merge, disintegrate or promotion), promotion choice, start, end
+        if self.promotion:
+            return 0xC000 | PROMOTION_CHOICES.index(self.promotion) << 12 | self.start << 6 | self.end
+        return _MOVE_KINDS.index(self.kind) << 14 | self.start << 6 | self.end
+
+    @classmethod
+    def unpack(cls, value):
+        kind = value >> 14
+        if kind == 3:
+            return cls(MOVE, value >> 6 & 63, value & 63, PROMOTION_CHOICES[value >> 12 & 3])
+        return cls(_MOVE_KINDS[kind], value >> 6 & 63, value & 63)
+
+_MOVE_KINDS = (MOVE, MERGE, DISINTEGRATE)
+
+def parse_square(square_str):
+    # Converts a single square (e.g., "e2") to board coordinates
+    if len(square_str) != 2 or square_str[0] not in 'abcdefgh' or square_str[1] not in '12345678':
+        return None
+    return 8 - int(square_str[1]), ord(square_str[0]) - 97
+
+def parse_action(action_str):
+    # Converts Move notation ("e2e4", "e7e8q", "merge a1 b1", "disintegrate c4 b5") to a Move
+    parts = action_str.strip().lower().split()
+    if len(parts) == 3 and parts[0] in (MERGE, DISINTEGRATE):
+        pos1, pos2 = parse_square(parts[1]), parse_square(parts[2])
+        if pos1 is None or pos2 is None:
+            return None
+        return Move(parts[0], pos1[0] * 8 + pos1[1], pos2[0] * 8 + pos2[1])
+    if len(parts) == 1 and len(parts[0]) in (4, 5):
+        start, end = parse_square(parts[0][:2]), parse_square(parts[0][2:4])
+        promotion = parts[0][4:].upper() or None
+        if start is None or end is None or (promotion and promotion not in PROMOTION_CHOICES):
+            return None
+        return Move(MOVE, start[0] * 8 + start[1], end[0] * 8 + end[1], promotion)
+    return None
+
+# What make() needs to restore the game: the previous occupant of every touched
+# square, the piece captured (if any), and the mover's previous merge count, last_move, winner and outcome
+Undo = namedtuple('Undo', ['move', 'squares', 'captured', 'merge_count', 'last_move', 'winner', 'outcome'])
+
 class Piece:
-    def __init__(self, piece_type, color):
+    def __init__(self, piece_type, color, combined_pieces=None):
         self.piece_type = piece_type
         self.color = color
-        self.combined_pieces = []  # Stores types of merged pieces, e.g., ['R', 'N']
+        self.combined_pieces = combined_pieces or []  # Stores types of merged pieces, e.g., ['R', 'N']
+        self.code = None  # Index in PIECES, set on the shared instances only
+        # Worked out once from the fields above. A merge, disintegration or
+        # promotion puts a different Piece on the square instead of changing this one.
+        self.combined_mask = types_mask(self.combined_pieces)
+        self.mask = self.combined_mask | TYPE_BITS[piece_type]
+        special = SPECIAL_BY_MASK[self.combined_mask]
+        self.display_info = (special, True) if special else (piece_type, False)
+        self.special_info = SPECIAL_PIECE_INFO[special] if special else None
 
     def get_display_info(self):
-        """Determines the piece's symbol for display, especially for merged pieces."""
-        if self.is_combined():
-            combined_set = set(self.combined_pieces)
-            # Order of checks is important for pieces with multiple combinations
-            if {'R', 'N', 'B'}.issubset(combined_set):
-                return 'G', True  # Grand Chancellor / Archmagister
-            if {'Q', 'N'}.issubset(combined_set):
-                return 'M', True  # Amazon
-            elif {'B', 'N'}.issubset(combined_set):
-                return 'A', True  # Archbishop
-            elif {'R', 'N'}.issubset(combined_set):
-                return 'C', True  # Chancellor
-            elif {'B', 'R'}.issubset(combined_set):
-                return 'Q', True   # Queen
-        return self.piece_type, False
+        """The piece's symbol for display and whether it is a special combined piece."""
+        return self.display_info
 
     def __str__(self):
-        # Unicode and custom characters for chess pieces
-        symbols = {
-            'P': '♙', 'R': '♖', 'N': '♘', 'B': '♗', 'Q': '♕', 'K': '♔',
-            'p': '♟', 'r': '♜', 'n': '♞', 'b': '♝', 'q': '♛', 'k': '♚',
-            'A': 'A', 'C': 'C', 'M': 'M', 'G': 'G', # Archbishop, Chancellor, Amazon, Grand Chancellor
-            'a': 'a', 'c': 'c', 'm': 'm', 'g': 'g'
-        }
-
-        display_type, is_special_combo = self.get_display_info()
+        symbols = PIECE_SYMBOLS
+        display_type, is_special_combo = self.display_info
 
         symbol_key = display_type.upper()
         if self.color == 'black':
@@ -71,18 +149,241 @@ class Piece:
     def is_combined(self):
         return len(self.combined_pieces) > 0
 
+    def types_mask(self):
+        # Union of the component bits this piece moves as
+        return self.mask
+
+def piece_code(piece):
+    """Index of the piece in PIECES: a square fits in one byte, 0 being empty."""
+    if piece.code is not None:
+        return piece.code
+    code = PIECE_CODES.get((piece.color, piece.piece_type, piece.combined_mask))
+    if code is None:
+        raise ValueError(f"Not a Symbiotic Chess piece: {piece.color} {piece.piece_type} {piece.combined_pieces}")
+    return code
+
+def _piece_table():
+    # Every piece a game can reach. combined_pieces is empty or contains piece_type,
+    # in sorted order. Kings never combine; Queens can't merge, so a Queen component
+    # (from a promotion) is never combined with a Pawn.
+    families = [set(combo) for n in range(1, 5) for combo in itertools.combinations('BNPR', n)]
+    families += [{'Q'} | set(combo) for n in range(4) for combo in itertools.combinations('BNR', n)]
+    pieces = [None]
+    for color in ('white', 'black'):
+        pieces += [Piece(piece_type, color) for piece_type in PIECE_TYPES]
+        for family in families:
+            pieces += [Piece(piece_type, color, sorted(family)) for piece_type in sorted(family)]
+    for code, piece in enumerate(pieces[1:], 1):
+        piece.code = code
+    return pieces
+
+# Shared Piece instances, indexed by code. The board only holds these, so they must never be modified.
+PIECES = _piece_table()
+PIECE_CODES = {(p.color, p.piece_type, p.combined_mask): p.code for p in PIECES[1:]}
+# Zobrist key of every piece code on every square; code 0 (empty) is 0
+SQUARE_PIECE_KEYS = [[piece_key(sq, piece) for piece in PIECES] for sq in range(64)]
+
+# Symbiotic FEN: standard FEN ranks, where a combined piece is written as its
+# component set in braces, primary type first (e.g. {RN} is a Chancellor built
+# on a Rook, {nb} a black Archbishop built on a Knight), followed by the side to
+# move, White's and Black's remaining merges, and the merge limit.
+START_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w 3 3 3'
+
+def _fen_token(piece):
+    letters = piece.piece_type + ''.join(t for t in piece.combined_pieces if t != piece.piece_type)
+    token = f"{{{letters}}}" if piece.combined_pieces else letters
+    return token if piece.color == 'white' else token.lower()
+
+PIECE_FEN = [None] + [_fen_token(p) for p in PIECES[1:]]
+FEN_CODES = {token: code for code, token in enumerate(PIECE_FEN) if token}
+
+def parse_fen_board(board_fen):
+    """Returns the 64 piece codes of a FEN board field, or raises ValueError."""
+    ranks = board_fen.split('/')
+    if len(ranks) != 8:
+        raise ValueError(f"Expected 8 ranks, got {len(ranks)}")
+    codes = bytearray()
+    for rank in ranks:
+        start, i = len(codes), 0
+        while i < len(rank):
+            char = rank[i]
+            if char.isdigit():
+                codes += bytes(int(char))
+                i += 1
+                continue
+            if char == '{':
+                end = rank.find('}', i)
+                if end < 0:
+                    raise ValueError(f"Unclosed piece in rank {rank!r}")
+                letters = rank[i + 1:end]
+                # Components after the primary may come in any order
+                token = '{' + letters[:1] + ''.join(sorted(letters[1:])) + '}'
+                i = end + 1
+            else:
+                token = char
+                i += 1
+            code = FEN_CODES.get(token)
+            if code is None:
+                raise ValueError(f"Unknown piece {token!r}")
+            codes.append(code)
+        if len(codes) - start != 8:
+            raise ValueError(f"Rank {rank!r} does not have 8 squares")
+    return codes
+
+# Versions come from one process-wide counter, so they never repeat across games or resets
+_versions = itertools.count(1)
+
+_terminal_ready = False
+
+def init_terminal():
+    # colorama wraps sys.stdout/sys.stderr again on every init() call, which
+    # nests deeper with each new game, so only do it once per process
+    global _terminal_ready
+    if not _terminal_ready:
+        init(autoreset=True)
+        _terminal_ready = True
+
 # Manages the board and game logic
 class SymbioticChessGame:
-    def __init__(self):
+    def __init__(self, headless=False):
+        # A headless game never touches the terminal: promotions default to a
+        # Queen instead of prompting, and game over is reported, not exit()ed
+        self.headless = headless
+        # Bumped by every change to the game; square_versions and captured_version
+        # record when each square and the captured lists last changed
+        self.version = next(_versions)
+        self.square_versions = [self.version] * 64
+        self.captured_version = self.version
         self.board = self.setup_board()
         self.current_turn = 'white'
         self.merge_count = {'white': 0, 'black': 0}
-        self.max_merges = 3 # Setting a limit for merges per player
+        self._max_merges = 3 # Setting a limit for merges per player
         self.last_move = None
         self.captured_pieces = {'white': [], 'black': []}
-        self.status_message = ""
-        self.last_merge_info = None
-        init(autoreset=True)
+        self._status_message = ""
+        self._last_merge_info = None
+        self.winner = None
+        self.outcome = None  # CHECKMATE, STALEMATE or KING_CAPTURED once the game is over
+        self.history = []  # Undo records, one per action applied with make()
+        self.start_fen = None  # The position the history starts from, if not the standard one
+        # Bitboards are what move validation runs on; self.board stays as the
+        # Piece-level view used for display and serialization.
+        self.position = Position()
+        # Piece code of every square (see PIECES), the compact form of self.board
+        self.codes = bytearray(64)
+        # 64-bit Zobrist hash of the board, side to move and remaining merges,
+        # kept up to date by sync_square, switch_turn and set_merge_count
+        self.position_hash = 0
+        self.square_keys = [0] * 64
+        self.sync_position()
+        if not headless:
+            init_terminal()
+
+    @classmethod
+    def from_fen(cls, fen, headless=False):
+        game = cls(headless)
+        game.load_fen(fen)
+        return game
+
+    def load_fen(self, fen):
+        """Replaces the whole game with the position in a Symbiotic FEN string.
+
+        The side to move, merges and limit are optional and default to White,
+        a limit of 3 and no merges made. History, captured pieces and the last
+        move are cleared. Raises ValueError for an invalid FEN.
+        """
+        fields = fen.split()
+        if not 1 <= len(fields) <= 5:
+            raise ValueError("Expected 1 to 5 FEN fields")
+        codes = parse_fen_board(fields[0])
+        if len(fields) > 1 and fields[1] not in ('w', 'b'):
+            raise ValueError(f"Side to move must be 'w' or 'b', not {fields[1]!r}")
+        max_merges = int(fields[4]) if len(fields) > 4 else 3
+        white_left = int(fields[2]) if len(fields) > 2 else max_merges
+        black_left = int(fields[3]) if len(fields) > 3 else max_merges
+        if not 0 <= max_merges <= MAX_MERGE_LIMIT:
+            raise ValueError(f"The merge limit must be between 0 and {MAX_MERGE_LIMIT}")
+        if not (0 <= white_left <= max_merges and 0 <= black_left <= max_merges):
+            raise ValueError("Remaining merges must be between 0 and the merge limit")
+
+        current_turn = 'black' if len(fields) > 1 and fields[1] == 'b' else 'white'
+        self.set_position(codes, current_turn, white_left, black_left, max_merges)
+        self.update_outcome()
+        self.start_fen = self.to_fen()
+
+    def set_position(self, codes, current_turn, white_left, black_left, max_merges):
+        """Replaces the whole game with 64 piece codes (see PIECES), the side to move
+        and each side's remaining merges. Unlike load_fen, nothing is validated and
+        the game isn't checked for being over.
+        """
+        self.board = [[PIECES[code] for code in codes[row * 8:row * 8 + 8]] for row in range(8)]
+        self.current_turn = current_turn
+        self._max_merges = max_merges
+        self.merge_count = {'white': max_merges - white_left, 'black': max_merges - black_left}
+        self.last_move = None
+        self.captured_pieces = {'white': [], 'black': []}
+        self._status_message = ""
+        self._last_merge_info = None
+        self.winner = None
+        self.outcome = None
+        self.history = []
+        self.sync_position()
+        self.captured_version = self.version
+
+    def to_fen(self):
+        codes = self.codes
+        ranks = []
+        for row in range(0, 64, 8):
+            rank, empty = '', 0
+            for code in codes[row:row + 8]:
+                if code:
+                    if empty:
+                        rank += str(empty)
+                        empty = 0
+                    rank += PIECE_FEN[code]
+                else:
+                    empty += 1
+            ranks.append(rank + str(empty) if empty else rank)
+        white_left = max(0, self.max_merges - self.merge_count['white'])
+        black_left = max(0, self.max_merges - self.merge_count['black'])
+        return f"{'/'.join(ranks)} {self.current_turn[0]} {white_left} {black_left} {self.max_merges}"
+
+    @property
+    def max_merges(self):
+        return self._max_merges
+
+    @max_merges.setter
+    def max_merges(self, value):
+        # The remaining merge budget is part of the position hash
+        self.position_hash ^= self.budget_hash()
+        self._max_merges = value
+        self.position_hash ^= self.budget_hash()
+        self.touch()
+
+    @property
+    def status_message(self):
+        return self._status_message
+
+    @status_message.setter
+    def status_message(self, value):
+        self._status_message = value
+        self.touch()
+
+    @property
+    def last_merge_info(self):
+        return self._last_merge_info
+
+    @last_merge_info.setter
+    def last_merge_info(self, value):
+        self._last_merge_info = value
+        self.touch()
+
+    def touch(self):
+        self.version = next(_versions)
+
+    def changed_since(self, version):
+        # Squares (0-63) that changed after `version`
+        return [sq for sq in range(64) if self.square_versions[sq] > version]
 
     def setup_board(self):
         # Creates the initial board setup
@@ -106,6 +407,62 @@ class SymbioticChessGame:
                 board[pawn_row][i] = Piece('P', color)
         return board
 
+    def sync_position(self):
+        # Rebuilds the bitboards and position_hash from self.board, current_turn and
+        # merge_count, e.g. after editing them directly
+        self.position.clear()
+        self.square_keys = [0] * 64
+        self.codes[:] = bytes(64)
+        self.position_hash = self.budget_hash()
+        self.touch()
+        self.square_versions = [self.version] * 64
+        for row in range(8):
+            for col in range(8):
+                if self.board[row][col] is not None:
+                    self.sync_square(row, col)
+
+    def sync_square(self, row, col):
+        sq = row * 8 + col
+        piece = self.board[row][col]
+        if piece is None:
+            self.position.remove(sq)
+            code = 0
+        else:
+            code = piece_code(piece)
+            piece = self.board[row][col] = PIECES[code]
+            self.position.place(sq, COLOR_INDEX[piece.color], piece.mask)
+        self.codes[sq] = code
+        key = SQUARE_PIECE_KEYS[sq][code]
+        self.position_hash ^= self.square_keys[sq] ^ key
+        self.square_keys[sq] = key
+        self.touch()
+        self.square_versions[sq] = self.version
+
+    def budget_hash(self):
+        # Hash of the side to move and both sides' remaining merges
+        key = merge_key('white', self.max_merges - self.merge_count['white']) ^ \
+              merge_key('black', self.max_merges - self.merge_count['black'])
+        if self.current_turn == 'black':
+            key ^= BLACK_TO_MOVE_KEY
+        return key
+
+    def compute_hash(self):
+        # Full recomputation of position_hash, for checking the incremental one
+        key = self.budget_hash()
+        for sq in range(64):
+            key ^= piece_key(sq, self.board[sq >> 3][sq & 7])
+        return key
+
+    def set_merge_count(self, color, count):
+        self.position_hash ^= merge_key(color, self.max_merges - self.merge_count[color]) ^ \
+                              merge_key(color, self.max_merges - count)
+        self.merge_count[color] = count
+        self.touch()
+
+    def set_piece(self, row, col, piece):
+        self.board[row][col] = piece
+        self.sync_square(row, col)
+
     def print_board(self):
         print("  a  b  c  d  e  f  g  h")
         print(" +------------------------+")
@@ -133,12 +490,112 @@ class SymbioticChessGame:
         except (ValueError, KeyError, IndexError):
             return None, None
 
+    def parse_action(self, action_str):
+        return parse_action(action_str)
+
+    def parse_square(self, square_str):
+        return parse_square(square_str)
+
     def is_valid_move(self, start_pos, end_pos):
         # Basic validation (to be expanded for full chess rules)
         if not (0 <= start_pos[0] < 8 and 0 <= start_pos[1] < 8 and
                 0 <= end_pos[0] < 8 and 0 <= end_pos[1] < 8):
             return False
         
+        start = start_pos[0] * 8 + start_pos[1]
+        color = self.position.colors[start]
+        if color is None or color != COLOR_INDEX[self.current_turn]:
+            return False
+
+        # One lookup against the union of the moves of every combined piece type
+        end = end_pos[0] * 8 + end_pos[1]
+        return self.position.can_move(start, end, color, self.position.masks[start]) and \
+            self.king_safe_after(MOVE, start, end)
+
+    def move_error(self, start_pos, end_pos):
+        # Returns why moving from start_pos to end_pos is not allowed, or None
+        if self.outcome:
+            return "The game is over."
+        if self.is_valid_move(start_pos, end_pos):
+            return None
+        if not all(0 <= i < 8 for i in (*start_pos, *end_pos)):
+            return "Invalid move."  # parse_move takes ranks 0 and 9
+        start, end = start_pos[0] * 8 + start_pos[1], end_pos[0] * 8 + end_pos[1]
+        position = self.position
+        if position.colors[start] == COLOR_INDEX[self.current_turn] and \
+           position.can_move(start, end, position.colors[start], position.masks[start]):
+            return IN_CHECK_ERROR
+        return "Invalid move."
+
+    def is_in_check(self, color=None):
+        """Whether a King of `color` (default: the side to move) is attacked."""
+        color = COLOR_INDEX[color or self.current_turn]
+        position = self.position
+        for king in iter_bits(position.pieces[color][KINGS]):
+            if position.attackers(king, color ^ 1):
+                return True
+        return False
+
+    def king_safe_after(self, kind, start, end):
+        """Whether the side to move's King would be safe after the action, without playing it.
+
+        Only the occupancy changes: a move empties `start` and fills `end`
+        (removing what it captures), a merge empties `end`, and a disintegration
+        fills `end`. Kings never merge, so only a move can move one.
+        """
+        position = self.position
+        color = COLOR_INDEX[self.current_turn]
+        kings = position.pieces[color][KINGS]
+        if not kings:
+            return True
+        occupied = position.occupied[0] | position.occupied[1]
+        captured = 0
+        if kind == MOVE:
+            occupied = occupied & ~(1 << start) | 1 << end
+            captured = position.occupied[color ^ 1] & 1 << end
+            if kings >> start & 1:
+                kings ^= 1 << start | 1 << end
+        elif kind == MERGE:
+            occupied &= ~(1 << end)
+        else:
+            occupied |= 1 << end
+        for king in iter_bits(kings):
+            if position.attackers(king, color ^ 1, occupied, captured):
+                return False
+        return True
+
+    def king_safe_by_rules(self, move):
+        # Square-by-square reference for king_safe_after: plays the move, then
+        # asks whether any enemy piece could move onto one of the mover's Kings
+        color = self.current_turn
+        self.make(move if move.kind != MOVE or not self.reaches_last_row(move) else move._replace(promotion='Q'))
+        try:
+            kings = [(row, col) for row in range(8) for col in range(8)
+                     if self.board[row][col] and self.board[row][col].color == color and
+                     'K' in [self.board[row][col].piece_type] + self.board[row][col].combined_pieces]
+            return not any(self.reaches_by_rules((row, col), king)
+                           for row in range(8) for col in range(8) for king in kings)
+        finally:
+            self.unmake()
+
+    def reaches_last_row(self, move):
+        piece = self.board[move.start >> 3][move.start & 7]
+        return piece.piece_type == 'P' and move.end >> 3 == (0 if piece.color == 'white' else 7)
+
+    def is_valid_move_by_rules(self, start_pos, end_pos):
+        # Square-by-square reference implementation of is_valid_move, kept to
+        # cross-check the bitboard move generator
+        if not self.reaches_by_rules(start_pos, end_pos):
+            return False
+        return self.king_safe_by_rules(Move(MOVE, start_pos[0] * 8 + start_pos[1], end_pos[0] * 8 + end_pos[1]))
+
+    def reaches_by_rules(self, start_pos, end_pos):
+        # Whether the side to move's piece on start_pos moves as far as end_pos,
+        # ignoring the safety of its own King
+        if not (0 <= start_pos[0] < 8 and 0 <= start_pos[1] < 8 and
+                0 <= end_pos[0] < 8 and 0 <= end_pos[1] < 8):
+            return False
+        
         piece = self.board[start_pos[0]][start_pos[1]]
         if not piece or piece.color != self.current_turn:
             return False
@@ -148,11 +605,9 @@ class SymbioticChessGame:
             return False # Cannot capture your own piece
             
         # Check movement rules for all combined piece types
-        all_possible_types = list(set([piece.piece_type] + piece.combined_pieces))
-        
-        for piece_type in all_possible_types:
-            temp_piece = Piece(piece_type, piece.color) 
-            if self.is_valid_piece_move(temp_piece, start_pos, end_pos):
+        for piece_type in MASK_TYPES[piece.mask]:
+            plain_piece = PIECES[PIECE_CODES[piece.color, piece_type, 0]]
+            if self.is_valid_piece_move(plain_piece, start_pos, end_pos):
                 return True
                 
         return False
@@ -274,13 +729,17 @@ class SymbioticChessGame:
                 print(f"{Fore.YELLOW}{self.status_message}{Style.RESET_ALL}")
                 self.status_message = ""  # Clear the message after displaying it
 
-            print("Enter move, 'merge [pos1] [pos2]', 'disintegrate [pos] [target]', or 'quit'.")
+            print("Enter move, 'merge [pos1] [pos2]', 'disintegrate [pos] [target]', 'undo', or 'quit'.")
             
             action = input(f"{Fore.CYAN}> {Style.RESET_ALL}").strip()
             
             if action.lower() == 'quit':
                 print("Game ended.")
                 break
+
+            if action.lower() == 'undo':
+                self.attempt_undo()
+                continue
                 
             if action.lower().startswith('merge'):
                 try:
@@ -312,35 +771,50 @@ class SymbioticChessGame:
 
             if self.is_valid_move(start_pos, end_pos):
                 self.move_piece(start_pos, end_pos)
-                self.switch_turn()
             else:
                 self.status_message = "Invalid move."
 
-    def move_piece(self, start_pos, end_pos):
+    def move_piece(self, start_pos, end_pos, promotion=None):
+        # Returns the winner if this move captured the King, otherwise None
         self.last_merge_info = None
-        piece_to_move = self.board[start_pos[0]][start_pos[1]]
-        
-        # Basic check for game over
-        target_piece = self.board[end_pos[0]][end_pos[1]]
-        if target_piece:
-            self.captured_pieces[self.current_turn].append(target_piece)
-            
-        if target_piece and (target_piece.piece_type == 'K' or 'K' in target_piece.combined_pieces):
-             print(f"\nGame Over! {self.current_turn.capitalize()} wins by capturing the King!")
-             exit()
+        self.make(Move(MOVE, start_pos[0] * 8 + start_pos[1], end_pos[0] * 8 + end_pos[1], promotion))
+        self.end_of_action(MOVE)
+        return self.winner
 
-        self.board[end_pos[0]][end_pos[1]] = piece_to_move
-        self.board[start_pos[0]][start_pos[1]] = None
-        
-        # Format the last move string
-        from_str = f"{chr(97+start_pos[1])}{8-start_pos[0]}"
-        to_str = f"{chr(97+end_pos[1])}{8-end_pos[0]}"
-        self.last_move = f"{from_str}{to_str}"
-        
-        # Check for pawn promotion
-        self.check_pawn_promotion(end_pos)
-        
-    def check_pawn_promotion(self, pos):
+    def update_outcome(self):
+        """Ends the game when the side to move has no legal action: checkmate if
+        it is in check, stalemate otherwise.
+
+        make() leaves this out because searches call it for every node; the
+        player-facing actions call it through end_of_action.
+        """
+        if self.outcome or next(self.generate_moves(), None) is not None:
+            return self.outcome
+        if self.is_in_check():
+            self.winner = 'black' if self.current_turn == 'white' else 'white'
+            self.outcome = CHECKMATE
+        else:
+            self.outcome = STALEMATE
+        self.touch()
+        return self.outcome
+
+    def end_of_action(self, kind):
+        # After a player's action: end the game if it's over, or announce check
+        self.update_outcome()
+        if self.outcome == KING_CAPTURED:
+            self.status_message = f"Game Over! {self.winner.capitalize()} wins by capturing the King!"
+        elif self.outcome == CHECKMATE:
+            self.status_message = f"Checkmate! {self.winner.capitalize()} wins."
+        elif self.outcome == STALEMATE:
+            self.status_message = f"Stalemate! {self.current_turn.capitalize()} has no legal action. The game is a draw."
+        elif self.is_in_check():
+            self.status_message = "Check!" if kind == MOVE else f"{self.status_message} Check!"
+        if self.outcome and not self.headless:
+            print(f"\n{self.status_message}")
+            exit()
+
+    def check_pawn_promotion(self, pos, promotion_choice=None):
+        # Replaces a pawn that reached the last rank; asks the player when no choice is given
         row, col = pos
         piece = self.board[row][col]
         
@@ -348,138 +822,309 @@ class SymbioticChessGame:
             if (piece.color == 'white' and row == 0) or \
                (piece.color == 'black' and row == 7):
                 
-                while True:
+                if promotion_choice is None and self.headless:
+                    promotion_choice = 'Q'
+                ask = promotion_choice is None
+                while ask:
                     promotion_choice = input("Promote pawn to (Q, R, B, N): ").upper()
-                    if promotion_choice in ['Q', 'R', 'B', 'N']:
-                        piece.piece_type = promotion_choice
-                        # If the pawn was part of a combined piece, remove the 'P'
-                        if 'P' in piece.combined_pieces:
-                            piece.combined_pieces.remove('P')
-                        # Add the new piece type to the combined list for consistency
-                        if promotion_choice not in piece.combined_pieces:
-                             piece.combined_pieces.append(promotion_choice)
-                        print(f"Pawn promoted to {promotion_choice}.")
+                    if promotion_choice in PROMOTION_CHOICES:
                         break
                     else:
                         print("Invalid choice. Please enter Q, R, B, or N.")
 
-    def attempt_merge(self, pos1, pos2):
+                # If the pawn was part of a combined piece, remove the 'P'
+                combined_pieces = [p for p in piece.combined_pieces if p != 'P']
+                # Add the new piece type to the combined list for consistency,
+                # kept sorted like the lists merges produce
+                if promotion_choice not in combined_pieces:
+                    combined_pieces = sorted(combined_pieces + [promotion_choice])
+                self.set_piece(row, col, Piece(promotion_choice, piece.color, combined_pieces))
+                if ask:
+                    print(f"Pawn promoted to {promotion_choice}.")
+                return promotion_choice
+        return None
+
+    def merge_error(self, pos1, pos2):
+        # Returns why merging the piece on pos2 into the piece on pos1 is not allowed, or None
+        if self.outcome:
+            return "The game is over."
         if self.merge_count[self.current_turn] >= self.max_merges:
-            self.status_message = f"Merge limit reached for {self.current_turn}."
-            return
+            return f"Merge limit reached for {self.current_turn}."
+
+        piece1 = self.board[pos1[0]][pos1[1]]
+        piece2 = self.board[pos2[0]][pos2[1]]
 
-        p1_row, p1_col = pos1
-        p2_row, p2_col = pos2
-        
-        piece1 = self.board[p1_row][p1_col]
-        piece2 = self.board[p2_row][p2_col]
-        
-        # Validation checks for merge
         if not piece1 or not piece2:
-            self.status_message = "One of the squares is empty."
-            return
+            return "One of the squares is empty."
         if piece1.color != self.current_turn or piece2.color != self.current_turn:
-            self.status_message = "You can only merge your own pieces."
-            return
+            return "You can only merge your own pieces."
         if piece1.piece_type == 'K' or piece2.piece_type == 'K' or \
            'K' in piece1.combined_pieces or 'K' in piece2.combined_pieces:
-            self.status_message = "The King cannot be merged."
-            return
+            return "The King cannot be merged."
         if piece1.piece_type == 'Q' or piece2.piece_type == 'Q' or \
            'Q' in piece1.combined_pieces or 'Q' in piece2.combined_pieces:
-            self.status_message = "The Queen cannot be merged."
-            return
+            return "The Queen cannot be merged."
         if piece1.piece_type == piece2.piece_type:
-            self.status_message = "Cannot merge two pieces of the same type."
-            return
-        if abs(p1_row - p2_row) > 1 or abs(p1_col - p2_col) > 1:
-            self.status_message = "Pieces must be adjacent to merge."
+            return "Cannot merge two pieces of the same type."
+        if abs(pos1[0] - pos2[0]) > 1 or abs(pos1[1] - pos2[1]) > 1:
+            return "Pieces must be adjacent to merge."
+        if not self.king_safe_after(MERGE, pos1[0] * 8 + pos1[1], pos2[0] * 8 + pos2[1]):
+            return IN_CHECK_ERROR
+        return None
+
+    def disintegrate_error(self, pos, target_pos):
+        # Returns why the piece on pos cannot split towards target_pos, or None
+        if self.outcome:
+            return "The game is over."
+        piece = self.board[pos[0]][pos[1]]
+
+        if not piece or not piece.is_combined():
+            return "There is no combined piece at this position."
+        if piece.color != self.current_turn:
+            return "You can only disintegrate your own pieces."
+        if abs(pos[0] - target_pos[0]) > 1 or abs(pos[1] - target_pos[1]) > 1:
+            return "Target square must be adjacent."
+        if self.board[target_pos[0]][target_pos[1]] is not None:
+            return "Target square must be empty."
+        if not self.king_safe_after(DISINTEGRATE, pos[0] * 8 + pos[1], target_pos[0] * 8 + target_pos[1]):
+            return IN_CHECK_ERROR
+        return None
+
+    def action_error(self, move):
+        # Returns why a Move can't be played now, or None
+        start_pos = (move.start >> 3, move.start & 7)
+        end_pos = (move.end >> 3, move.end & 7)
+        if move.kind == MERGE:
+            return self.merge_error(start_pos, end_pos)
+        if move.kind == DISINTEGRATE:
+            return self.disintegrate_error(start_pos, end_pos)
+        error = self.move_error(start_pos, end_pos)
+        if error:
+            return error
+        if move.promotion:
+            piece = self.board[start_pos[0]][start_pos[1]]
+            if piece.piece_type != 'P' or end_pos[0] != (0 if piece.color == 'white' else 7):
+                return "Only a pawn reaching the last rank can be promoted."
+        return None
+
+    def attempt_merge(self, pos1, pos2):
+        error = self.merge_error(pos1, pos2)
+        if error:
+            self.status_message = error
             return
+
+        p1_row, p1_col = pos1
+        p2_row, p2_col = pos2
+        
+        piece1 = self.board[p1_row][p1_col]
+        piece2 = self.board[p2_row][p2_col]
         
         # Perform the merge
         # piece2 is merged into piece1
         self.status_message = f"Merging {piece2.piece_type} into {piece1.piece_type} at {chr(97+p1_col)}{8-p1_row}"
+        self.make(Move(MERGE, p1_row * 8 + p1_col, p2_row * 8 + p2_col))
 
-        # The new piece keeps the primary piece type for display
-        # but gains the abilities of the other
-        new_combined_list = sorted(list(set([piece1.piece_type] + piece1.combined_pieces + \
-                                            [piece2.piece_type] + piece2.combined_pieces)))
-
-        piece1.combined_pieces = new_combined_list
-        
         # For simplicity, we keep the original piece type, but you could create new ones
         # e.g., if 'R' and 'N' merge, the piece_type could become 'C' (Chancellor)
-        display_type, is_special_combo = piece1.get_display_info()
-        if is_special_combo:
-            info = SPECIAL_PIECE_INFO.get(display_type)
-            if info:
-                self.last_merge_info = f"Created a {info['name']}! It moves {info['moves']}."
-            else:
-                self.last_merge_info = None
+        info = self.board[p1_row][p1_col].special_info
+        if info:
+            self.last_merge_info = f"Created a {info['name']}! It moves {info['moves']}."
         else:
             self.last_merge_info = None
-
-        self.board[p2_row][p2_col] = None # Remove the second piece
-        self.merge_count[self.current_turn] += 1
-        
-        from_str = f"{chr(97+p1_col)}{8-p1_row}"
-        to_str = f"{chr(97+p2_col)}{8-p2_row}"
-        self.last_move = f"merge {from_str} {to_str}"
-        
-        self.switch_turn()
+        self.end_of_action(MERGE)
 
     def attempt_disintegrate(self, pos, target_pos):
         self.last_merge_info = None
+        error = self.disintegrate_error(pos, target_pos)
+        if error:
+            self.status_message = error
+            return
+
         pos_row, pos_col = pos
         piece = self.board[pos_row][pos_col]
 
-        # Validation for disintegration
-        if not piece or not piece.is_combined():
-            self.status_message = "There is no combined piece at this position."
-            return
-        if piece.color != self.current_turn:
-            self.status_message = "You can only disintegrate your own pieces."
-            return
-        if abs(pos_row - target_pos[0]) > 1 or abs(pos_col - target_pos[1]) > 1:
-            self.status_message = "Target square must be adjacent."
-            return
-        if self.board[target_pos[0]][target_pos[1]] is not None:
-            self.status_message = "Target square must be empty."
+        # Perform disintegration
+        self.make(Move(DISINTEGRATE, pos_row * 8 + pos_col, target_pos[0] * 8 + target_pos[1]))
+
+        primary = self.board[target_pos[0]][target_pos[1]]
+        secondary = self.board[pos_row][pos_col]
+        self.status_message = f"Disintegrated into {primary.piece_type} and {secondary.piece_type}."
+        self.end_of_action(DISINTEGRATE)
+
+    def apply_move(self, move):
+        # Plays a Move from generate_moves through the same path as player input;
+        # returns the winner once the game is over
+        start_pos = (move.start >> 3, move.start & 7)
+        end_pos = (move.end >> 3, move.end & 7)
+        if move.kind == MOVE:
+            return self.move_piece(start_pos, end_pos, move.promotion)
+        elif move.kind == MERGE:
+            self.attempt_merge(start_pos, end_pos)
+        else:
+            self.attempt_disintegrate(start_pos, end_pos)
+        return self.winner
+
+    def attempt_undo(self):
+        if not self.history:
+            self.status_message = "Nothing to undo."
             return
+        self.last_merge_info = None
+        move = self.unmake()
+        self.status_message = f"Took back {move}."
 
-        # Perform disintegration
-        primary_piece_type = piece.piece_type
-        
-        # The last piece added to the combined_pieces list is the one that's split off
-        secondary_piece_type = piece.combined_pieces.pop(-1)
+    def merged_piece(self, piece1, piece2):
+        # The new piece keeps the primary piece type for display
+        # but gains the abilities of the other
+        new_combined_list = sorted(list(set([piece1.piece_type] + piece1.combined_pieces + \
+                                            [piece2.piece_type] + piece2.combined_pieces)))
+        return Piece(piece1.piece_type, piece1.color, new_combined_list)
+
+    def disintegrated_pieces(self, piece):
+        # Returns the (primary, secondary) pieces a combined piece splits into
+        piece_type = piece.piece_type
+
+        # The last type in combined_pieces (which is kept sorted) is the one that's split off
+        secondary_piece_type = piece.combined_pieces[-1]
 
         # If the primary piece's own type was in the combined list, it should remain
         # The new combined list for the primary piece is everything minus the secondary piece type
-        new_combined_list = [p for p in piece.combined_pieces if p != secondary_piece_type]
+        new_combined_list = [p for p in piece.combined_pieces[:-1] if p != secondary_piece_type]
 
         # After splitting, if only one piece type is left in the list, it means it's no longer a combined piece
         if len(new_combined_list) == 1:
-            piece.piece_type = new_combined_list[0]
-            piece.combined_pieces = []
-        elif len(new_combined_list) == 0: # This case handles splitting a piece with only two components
-            # The piece keeps its original type, and the combined list is now empty.
-            piece.combined_pieces = []
-        else:
+            piece_type = new_combined_list[0]
+            new_combined_list = []
+        elif len(new_combined_list) > 1:
             # If there are still multiple pieces combined, we need to update the primary piece type
             # A simple approach is to set it to the first type in the new list.
-            piece.piece_type = new_combined_list[0]
-            piece.combined_pieces = new_combined_list
+            piece_type = new_combined_list[0]
+        # With nothing left the piece keeps its original type and is no longer combined
+
+        return Piece(piece_type, piece.color, new_combined_list), Piece(secondary_piece_type, piece.color)
+
+    def make(self, move):
+        """Applies a Move for the side to move without validating it, and records how to undo it."""
+        kind, start, end, promotion = move
+        board = self.board
+        color = self.current_turn
+        piece = board[start >> 3][start & 7]
+        target = board[end >> 3][end & 7]
+        captured = target if kind == MOVE else None
+        self.history.append(Undo(move, ((start, piece), (end, target)), captured,
+                                 self.merge_count[color], self.last_move, self.winner, self.outcome))
+
+        if kind == MOVE:
+            if captured:
+                self.captured_pieces[color].append(captured)
+                self.touch()
+                self.captured_version = self.version
+                if target.piece_type == 'K' or 'K' in target.combined_pieces:
+                    self.winner = color
+                    self.outcome = KING_CAPTURED
+            self.set_piece(end >> 3, end & 7, piece)
+            self.set_piece(start >> 3, start & 7, None)
+            self.last_move = f"{SQUARE_NAMES[start]}{SQUARE_NAMES[end]}"
+            choice = self.check_pawn_promotion((end >> 3, end & 7), promotion)
+            if choice != promotion:
+                # Keep the choice made at the prompt, so the recorded move replays as played
+                self.history[-1] = self.history[-1]._replace(move=move._replace(promotion=choice))
+        elif kind == MERGE:
+            self.set_piece(start >> 3, start & 7, self.merged_piece(piece, target))
+            self.set_piece(end >> 3, end & 7, None) # Remove the second piece
+            self.set_merge_count(color, self.merge_count[color] + 1)
+            self.last_move = str(move)
+        else:
+            # The primary piece moves to the target square
+            primary, secondary = self.disintegrated_pieces(piece)
+            self.set_piece(end >> 3, end & 7, primary)
+            self.set_piece(start >> 3, start & 7, secondary)
+            self.last_move = str(move)
 
-        # The primary piece moves to the target square
-        self.board[target_pos[0]][target_pos[1]] = piece
-        self.board[pos_row][pos_col] = Piece(secondary_piece_type, self.current_turn)
-        
-        self.status_message = f"Disintegrated into {piece.piece_type} and {secondary_piece_type}."
-        self.last_move = f"disintegrate {chr(97+pos_col)}{8-pos_row} {chr(97+target_pos[1])}{8-target_pos[0]}"
         self.switch_turn()
 
+    def unmake(self):
+        """Takes back the last action applied with make() and returns its Move."""
+        undo = self.history.pop()
+        self.switch_turn()
+        for sq, piece in undo.squares:
+            self.set_piece(sq >> 3, sq & 7, piece)
+        if undo.captured:
+            self.captured_pieces[self.current_turn].pop()
+            self.touch()
+            self.captured_version = self.version
+        self.set_merge_count(self.current_turn, undo.merge_count)
+        self.last_move = undo.last_move
+        self.winner = undo.winner
+        self.outcome = undo.outcome
+        return undo.move
+
+    def generate_moves(self, square=None, captures_only=False):
+        """Yields every legal Move for the side to move, optionally only those starting on `square` (row, col).
+
+        With captures_only, only moves that take a piece are generated (no merges or disintegrations).
+        Actions that would leave the mover's King in check are left out.
+        """
+        if self.outcome:
+            return
+        position = self.position
+        color = COLOR_INDEX[self.current_turn]
+        own = position.occupied[color]
+        if square is not None:
+            own &= 1 << (square[0] * 8 + square[1])
+        empty = ~(position.occupied[0] | position.occupied[1])
+        last_row = 0 if color == 0 else 7
+        can_merge = self.merge_count[self.current_turn] < self.max_merges
+
+        # Most actions can't expose the King: only those of the King itself, of
+        # pinned pieces, or any action while in check need king_safe_after
+        in_check, pinned = False, 0
+        for king in iter_bits(position.pieces[color][KINGS]):
+            in_check = in_check or bool(position.attackers(king, color ^ 1))
+            pinned |= position.pinned(king, color)
+        king_safe_after = self.king_safe_after
+
+        for start in iter_bits(own):
+            piece = self.board[start >> 3][start & 7]
+            mask = position.masks[start]
+
+            targets = position.targets(start, color, mask)
+            if captures_only:
+                targets &= position.occupied[color ^ 1]
+            if in_check or mask & KING or pinned >> start & 1:
+                for end in iter_bits(targets):
+                    if not king_safe_after(MOVE, start, end):
+                        targets ^= 1 << end
+            if piece.piece_type == 'P':
+                for end in iter_bits(targets):
+                    if end >> 3 == last_row:
+                        for choice in PROMOTION_CHOICES:
+                            yield Move(MOVE, start, end, choice)
+                    else:
+                        yield Move(MOVE, start, end)
+            else:
+                for end in iter_bits(targets):
+                    yield Move(MOVE, start, end)
+
+            if captures_only:
+                continue
+
+            # Merges with adjacent friendly pieces; neither may contain a King or Queen
+            if can_merge and not mask & (KING | QUEEN):
+                for other in iter_bits(KING_ATTACKS[start] & position.occupied[color]):
+                    if not position.masks[other] & (KING | QUEEN) and \
+                       self.board[other >> 3][other & 7].piece_type != piece.piece_type and \
+                       (not (in_check or pinned >> other & 1) or king_safe_after(MERGE, start, other)):
+                        yield Move(MERGE, start, other)
+
+            if piece.is_combined():
+                for end in iter_bits(KING_ATTACKS[start] & empty):
+                    if not in_check or king_safe_after(DISINTEGRATE, start, end):
+                        yield Move(DISINTEGRATE, start, end)
+
     def switch_turn(self):
         self.current_turn = 'black' if self.current_turn == 'white' else 'white'
+        self.position_hash ^= BLACK_TO_MOVE_KEY
+        self.touch()
 
 # The game loop will now be handled by the server
 # if __name__ == "__main__":
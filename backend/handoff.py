@@ -0,0 +1,93 @@
+"""Game ownership and handoff between the worker processes behind router.py.
+
+With several workers, each game lives in exactly one of them: worker_for()
+maps a game ID to its owner by rendezvous hashing, so the router and the
+workers agree without talking to each other, and changing the number of
+workers only moves the games of the workers added or removed.
+
+When a worker stops (a restart, or a new pool size) it puts every game it
+holds into a handoff store: the start FEN, if any, and the game record (two
+bytes per action, see encoding.py). The game's owner takes it over on the
+next request for it and logs it to its own action log. SQLiteHandoff is one
+SQLite file shared by every worker on the host; MemoryHandoff is the same
+interface on a dict, a stand-in for tests that run the workers in one process.
+"""
+import hashlib
+import sqlite3
+import threading
+from functools import lru_cache
+
+from encoding import decode_moves, encode_moves
+
+
+@lru_cache(maxsize=1 << 16)
+def worker_for(game_id, workers):
+    """Index of the worker that owns game_id, out of `workers`."""
+    # The worker with the highest hash of (index, game ID) wins; the hash is
+    # fixed, unlike hash(), so every process gets the same answer
+    return max(range(workers),
+               key=lambda i: hashlib.blake2b(f"{i}:{game_id}".encode(), digest_size=8).digest())
+
+
+class SQLiteHandoff:
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.lock = threading.Lock()
+        # Workers write at startup and shutdown, often together; they wait up to `timeout` for each other
+        self.connection = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS games (game_id TEXT PRIMARY KEY, fen TEXT, record BLOB NOT NULL)')
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM games').fetchone()[0]
+
+    def get(self, game_id):
+        """(start FEN or None, [Move, ...]) of a handed-off game, or None."""
+        with self.lock:
+            row = self.connection.execute('SELECT fen, record FROM games WHERE game_id = ?', (game_id,)).fetchone()
+        if row is None:
+            return None
+        return row[0], decode_moves(row[1])
+
+    def put(self, games):
+        # {game_id: (start FEN or None, [Move, ...])}, in one transaction
+        rows = [(game_id, fen, encode_moves(moves)) for game_id, (fen, moves) in games.items()]
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO games VALUES (?, ?, ?)', rows)
+
+    def remove(self, game_ids):
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM games WHERE game_id = ?', [(g,) for g in game_ids])
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class MemoryHandoff:
+    def __init__(self):
+        self.games = {}  # game_id -> (start FEN or None, bytes game record)
+
+    def __len__(self):
+        return len(self.games)
+
+    def get(self, game_id):
+        entry = self.games.get(game_id)
+        if entry is None:
+            return None
+        return entry[0], decode_moves(entry[1])
+
+    def put(self, games):
+        for game_id, (fen, moves) in games.items():
+            # Encoded like the SQLite store, so both hand back fresh Moves
+            self.games[game_id] = (fen, encode_moves(moves))
+
+    def remove(self, game_ids):
+        for game_id in game_ids:
+            self.games.pop(game_id, None)
+
+    def close(self):
+        pass
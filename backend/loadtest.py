@@ -0,0 +1,339 @@
+"""Load generator for the game API: virtual players on localhost.
+
+Players are paired into games, one per color. Like frontend/app.js, a player
+fetches /state?since=<version>, and on its turn fetches /legal_moves and plays a
+random legal move, merge or disintegration, then fetches /state again. Off turn
+it polls /state every --poll seconds. Finished games are reset.
+
+    python loadtest.py --players 20 --duration 30            # Flask app in-process (test client)
+    python loadtest.py --target asgi --players 100           # ASGI app in-process (TestClient)
+    python loadtest.py --spawn asgi --players 100            # start asgi.py and drive it over HTTP
+    python loadtest.py --spawn router --players 400          # the same with router.py and a worker per core
+    python loadtest.py --target http://127.0.0.1:5000 --server-pid 1234
+
+Reports requests/s and p50/p95/p99 latency per endpoint, and the growth of the
+server's resident memory (the load generator's own process when the app runs
+in-process). In-process and spawned servers keep their games in a temporary
+data directory. Use --json to save the numbers for before/after comparisons.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+SPAWN_SCRIPTS = {'asgi': 'asgi.py', 'flask': 'server.py', 'router': 'router.py'}
+SPAWN_URL = 'http://127.0.0.1:5000'
+
+
+class HTTPClient:
+    """One keep-alive connection to a running server."""
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        self.prefix = parts.path.rstrip('/')
+
+    def request(self, method, path, body=None):
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        data = json.dumps(body) if body is not None else None
+        try:
+            self.connection.request(method, self.prefix + path, data, headers)
+            response = self.connection.getresponse()
+            payload = response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()  # Reconnects on the next request
+            raise
+        return response.status, json.loads(payload) if payload else None
+
+
+class FlaskClient:
+    def __init__(self):
+        import server
+        self.client = server.app.test_client()
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, json=body)
+        return response.status_code, response.get_json(silent=True)
+
+
+class ASGIClient:
+    # One TestClient (one event loop) shared by every player thread
+    _client = None
+
+    def __init__(self):
+        self.client = ASGIClient._client
+
+    @classmethod
+    def start(cls):
+        import asgi
+        from starlette.testclient import TestClient
+        cls._client = TestClient(asgi.app)
+        cls._client.__enter__()
+
+    @classmethod
+    def stop(cls):
+        cls._client.__exit__(None, None, None)
+
+    def request(self, method, path, body=None):
+        response = self.client.request(method, path, json=body)
+        return response.status_code, response.json() if response.content else None
+
+
+class Stats:
+    """Latencies and error counts per endpoint, shared by the player threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, endpoint, seconds, ok):
+        with self.lock:
+            self.latencies[endpoint].append(seconds)
+            if not ok:
+                self.errors[endpoint] += 1
+
+
+def percentile(values, p):
+    # Nearest-rank percentile of sorted values
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
+
+
+def child_pids(pid):
+    # Processes whose parent is pid, from /proc/<pid>/stat (the parent is the field after the state)
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue  # exited while we looked
+        if int(fields[1]) == pid:
+            pids.append(int(entry))
+    return pids
+
+
+def rss_bytes(pid=None, children=False):
+    # Resident memory of a process (Linux), plus its children's if `children`, or None where /proc isn't available
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    total = int(line.split()[1]) * 1024
+                    break
+            else:
+                return None
+        if children:
+            total += sum(rss_bytes(child) or 0 for child in child_pids(pid or os.getpid()))
+        return total
+    except OSError:
+        pass
+    return None
+
+
+class Player:
+    def __init__(self, client, stats, game_url, color, rng, poll):
+        self.client = client
+        self.stats = stats
+        self.game_url = game_url
+        self.color = color
+        self.rng = rng
+        self.poll = poll
+        self.version = None
+        self.turn = None
+        self.winner = None
+
+    def call(self, endpoint, method, path, body=None):
+        started = time.perf_counter()
+        try:
+            status, payload = self.client.request(method, self.game_url + path, body)
+        except (OSError, http.client.HTTPException):
+            status, payload = None, None
+        self.stats.record(endpoint, time.perf_counter() - started, status is not None and status < 500)
+        return status, payload
+
+    def fetch_state(self):
+        since = f"?since={self.version}" if self.version is not None else ''
+        status, state = self.call('state', 'GET', '/state' + since)
+        if status == 200 and state:
+            self.version = state['version']
+            self.turn = state['current_turn']
+            self.winner = state['winner']
+
+    def play(self):
+        status, payload = self.call('legal_moves', 'GET', '/legal_moves')
+        moves = payload['moves'] if status == 200 and payload else []
+        if not moves:
+            self.call('reset', 'POST', '/reset')
+            return
+        move = self.rng.choice(moves)
+        endpoint = move['kind']  # 'move', 'merge' or 'disintegrate', like the endpoints
+        if endpoint == 'move':
+            body = {'move': move['from'] + move['to'], 'promotion': move['promotion']}
+        elif endpoint == 'merge':
+            body = {'pos1': move['from'], 'pos2': move['to']}
+        else:
+            body = {'pos': move['from'], 'target_pos': move['to']}
+        self.call(endpoint, 'POST', '/' + endpoint, body)
+
+    def run(self, deadline):
+        while time.monotonic() < deadline:
+            self.fetch_state()
+            if self.winner:
+                # White resets finished games
+                if self.color == 'white':
+                    self.call('reset', 'POST', '/reset')
+                    self.version = None
+                else:
+                    time.sleep(self.poll)
+            elif self.turn == self.color:
+                self.play()
+            else:
+                time.sleep(self.poll)
+
+
+def make_client_factory(target):
+    if target == 'flask':
+        return FlaskClient
+    if target == 'asgi':
+        ASGIClient.start()
+        return ASGIClient
+    return lambda: HTTPClient(target)
+
+
+def wait_for_server(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            HTTPClient(url).request('GET', '/piece_codes')
+            return
+        except (OSError, http.client.HTTPException):
+            time.sleep(0.1)
+    raise RuntimeError(f"No server at {url} after {timeout}s")
+
+
+def run(client_factory, players, duration, poll, seed=0, memory_pid=None, memory_children=False):
+    """Runs players/2 games for `duration` seconds and returns a report dict."""
+    stats = Stats()
+    rng = random.Random(seed)
+    setup = client_factory()
+    rss_before = rss_bytes(memory_pid, memory_children)
+    threads = []
+    deadline = time.monotonic() + duration
+    for i in range(0, players, 2):
+        status, payload = setup.request('POST', '/games')
+        if status != 201:
+            raise RuntimeError(f"POST /games failed with status {status}")
+        game_url = f"/games/{payload['game_id']}"
+        for color in ('white', 'black')[:players - i]:
+            player = Player(client_factory(), stats, game_url, color, random.Random(rng.random()), poll)
+            threads.append(threading.Thread(target=player.run, args=(deadline,), daemon=True))
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    rss_after = rss_bytes(memory_pid, memory_children)
+
+    endpoints = {}
+    for endpoint, latencies in sorted(stats.latencies.items()):
+        latencies.sort()
+        endpoints[endpoint] = {
+            'requests': len(latencies),
+            'errors': stats.errors[endpoint],
+            'per_second': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': latencies[-1] * 1000,
+        }
+    return {
+        'players': players,
+        'games': (players + 1) // 2,
+        'seconds': elapsed,
+        'requests': sum(e['requests'] for e in endpoints.values()),
+        'per_second': sum(e['requests'] for e in endpoints.values()) / elapsed,
+        'endpoints': endpoints,
+        'rss_before': rss_before,
+        'rss_after': rss_after,
+    }
+
+
+def format_report(report):
+    lines = [
+        f"{report['players']} players in {report['games']} games for {report['seconds']:.1f}s: "
+        f"{report['requests']} requests ({report['per_second']:.0f}/s)",
+        f"{'endpoint':<14}{'requests':>9}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}",
+    ]
+    for name, e in report['endpoints'].items():
+        lines.append(f"{name:<14}{e['requests']:>9}{e['errors']:>8}{e['per_second']:>9.1f}"
+                     f"{e['p50_ms']:>9.2f}{e['p95_ms']:>9.2f}{e['p99_ms']:>9.2f}{e['max_ms']:>9.2f}")
+    if report['rss_before'] and report['rss_after']:
+        growth = report['rss_after'] - report['rss_before']
+        lines.append(f"server memory: {report['rss_before'] / 2**20:.1f} MB -> {report['rss_after'] / 2**20:.1f} MB "
+                     f"({growth / 2**20:+.1f} MB, {growth / 1024 / report['games']:+.1f} KB per game)")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the Symbiotic Chess API with virtual players")
+    parser.add_argument('--target', default='flask',
+                        help="'flask' or 'asgi' to run the app in-process, or the URL of a running server")
+    parser.add_argument('--spawn', choices=sorted(SPAWN_SCRIPTS),
+                        help=f"start that server as a subprocess and drive it at {SPAWN_URL}")
+    parser.add_argument('--server-pid', type=int, help="process to measure memory of, for --target URL")
+    parser.add_argument('-p', '--players', type=int, default=20, help="virtual players, two per game")
+    parser.add_argument('-d', '--duration', type=float, default=10, help="seconds to run")
+    parser.add_argument('--poll', type=float, default=0.05, help="seconds between /state polls while waiting")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help="also write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    data_dir = tempfile.TemporaryDirectory(prefix='loadtest-')
+    os.environ['SYMBIOTIC_CHESS_DATA'] = data_dir.name
+    server = None
+    memory_pid = args.server_pid
+    target = args.target
+    if args.spawn:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), SPAWN_SCRIPTS[args.spawn])
+        server = subprocess.Popen([sys.executable, script], cwd=os.path.dirname(script),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        target = SPAWN_URL
+        memory_pid = server.pid
+    try:
+        client_factory = make_client_factory(target)
+        if server:
+            wait_for_server(target)
+        # A router's games live in its workers, so count their memory too
+        report = run(client_factory, args.players, args.duration, args.poll, args.seed, memory_pid,
+                     memory_children=args.spawn == 'router')
+    finally:
+        if target == 'asgi' and ASGIClient._client is not None:
+            ASGIClient.stop()
+        if server:
+            server.terminate()
+            server.wait()
+        data_dir.cleanup()
+
+    print(format_report(report))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 1 if any(e['errors'] for e in report['endpoints'].values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
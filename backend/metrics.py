@@ -0,0 +1,244 @@
+"""Optional request metrics and profiling, served at /metrics in Prometheus text format.
+
+Off unless SYMBIOTIC_CHESS_METRICS=1 is set (or enable() is called). While off,
+every hook is a flag check or returns a shared no-op, so it can stay compiled in.
+When on it records:
+
+    symbiotic_requests_total                    requests by endpoint and status
+    symbiotic_request_duration_seconds          request latency by endpoint (histogram)
+    symbiotic_actions_total                     accepted and rejected actions by kind
+    symbiotic_phase_duration_seconds            time in lock_wait, validate, mutate and serialize
+
+start_profile(n) runs cProfile over the next n requests, one at a time
+(requests that overlap a profiled one aren't profiled), and profile_report()
+returns the combined statistics.
+"""
+import bisect
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import threading
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+enabled = os.environ.get('SYMBIOTIC_CHESS_METRICS') == '1'
+
+_lock = threading.Lock()
+_requests = {}        # (endpoint, status) -> count
+_durations = {}       # endpoint -> Histogram
+_actions = {}         # (kind, result) -> count
+_phases = {}          # phase -> Histogram
+_gauges = {}          # name -> (help, function returning the value)
+
+_profile_remaining = 0
+_profile_active = False
+_profile_stats = None
+_profile_requests = 0
+
+_NO_OP = contextlib.nullcontext()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    with _lock:
+        _requests.clear()
+        _durations.clear()
+        _actions.clear()
+        _phases.clear()
+
+
+def gauge(name, help_text, function):
+    # A value read when /metrics is scraped, e.g. the number of open games
+    _gauges[name] = (help_text, function)
+
+
+def observe_request(endpoint, status, seconds):
+    if not enabled:
+        return
+    with _lock:
+        key = (endpoint, status)
+        _requests[key] = _requests.get(key, 0) + 1
+        histogram = _durations.get(endpoint)
+        if histogram is None:
+            histogram = _durations[endpoint] = Histogram()
+        histogram.observe(seconds)
+
+
+def observe_phase(phase, seconds):
+    with _lock:
+        histogram = _phases.get(phase)
+        if histogram is None:
+            histogram = _phases[phase] = Histogram()
+        histogram.observe(seconds)
+
+
+def count_action(kind, accepted):
+    if not enabled:
+        return
+    key = (kind, 'accepted' if accepted else 'rejected')
+    with _lock:
+        _actions[key] = _actions.get(key, 0) + 1
+
+
+class _Phase:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        observe_phase(self.name, time.perf_counter() - self.started)
+
+
+def phase(name):
+    """Times a with-block as one phase of the request (validate, mutate, serialize)."""
+    return _Phase(name) if enabled else _NO_OP
+
+
+class _TimedLock:
+    # Records how long acquiring a threading.Lock or an asyncio.Lock took
+    def __init__(self, lock):
+        self.lock = lock
+
+    def __enter__(self):
+        started = time.perf_counter()
+        self.lock.acquire()
+        observe_phase('lock_wait', time.perf_counter() - started)
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+    async def __aenter__(self):
+        started = time.perf_counter()
+        await self.lock.acquire()
+        observe_phase('lock_wait', time.perf_counter() - started)
+
+    async def __aexit__(self, *exc):
+        self.lock.release()
+
+
+def timed_lock(lock):
+    """Use `with timed_lock(lock):` (or `async with`) in place of `with lock:`."""
+    return _TimedLock(lock) if enabled else lock
+
+
+def start_profile(requests):
+    """Profiles the next `requests` requests, replacing any earlier profile."""
+    global _profile_remaining, _profile_stats, _profile_requests
+    with _lock:
+        _profile_remaining = requests
+        _profile_stats = None
+        _profile_requests = 0
+
+
+def profile_begin():
+    # Returns a running profiler if this request should be profiled, else None
+    global _profile_active, _profile_remaining
+    if not _profile_remaining:
+        return None
+    with _lock:
+        if _profile_active or not _profile_remaining:
+            return None
+        _profile_active = True
+        _profile_remaining -= 1
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:  # Another profiler is already running in this process
+        with _lock:
+            _profile_active = False
+        return None
+    return profiler
+
+
+def profile_end(profiler):
+    global _profile_active, _profile_stats, _profile_requests
+    profiler.disable()
+    with _lock:
+        if _profile_stats is None:
+            _profile_stats = pstats.Stats(profiler)
+        else:
+            _profile_stats.add(profiler)
+        _profile_requests += 1
+        _profile_active = False
+
+
+def profile_report(limit=40):
+    """The functions with the most cumulative time over the profiled requests, as text."""
+    with _lock:
+        if _profile_stats is None:
+            return f"No requests profiled yet ({_profile_remaining} to go).\n"
+        out = io.StringIO()
+        out.write(f"{_profile_requests} requests profiled, {_profile_remaining} to go\n")
+        _profile_stats.stream = out
+        _profile_stats.sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels.items()) + '}'
+
+
+def _histogram_lines(name, histograms, label):
+    lines = []
+    for key, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(**{label: key, 'le': bound})} {cumulative}")
+        lines.append(f"{name}_sum{_labels(**{label: key})} {histogram.sum:.6f}")
+        lines.append(f"{name}_count{_labels(**{label: key})} {histogram.count}")
+    return lines
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    lines = [
+        "# HELP symbiotic_metrics_enabled Whether request metrics are being recorded.",
+        "# TYPE symbiotic_metrics_enabled gauge",
+        f"symbiotic_metrics_enabled {int(enabled)}",
+    ]
+    for name, (help_text, function) in sorted(_gauges.items()):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {function()}"]
+    with _lock:
+        lines += ["# HELP symbiotic_requests_total Requests served, by endpoint and status.",
+                  "# TYPE symbiotic_requests_total counter"]
+        lines += [f"symbiotic_requests_total{_labels(endpoint=endpoint, status=status)} {count}"
+                  for (endpoint, status), count in sorted(_requests.items())]
+        lines += ["# HELP symbiotic_request_duration_seconds Request latency, by endpoint.",
+                  "# TYPE symbiotic_request_duration_seconds histogram"]
+        lines += _histogram_lines('symbiotic_request_duration_seconds', _durations, 'endpoint')
+        lines += ["# HELP symbiotic_actions_total Game actions, by kind and whether they were legal.",
+                  "# TYPE symbiotic_actions_total counter"]
+        lines += [f"symbiotic_actions_total{_labels(kind=kind, result=result)} {count}"
+                  for (kind, result), count in sorted(_actions.items())]
+        lines += ["# HELP symbiotic_phase_duration_seconds Time spent in each phase of handling a request.",
+                  "# TYPE symbiotic_phase_duration_seconds histogram"]
+        lines += _histogram_lines('symbiotic_phase_duration_seconds', _phases, 'phase')
+    return "\n".join(lines) + "\n"
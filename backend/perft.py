@@ -0,0 +1,186 @@
+"""Perft node counts and move-generation benchmarks for SymbioticChessGame.
+
+Counts every action (moves, captures, promotions, merges and disintegrations)
+to a fixed depth from a set of test positions and reports nodes per second.
+
+    python perft.py                       # all positions at their reference depths
+    python perft.py start 3 --divide      # per-root-move counts
+    python perft.py "<fen>" 3             # any position in Symbiotic FEN
+    python perft.py --check               # fail if any count differs from REFERENCE_COUNTS
+    python perft.py --verify              # cross-check generate_moves against is_valid_move_by_rules
+    python perft.py --bench               # validations per second, bitboard vs square-by-square
+"""
+import argparse
+import sys
+import time
+
+from game import SymbioticChessGame, Move, MOVE, MERGE, DISINTEGRATE, START_FEN, IN_CHECK_ERROR
+
+
+POSITIONS = {
+    'start': START_FEN,
+    'chancellors': 'rnbqkb1{rn}/pppppppp/8/8/8/8/PPPPPPPP/{RN}1BQKBNR w 2 2 3',
+    'archbishops': 'rnbqk1{nb}r/pppppppp/8/8/8/8/PPPPPPPP/R{NB}1QKBNR w 2 2 3',
+    'grand_chancellors': 'rnbqk1{nbr}1/pppppppp/8/8/8/8/PPPPPPPP/1{NBR}1QKBNR w 1 1 3',
+    # A sparse middlegame with one of every special piece, including an Amazon
+    # (a pawn merged with a knight, then promoted to a queen)
+    'amazon': '{rn}3k3/1{PR}1{pn}2pn/2{bn}5/8/3{QN}4/2{RBN}5/P6P/6K1 w 1 1 3',
+}
+
+# Agreed node counts per depth (depth 1 first); any faster move generator must reproduce them.
+# Actions that leave the mover's King in check are not counted.
+REFERENCE_COUNTS = {
+    'start': [60, 3600, 209739],
+    'chancellors': [51, 2601, 134159],
+    'archbishops': [54, 2916, 157067],
+    'grand_chancellors': [51, 2601, 107885],
+    'amazon': [97, 4625, 406929],
+}
+
+
+def perft(game, depth):
+    if depth == 0:
+        return 1
+    moves = list(game.generate_moves())
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        game.make(move)
+        nodes += perft(game, depth - 1)
+        game.unmake()
+    return nodes
+
+
+def divide(game, depth):
+    counts = {}
+    for move in list(game.generate_moves()):
+        game.make(move)
+        counts[str(move)] = perft(game, depth - 1)
+        game.unmake()
+    return counts
+
+
+def reference_moves(game):
+    # Every action found by brute force with the square-by-square rule checks.
+    # merge_error and disintegrate_error check the King's safety on bitboards,
+    # so that part is redone here with king_safe_by_rules.
+    moves = set()
+    if game.outcome:
+        return moves
+    last_row = 0 if game.current_turn == 'white' else 7
+    for start in range(64):
+        start_pos = (start >> 3, start & 7)
+        piece = game.board[start_pos[0]][start_pos[1]]
+        if not piece or piece.color != game.current_turn:
+            continue
+        for end in range(64):
+            end_pos = (end >> 3, end & 7)
+            if game.is_valid_move_by_rules(start_pos, end_pos):
+                if piece.piece_type == 'P' and end_pos[0] == last_row:
+                    moves.update(Move(MOVE, start, end, choice) for choice in 'QRBN')
+                else:
+                    moves.add(Move(MOVE, start, end))
+            if max(abs(start_pos[0] - end_pos[0]), abs(start_pos[1] - end_pos[1])) == 1:
+                if game.merge_error(start_pos, end_pos) in (None, IN_CHECK_ERROR) and \
+                   game.king_safe_by_rules(Move(MERGE, start, end)):
+                    moves.add(Move(MERGE, start, end))
+                if game.disintegrate_error(start_pos, end_pos) in (None, IN_CHECK_ERROR) and \
+                   game.king_safe_by_rules(Move(DISINTEGRATE, start, end)):
+                    moves.add(Move(DISINTEGRATE, start, end))
+    return moves
+
+
+def verify(game, depth):
+    # Walks the tree comparing generate_moves with reference_moves at every node
+    moves = list(game.generate_moves())
+    expected = reference_moves(game)
+    if set(moves) != expected or len(moves) != len(expected):
+        missing = sorted(str(m) for m in expected - set(moves))
+        extra = sorted(str(m) for m in set(moves) - expected)
+        raise AssertionError(f"generate_moves differs after {game.last_move}: missing {missing}, extra {extra}")
+    if depth > 1:
+        for move in moves:
+            game.make(move)
+            verify(game, depth - 1)
+            game.unmake()
+
+
+def bench_validation(game, rounds=20):
+    # Validations per second over every (start, end) pair of the side to move
+    pairs = [((s >> 3, s & 7), (e >> 3, e & 7)) for s in range(64) for e in range(64)
+             if game.board[s >> 3][s & 7] and game.board[s >> 3][s & 7].color == game.current_turn]
+    results = {}
+    for name in ('is_valid_move', 'is_valid_move_by_rules'):
+        check = getattr(game, name)
+        started = time.perf_counter()
+        for _ in range(rounds):
+            for start_pos, end_pos in pairs:
+                check(start_pos, end_pos)
+        results[name] = len(pairs) * rounds / (time.perf_counter() - started)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Perft for Symbiotic Chess")
+    parser.add_argument('position', nargs='?',
+                        help=f"test position ({', '.join(POSITIONS)}) or a FEN (default: all test positions)")
+    parser.add_argument('depth', nargs='?', type=int, help="search depth (default: reference depth)")
+    parser.add_argument('--divide', action='store_true', help="print node counts per root action")
+    parser.add_argument('--check', action='store_true', help="compare against REFERENCE_COUNTS")
+    parser.add_argument('--verify', action='store_true', help="cross-check against the reference rules")
+    parser.add_argument('--bench', action='store_true', help="benchmark is_valid_move")
+    args = parser.parse_args(argv)
+
+    if args.position in POSITIONS:
+        positions = {args.position: POSITIONS[args.position]}
+    elif args.position:
+        positions = {'fen': args.position}
+    else:
+        positions = POSITIONS
+    failed = False
+    for name, fen in positions.items():
+        try:
+            game = SymbioticChessGame.from_fen(fen, headless=True)
+        except ValueError as e:
+            parser.error(f"invalid position {fen!r}: {e}")
+        reference = REFERENCE_COUNTS.get(name, [])
+        depth = args.depth or max(len(reference), 1)
+
+        if args.bench:
+            rates = bench_validation(game)
+            print(f"{name}: " + ", ".join(f"{k} {v:,.0f}/s" for k, v in rates.items()))
+            continue
+
+        if args.verify:
+            started = time.perf_counter()
+            verify(game, depth)
+            print(f"{name}: generate_moves matches the reference rules to depth {depth} "
+                  f"({time.perf_counter() - started:.1f}s)")
+            continue
+
+        if args.divide:
+            counts = divide(game, depth)
+            for notation in sorted(counts):
+                print(f"  {notation}: {counts[notation]}")
+            print(f"{name} depth {depth}: {sum(counts.values())} nodes, {len(counts)} root actions")
+            continue
+
+        for d in range(1, depth + 1):
+            started = time.perf_counter()
+            nodes = perft(game, d)
+            elapsed = time.perf_counter() - started
+            status = ""
+            if args.check:
+                if d <= len(reference) and nodes != reference[d - 1]:
+                    status = f"  MISMATCH (expected {reference[d - 1]})"
+                    failed = True
+                elif d <= len(reference):
+                    status = "  ok"
+            print(f"{name} depth {d}: {nodes} nodes in {elapsed:.2f}s "
+                  f"({nodes / max(elapsed, 1e-9):,.0f} nodes/s){status}")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
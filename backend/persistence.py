@@ -0,0 +1,237 @@
+"""Crash-safe game persistence: an append-only action log plus periodic snapshots.
+
+Every applied action is appended to an in-memory buffer that a background
+thread writes to the current log segment and fsyncs in batches, so a request
+never waits for the disk. A crash loses at most the last `flush_interval`
+seconds of actions.
+
+The store keeps each game's record (its actions from the start position, two
+bytes each, see encoding.py) in memory.
+Every `checkpoint_interval` it starts a new log segment, writes a snapshot of
+every game that changed, and deletes the segments the snapshots now cover. On
+restart, load() reads the snapshots and replays only the log tail after them.
+
+Layout of `directory`:
+    log-<first seq>.jsonl     {"seq": 12, "game": "abc", "op": "action", "action": "e2e4"}
+    snapshots/<game id>.json  {"seq": 10, "fen": null, "record": "<base64 game record>"}
+
+A game restarted from a position with /load logs a "load" record with its FEN;
+its actions then count from that position instead of the start position.
+"""
+import json
+import os
+import re
+import threading
+import time
+
+from encoding import decode_moves, encode_moves, from_base64, to_base64
+from game import parse_action
+
+CREATE, ACTION, UNDO, RESET, LOAD, DELETE = 'create', 'action', 'undo', 'reset', 'load', 'delete'
+
+_SAFE_GAME_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class GameStore:
+    def __init__(self, directory, flush_interval=0.05, checkpoint_interval=60.0):
+        self.directory = directory
+        self.snapshot_dir = os.path.join(directory, 'snapshots')
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        self.flush_interval = flush_interval
+        self.checkpoint_interval = checkpoint_interval
+
+        self.lock = threading.Lock()
+        # Held while writing the log or switching segments, so batches reach the file in seq order
+        # (the writer thread flushes, and so does a worker taking over a game, see api.take_over)
+        self.io_lock = threading.Lock()
+        self.seq = 0
+        self.games = {}      # game_id -> bytearray game record
+        self.start_fens = {}  # game_id -> FEN the record starts from, if not the start position
+        self.dirty = set()   # games changed since their last snapshot
+        self.deleted = set()  # games whose snapshot must be removed at the next checkpoint
+        self.buffer = []
+        self.segment = None
+        self.segment_path = None
+
+        self.stopping = threading.Event()
+        self.writer = None
+
+    @staticmethod
+    def persistable(game_id):
+        return bool(_SAFE_GAME_ID.match(game_id))
+
+    # Recovery
+
+    def load(self):
+        """Reads snapshots and the log tail; returns {game_id: (start FEN or None, [Move, ...])}."""
+        snapshot_seqs = {}
+        for name in os.listdir(self.snapshot_dir):
+            if not name.endswith('.json'):
+                continue
+            with open(os.path.join(self.snapshot_dir, name)) as f:
+                snapshot = json.load(f)
+            game_id = name[:-len('.json')]
+            self.games[game_id] = bytearray(from_base64(snapshot['record']))
+            if snapshot.get('fen'):
+                self.start_fens[game_id] = snapshot['fen']
+            snapshot_seqs[game_id] = snapshot['seq']
+            self.seq = max(self.seq, snapshot['seq'])
+
+        for path in self.segment_paths():
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # A torn write at the end of the last segment
+                    self.seq = max(self.seq, record['seq'])
+                    if record['seq'] > snapshot_seqs.get(record['game'], 0):
+                        action = record.get('action')
+                        self._apply(record['game'], record['op'], action and parse_action(action), record.get('fen'))
+        self.dirty = set(self.games)
+        return {game_id: (self.start_fens.get(game_id), decode_moves(bytes(moves)))
+                for game_id, moves in self.games.items()}
+
+    def segment_paths(self):
+        names = [n for n in os.listdir(self.directory) if n.startswith('log-') and n.endswith('.jsonl')]
+        names.sort(key=lambda n: int(n[len('log-'):-len('.jsonl')]))
+        return [os.path.join(self.directory, n) for n in names]
+
+    # Writing
+
+    def start(self):
+        self._open_segment()
+        self.writer = threading.Thread(target=self._run, name='game-store-writer', daemon=True)
+        self.writer.start()
+
+    def close(self):
+        if self.writer is not None:
+            self.stopping.set()
+            self.writer.join()
+            self.writer = None
+        with self.io_lock:
+            with self.lock:
+                lines, self.buffer = self.buffer, []
+            self._write(lines)
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+
+    def append(self, game_id, op, move=None, fen=None):
+        # Called with the game's lock held, so records of one game are in order
+        if not self.persistable(game_id):
+            return
+        with self.lock:
+            self.seq += 1
+            record = {'seq': self.seq, 'game': game_id, 'op': op}
+            if move is not None:
+                record['action'] = str(move)
+            if fen is not None:
+                record['fen'] = fen
+            self.buffer.append(json.dumps(record) + '\n')
+            self._apply(game_id, op, move, fen)
+
+    def _apply(self, game_id, op, move, fen=None):
+        if op in (CREATE, RESET, LOAD):
+            self.games[game_id] = bytearray()
+            if op == LOAD:
+                self.start_fens[game_id] = fen
+            else:
+                self.start_fens.pop(game_id, None)
+            self.deleted.discard(game_id)
+        elif op == ACTION:
+            self.games.setdefault(game_id, bytearray()).extend(encode_moves([move]))
+        elif op == UNDO:
+            if self.games.get(game_id):
+                del self.games[game_id][-2:]
+        elif op == DELETE:
+            self.games.pop(game_id, None)
+            self.start_fens.pop(game_id, None)
+            self.dirty.discard(game_id)
+            self.deleted.add(game_id)
+            return
+        self.dirty.add(game_id)
+
+    def flush(self):
+        with self.io_lock:
+            with self.lock:
+                lines, self.buffer = self.buffer, []
+            self._write(lines)
+
+    def _write(self, lines):
+        if lines and self.segment is not None:
+            self.segment.write(''.join(lines))
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+
+    def checkpoint(self):
+        """Snapshots every changed game and drops the log segments the snapshots cover."""
+        self.io_lock.acquire()
+        with self.lock:
+            covered = self.seq
+            snapshots = {game_id: (self.start_fens.get(game_id), bytes(self.games[game_id]))
+                         for game_id in self.dirty}
+            deleted = set(self.deleted)
+            self.dirty.clear()
+            self.deleted.clear()
+            # Taken with `covered`: a record appended after this gets a later seq and goes to the new segment
+            lines, self.buffer = self.buffer, []
+        # Everything up to `covered` goes to the old segments; later records start a new one
+        try:
+            self._write(lines)
+            old_segments = self.segment_paths()
+            self._open_segment(covered + 1)
+        finally:
+            self.io_lock.release()
+
+        for game_id, (fen, record) in snapshots.items():
+            self._write_snapshot(game_id, covered, fen, record)
+        for game_id in deleted:
+            try:
+                os.remove(self._snapshot_path(game_id))
+            except FileNotFoundError:
+                pass
+        _fsync_directory(self.snapshot_dir)
+
+        for path in old_segments:
+            if path != self.segment_path:
+                os.remove(path)
+        _fsync_directory(self.directory)
+
+    def _run(self):
+        next_checkpoint = time.monotonic() + self.checkpoint_interval
+        while not self.stopping.wait(self.flush_interval):
+            self.flush()
+            if time.monotonic() >= next_checkpoint:
+                self.checkpoint()
+                next_checkpoint = time.monotonic() + self.checkpoint_interval
+
+    def _open_segment(self, first_seq=None):
+        if self.segment is not None:
+            self.segment.close()
+        first_seq = self.seq + 1 if first_seq is None else first_seq
+        self.segment_path = os.path.join(self.directory, f"log-{first_seq}.jsonl")
+        self.segment = open(self.segment_path, 'a')
+        _fsync_directory(self.directory)
+
+    def _snapshot_path(self, game_id):
+        return os.path.join(self.snapshot_dir, f"{game_id}.json")
+
+    def _write_snapshot(self, game_id, seq, fen, record):
+        # Written to a temporary file and renamed, so a snapshot is never half-written
+        path = self._snapshot_path(game_id)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'seq': seq, 'fen': fen, 'record': to_base64(record)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+
+def _fsync_directory(path):
+    if hasattr(os, 'O_DIRECTORY'):
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,152 @@
+"""Games keyed by ID, so one server process can host many tables.
+
+Each game lives in a GameSession with its own lock (and an asyncio lock for
+the ASGI server); the registry lock only guards the dictionary itself, so
+requests to different games never wait on each other. Idle games are evicted
+after `ttl` seconds, and the least recently used ones are dropped when more
+than `max_games` are open.
+"""
+import asyncio
+import queue
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from game import SymbioticChessGame
+from engine import Engine
+
+# Transposition-table slots per game; the engine is created on the first AI move
+SESSION_TT_SIZE = 1 << 16
+# Updates buffered per event-stream subscriber before a slow client is dropped
+SUBSCRIBER_QUEUE_SIZE = 64
+
+
+class GameSession:
+    def __init__(self, game_id, game_factory=SymbioticChessGame, game=None):
+        self.game_id = game_id
+        self.game_factory = game_factory
+        self.game = game if game is not None else game_factory()
+        self.lock = threading.Lock()
+        self.async_lock = asyncio.Lock()
+        self.last_access = time.monotonic()
+        self._engine = None
+        self.subscribers = []
+        # Game version of the last update pushed to subscribers
+        self.published_version = self.game.version
+        # (version, encoded JSON) of the last full state served
+        self.state_cache = None
+        # Number of game.history entries already written to the action log
+        self.logged_plies = 0
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            self._engine = Engine(tt_size=SESSION_TT_SIZE)
+        return self._engine
+
+    def reset(self):
+        self.game = self.game_factory()
+        self.logged_plies = 0
+
+    def subscribe(self, subscriber=None):
+        # A queue.Queue by default; the ASGI server passes an asyncio.Queue
+        if subscriber is None:
+            subscriber = queue.Queue(SUBSCRIBER_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+
+    def publish(self, message):
+        # Call with self.lock held. Subscribers that stopped reading are dropped.
+        for subscriber in list(self.subscribers):
+            try:
+                subscriber.put_nowait(message)
+            except (queue.Full, asyncio.QueueFull):
+                # The stream notices it was dropped and closes; the client reconnects
+                self.subscribers.remove(subscriber)
+
+
+class GameRegistry:
+    def __init__(self, max_games=1000, ttl=6 * 3600, game_factory=SymbioticChessGame):
+        self.max_games = max_games
+        self.ttl = ttl
+        self.game_factory = game_factory
+        self.sessions = OrderedDict()  # Least recently used first
+        self.lock = threading.Lock()
+        # Optional callbacks, called with the registry lock held: on_create(session), on_remove(game_id)
+        self.on_create = None
+        self.on_remove = None
+        # Optional owns(game_id) check for generated IDs; a worker behind router.py only creates its own games
+        self.owns = None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def create(self, game_id=None, game=None):
+        # A new session for game_id (a generated ID if None), with a new game unless one is given
+        with self.lock:
+            return self._create(game_id, game)
+
+    def get(self, game_id):
+        # Returns the session and marks it as recently used, or None if unknown or expired
+        with self.lock:
+            return self._get(game_id)
+
+    def get_or_create(self, game_id):
+        with self.lock:
+            return self._get(game_id) or self._create(game_id)
+
+    def _create(self, game_id, game=None):
+        if game_id is None:
+            game_id = secrets.token_urlsafe(8)
+            while game_id in self.sessions or (self.owns is not None and not self.owns(game_id)):
+                game_id = secrets.token_urlsafe(8)
+        session = GameSession(game_id, self.game_factory, game)
+        self.sessions[game_id] = session
+        if self.on_create is not None:
+            self.on_create(session)
+        self._evict()
+        return session
+
+    def _get(self, game_id):
+        session = self.sessions.get(game_id)
+        if session is None:
+            return None
+        now = time.monotonic()
+        if now - session.last_access > self.ttl:
+            self._discard(game_id)
+            return None
+        session.last_access = now
+        self.sessions.move_to_end(game_id)
+        return session
+
+    def remove(self, game_id):
+        with self.lock:
+            if game_id not in self.sessions:
+                return False
+            self._discard(game_id)
+            return True
+
+    def _discard(self, game_id):
+        del self.sessions[game_id]
+        if self.on_remove is not None:
+            self.on_remove(game_id)
+
+    def evict(self):
+        with self.lock:
+            self._evict()
+
+    def _evict(self):
+        # Expired games first, then the least recently used ones above the cap
+        now = time.monotonic()
+        while self.sessions:
+            game_id, session = next(iter(self.sessions.items()))
+            if now - session.last_access <= self.ttl and len(self.sessions) <= self.max_games:
+                break
+            self._discard(game_id)
@@ -0,0 +1,414 @@
+"""Runs several asgi.py workers behind one port, each game on exactly one of them.
+
+    python router.py                        # one worker per core, on port 5000
+    python router.py --workers 4 --port 5000
+
+One asgi.py process handles every request on one event loop, so it uses a
+single core however many games it hosts. The router starts --workers of them
+on the ports from --worker-port up and forwards each HTTP request to the worker
+that owns its game, handoff.worker_for() of the ID in /games/<game_id>/...
+Requests for the default game (/state, /move, ...) go to the default game's
+owner. POST /games and /piece_codes go to the workers in turn; a worker only
+creates game IDs it owns. /workers/<n>/<path> reaches worker n directly, for
+example /workers/0/metrics. Every response names its worker in X-Worker.
+
+Worker n logs its games in <data>/worker-<n>. When a worker stops, it hands its
+games off through <data>/handoff.sqlite3, and their owner takes each one over
+on its next request: the same worker after a restart, or another one when
+--workers changes. A worker that exits on its own is restarted and rebuilds
+its games from its log. SIGHUP restarts the workers one at a time (after a
+deploy, say); requests wait for their worker to come back. At startup, the
+games logged by workers that no longer exist, or by a single-process server
+in <data> itself, are handed off as well.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import time
+from urllib.parse import unquote
+
+from api import DEFAULT_GAME_ID
+from handoff import SQLiteHandoff, worker_for
+from persistence import GameStore
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+HANDOFF_FILE = 'handoff.sqlite3'
+# Seconds a request waits for its worker to (re)start before it fails with a 502
+CONNECT_TIMEOUT = 30
+# Seconds a worker gets to start, and to finish its requests and hand off its games when stopped
+START_TIMEOUT = 60
+STOP_TIMEOUT = 30
+# Idle keep-alive connections kept open to each worker
+MAX_IDLE_CONNECTIONS = 64
+# Hop-by-hop request headers; the router manages both of its connections itself
+HOP_HEADERS = {'connection', 'keep-alive', 'proxy-connection', 'expect'}
+
+
+def log(message):
+    print(f"router: {message}", file=sys.stderr, flush=True)
+
+
+class Worker:
+    """One asgi.py process and the idle connections to it."""
+
+    def __init__(self, index, workers, port, data, ai_workers):
+        self.index = index
+        self.port = port
+        self.env = dict(os.environ,
+                        SYMBIOTIC_CHESS_WORKER=str(index),
+                        SYMBIOTIC_CHESS_WORKERS=str(workers),
+                        SYMBIOTIC_CHESS_DATA=os.path.join(data, f"worker-{index}"),
+                        SYMBIOTIC_CHESS_HANDOFF=os.path.join(data, HANDOFF_FILE),
+                        SYMBIOTIC_CHESS_AI_WORKERS=str(ai_workers))
+        self.process = None
+        self.stopping = False  # Stopped on purpose, so not restarted
+        self.idle = []
+
+    def start(self):
+        # In its own session, so a Ctrl+C reaches only the router, which stops the workers in order
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'asgi:app', '--host', '127.0.0.1', '--port', str(self.port),
+             '--no-access-log', '--timeout-keep-alive', '300', '--timeout-graceful-shutdown', '5'],
+            cwd=BACKEND_DIR, env=self.env, start_new_session=True)
+
+    def stop(self):
+        # SIGTERM: uvicorn finishes its requests, then the app hands its games off
+        self.stopping = True
+        self.close_idle()
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+    async def wait(self):
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while self.process.poll() is None:
+            if time.monotonic() > deadline:
+                log(f"worker {self.index} didn't stop in {STOP_TIMEOUT}s; killing it")
+                self.process.kill()
+            await asyncio.sleep(0.1)
+
+    async def ready(self):
+        # uvicorn only listens once the app has started, games and tables loaded
+        deadline = time.monotonic() + START_TIMEOUT
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Worker {self.index} exited with status {self.process.returncode}")
+            try:
+                _, writer = await asyncio.open_connection('127.0.0.1', self.port)
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Worker {self.index} didn't start in {START_TIMEOUT}s")
+                await asyncio.sleep(0.1)
+                continue
+            writer.close()
+            return
+
+    async def connect(self):
+        # An idle connection if there is one, else a new one, waiting for a worker that is (re)starting
+        while self.idle:
+            connection = self.idle.pop()
+            if not connection[0].at_eof():
+                return connection, True
+            connection[1].close()
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        while True:
+            try:
+                return await asyncio.open_connection('127.0.0.1', self.port), False
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+
+    async def exchange(self, request):
+        """Sends a request; returns the connection and the response head."""
+        while True:
+            connection, reused = await self.connect()
+            reader, writer = connection
+            try:
+                writer.write(request)
+                await writer.drain()
+                return connection, await reader.readuntil(b'\r\n\r\n')
+            except (OSError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused:
+                    raise
+                # The worker closed its idle connections, most likely in a restart; retry on a new one
+                self.close_idle()
+
+    def release(self, connection):
+        if len(self.idle) < MAX_IDLE_CONNECTIONS:
+            self.idle.append(connection)
+        else:
+            connection[1].close()
+
+    def close_idle(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+def parse_head(head):
+    # The first line and the [(lower-case name, value)] headers of a request or response head
+    lines = head.decode('latin-1').split('\r\n')
+    headers = []
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers.append((name.strip().lower(), value.strip()))
+    return lines[0], headers
+
+
+async def send_error(writer, status, reason, message):
+    # A response from the router itself; the connection is closed after it
+    body = json.dumps({'error': message}).encode()
+    writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\nAccess-Control-Allow-Origin: *\r\n"
+                 f"Connection: close\r\n\r\n".encode() + body)
+    await writer.drain()
+
+
+async def relay_exactly(reader, writer, length):
+    while length:
+        data = await reader.read(min(length, 1 << 16))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', length)
+        writer.write(data)
+        length -= len(data)
+        await writer.drain()
+
+
+async def relay_chunked(reader, writer):
+    # Chunk by chunk, so event streams reach the client as they are written
+    while True:
+        line = await reader.readuntil(b'\r\n')
+        writer.write(line)
+        size = int(line.split(b';', 1)[0], 16)
+        if size == 0:
+            break
+        writer.write(await reader.readexactly(size + 2))
+        await writer.drain()
+    while line != b'\r\n':  # Trailers, up to an empty line
+        line = await reader.readuntil(b'\r\n')
+        writer.write(line)
+    await writer.drain()
+
+
+async def relay_to_eof(reader, writer):
+    while True:
+        data = await reader.read(1 << 16)
+        if not data:
+            return
+        writer.write(data)
+        await writer.drain()
+
+
+class Router:
+    def __init__(self, workers):
+        self.workers = workers
+        self.turns = itertools.count()
+
+    def owner(self, game_id):
+        return self.workers[worker_for(game_id, len(self.workers))]
+
+    def route(self, target):
+        """The Worker for a request target and the target to forward, or (None, None)."""
+        parts = target.split('?', 1)[0].split('/')
+        if len(parts) > 2 and parts[1] == 'workers':
+            rest = target.split('/', 3)
+            if not parts[2].isdigit() or int(parts[2]) >= len(self.workers):
+                return None, None
+            return self.workers[int(parts[2])], '/' + (rest[3] if len(rest) > 3 else '')
+        if len(parts) > 2 and parts[1] == 'games':
+            return self.owner(unquote(parts[2])), target
+        if len(parts) == 2 and parts[1] in ('games', 'piece_codes'):
+            return self.workers[next(self.turns) % len(self.workers)], target
+        return self.owner(DEFAULT_GAME_ID), target
+
+    async def handle(self, reader, writer):
+        # One client connection, kept open between requests
+        try:
+            while await self.forward(reader, writer):
+                pass
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass  # The client went away, or sent something that isn't HTTP
+        finally:
+            writer.close()
+
+    async def forward(self, reader, writer):
+        """Relays one request and its response; returns whether the client connection stays open."""
+        request_line, headers = parse_head(await reader.readuntil(b'\r\n\r\n'))
+        fields = dict(headers)
+        try:
+            method, target, version = request_line.split(' ')
+            length = int(fields.get('content-length', 0))
+        except ValueError:
+            await send_error(writer, 400, 'Bad Request', "Malformed request")
+            return False
+        if 'chunked' in fields.get('transfer-encoding', '').lower():
+            await send_error(writer, 411, 'Length Required', "Request bodies need a Content-Length")
+            return False
+        worker, target = self.route(target)
+        if worker is None:
+            await send_error(writer, 404, 'Not Found', "No such worker")
+            return False
+        if fields.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        body = await reader.readexactly(length)
+        keep_alive = version == 'HTTP/1.1' and 'close' not in fields.get('connection', '').lower()
+
+        lines = [f"{method} {target} {version}"] + [f"{name}: {value}" for name, value in headers
+                                                    if name not in HOP_HEADERS]
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+        try:
+            connection, head = await worker.exchange(request)
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            await send_error(writer, 502, 'Bad Gateway', f"Worker {worker.index} is unavailable")
+            return False
+
+        upstream, upstream_writer = connection
+        status_line, response_headers = parse_head(head)
+        response_fields = dict(response_headers)
+        status = int(status_line.split(' ', 2)[1])
+        writer.write(head[:-2] + b'X-Worker: %d\r\n\r\n' % worker.index)
+        reusable = 'close' not in response_fields.get('connection', '').lower()
+        try:
+            if method == 'HEAD' or status in (204, 304) or status < 200:
+                await writer.drain()
+            elif 'chunked' in response_fields.get('transfer-encoding', '').lower():
+                await relay_chunked(upstream, writer)
+            elif 'content-length' in response_fields:
+                await relay_exactly(upstream, writer, int(response_fields['content-length']))
+            else:
+                await relay_to_eof(upstream, writer)  # The body ends with the worker's connection
+                reusable = False
+        except BaseException:
+            upstream_writer.close()
+            raise
+        if reusable:
+            worker.release(connection)
+        else:
+            upstream_writer.close()
+        return keep_alive and reusable
+
+
+def hand_off_orphans(data, workers, handoff):
+    # Hands off the games logged by workers beyond `workers`, or by a single-process server in `data`
+    directories = [data] + [os.path.join(data, name) for name in sorted(os.listdir(data))
+                            if name.startswith('worker-') and name[len('worker-'):].isdigit()
+                            and int(name[len('worker-'):]) >= workers]
+    moved = 0
+    for directory in directories:
+        store = GameStore(directory)
+        games = store.load()
+        handoff.put(games)
+        moved += len(games)
+        if directory == data:
+            for path in store.segment_paths():
+                os.remove(path)
+            shutil.rmtree(store.snapshot_dir)
+        else:
+            shutil.rmtree(directory)
+    return moved
+
+
+def add_signal_handler(loop, sig, callback):
+    try:
+        loop.add_signal_handler(sig, callback)
+    except NotImplementedError:
+        # Windows: no signals in the event loop
+        signal.signal(sig, lambda *args: loop.call_soon_threadsafe(callback))
+
+
+async def restart_workers(workers):
+    # One at a time, each handing its games off to its replacement
+    for worker in workers:
+        worker.stop()
+        await worker.wait()
+        worker.start()
+        worker.stopping = False
+        await worker.ready()
+        log(f"worker {worker.index} restarted")
+
+
+async def supervise(workers, stopping):
+    # Restarts workers that exit on their own, until the router stops
+    while not stopping.is_set():
+        for worker in workers:
+            if not worker.stopping and worker.process.poll() is not None:
+                log(f"worker {worker.index} exited with status {worker.process.returncode}; restarting it")
+                worker.close_idle()
+                worker.start()
+        try:
+            await asyncio.wait_for(stopping.wait(), 1)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def serve(args):
+    data = os.path.abspath(args.data)
+    os.makedirs(data, exist_ok=True)
+    handoff = SQLiteHandoff(os.path.join(data, HANDOFF_FILE))
+    moved = hand_off_orphans(data, args.workers, handoff)
+    if moved:
+        log(f"{moved} games handed off from earlier servers")
+    handoff.close()
+
+    # The workers share the cores for their AI searches
+    ai_workers = max(1, (os.cpu_count() or 1) // args.workers)
+    workers = [Worker(i, args.workers, args.worker_port + i, data, ai_workers) for i in range(args.workers)]
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    restarts = set()
+
+    def restart():
+        if not restarts:
+            task = loop.create_task(restart_workers(workers))
+            restarts.add(task)
+            task.add_done_callback(restarts.discard)
+
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            await worker.ready()
+        server = await asyncio.start_server(Router(workers).handle, args.host, args.port)
+        add_signal_handler(loop, signal.SIGINT, stopping.set)
+        add_signal_handler(loop, signal.SIGTERM, stopping.set)
+        if hasattr(signal, 'SIGHUP'):
+            add_signal_handler(loop, signal.SIGHUP, restart)
+        log(f"{len(workers)} workers on ports {args.worker_port}-{args.worker_port + len(workers) - 1}, "
+            f"serving on {args.host}:{args.port}")
+        await supervise(workers, stopping)
+        server.close()
+    finally:
+        for task in restarts:
+            task.cancel()
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            await worker.wait()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the Symbiotic Chess API from several worker processes")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1,
+                        help="asgi.py worker processes (default: one per core)")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--worker-port', type=int, default=5100, help="port of the first worker, on 127.0.0.1")
+    parser.add_argument('--data', default=os.environ.get('SYMBIOTIC_CHESS_DATA', 'data'),
+                        help="directory for the workers' logs and the handoff store")
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    return asyncio.run(serve(args))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
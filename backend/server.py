@@ -1,6 +1,19 @@
-from flask import Flask, jsonify, request
+"""Flask server for the game API (see api.py).
+
+The threaded Werkzeug server is the fallback for when the ASGI server
+(asgi.py) can't be used; both serve the same endpoints.
+"""
+import os
+import queue
+import time
+
+from flask import Flask, Response, abort, g, jsonify, request
 from flask_cors import CORS
-from game import SymbioticChessGame
+import analysis
+import api
+import metrics
+from api import DEFAULT_GAME_ID, EVENT_KEEPALIVE, registry, enable_persistence
+from encoding import piece_table
 
 app = Flask(__name__)
 # Allow requests from ngrok and localhost
@@ -14,77 +27,173 @@ def after_request(response):
     header['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
     return response
 
-game = SymbioticChessGame()
-
-def piece_to_dict(piece):
-    if piece is None:
-        return None
-    return {
-        'piece_type': piece.piece_type,
-        'color': piece.color,
-        'combined_pieces': piece.combined_pieces,
-        'display_info': piece.get_display_info()
-    }
-
-def board_to_json(board):
-    json_board = []
-    for row in board:
-        json_row = [piece_to_dict(p) for p in row]
-        json_board.append(json_row)
-    return json_board
-
-@app.route('/state', methods=['GET'])
-def get_state():
-    return jsonify({
-        'board': board_to_json(game.board),
-        'current_turn': game.current_turn,
-        'merge_count': game.merge_count,
-        'last_move': game.last_move,
-        'captured_pieces': {
-            'white': [piece_to_dict(p) for p in game.captured_pieces['white']],
-            'black': [piece_to_dict(p) for p in game.captured_pieces['black']]
-        },
-        'status_message': game.status_message,
-        'last_merge_info': game.last_merge_info
-    })
-
-@app.route('/move', methods=['POST'])
-def move():
-    data = request.json
-    start_pos, end_pos = game.parse_move(data['move'])
-    
-    if start_pos is None:
-        game.status_message = "Invalid move format."
-    elif game.is_valid_move(start_pos, end_pos):
-        game.move_piece(start_pos, end_pos)
-        game.switch_turn()
-    else:
-        game.status_message = "Invalid move."
-        
-    return jsonify({'status': 'ok'})
+@app.before_request
+def start_timer():
+    if metrics.enabled:
+        g.profiler = metrics.profile_begin()
+        g.started = time.perf_counter()
 
+@app.after_request
+def record_request(response):
+    if metrics.enabled and 'started' in g:
+        metrics.observe_request(request.endpoint, response.status_code, time.perf_counter() - g.started)
+        if g.profiler:
+            metrics.profile_end(g.profiler)
+    return response
 
-@app.route('/merge', methods=['POST'])
-def merge():
-    data = request.json
-    pos1, _ = game.parse_move(f"{data['pos1']}a1")
-    pos2, _ = game.parse_move(f"{data['pos2']}a1")
-    game.attempt_merge(pos1, pos2)
-    return jsonify({'status': 'ok'})
+def game_routes(rule, **options):
+    # Registers a view both at `rule` for the default game and under /games/<game_id>
+    def decorator(view):
+        app.route(rule, defaults={'game_id': DEFAULT_GAME_ID}, **options)(view)
+        app.route(f"/games/<game_id>{rule}", **options)(view)
+        return view
+    return decorator
 
-@app.route('/disintegrate', methods=['POST'])
-def disintegrate():
-    data = request.json
-    pos, _ = game.parse_move(f"{data['pos']}a1")
-    target_pos, _ = game.parse_move(f"{data['target_pos']}a1")
-    game.attempt_disintegrate(pos, target_pos)
-    return jsonify({'status': 'ok'})
+def get_session(game_id):
+    session = api.get_session(game_id)
+    if session is None:
+        abort(404)
+    return session
 
-@app.route('/reset', methods=['POST'])
-def reset():
-    global game
-    game = SymbioticChessGame()
+def request_data():
+    # The JSON body as a dict; anything else (no body, a list, a number) counts as empty
+    data = request.get_json(silent=True)
+    return data if isinstance(data, dict) else {}
+
+def action_route(rule, handler):
+    # A POST endpoint that runs an api action handler on the locked session
+    def view(game_id):
+        session = get_session(game_id)
+        data = request_data()
+        with metrics.timed_lock(session.lock):
+            payload, status = handler(session, data)
+        return jsonify(payload), status
+    view.__name__ = handler.__name__
+    game_routes(rule, methods=['POST'])(view)
+
+@app.route('/games', methods=['POST'])
+def create_game():
+    session = registry.create()
+    return jsonify({'game_id': session.game_id}), 201
+
+@app.route('/games/<game_id>', methods=['DELETE'])
+def delete_game(game_id):
+    if not registry.remove(game_id):
+        abort(404)
     return jsonify({'status': 'ok'})
 
+@game_routes('/state', methods=['GET'])
+def get_state(game_id):
+    session = get_session(game_id)
+    with metrics.timed_lock(session.lock):
+        status, body, mimetype, etag = api.state(session, request.args.get('since', type=int),
+                                                 request.args.get('format', 'json'),
+                                                 request.headers.get('If-None-Match'))
+    response = Response(body, status=status, mimetype=mimetype)
+    if etag:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/piece_codes', methods=['GET'])
+def piece_codes():
+    # The table for decoding boards in the binary state format
+    return jsonify(piece_table())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/metrics/profile', methods=['GET'])
+def get_profile():
+    return Response(metrics.profile_report(), mimetype='text/plain')
+
+@app.route('/metrics/profile', methods=['POST'])
+def start_profile():
+    payload, status = api.start_profile(request_data())
+    return jsonify(payload), status
+
+@game_routes('/events', methods=['GET'])
+def events(game_id):
+    # Server-Sent Events: the full state once, then one small update per action
+    session = get_session(game_id)
+    subscriber = session.subscribe()
+    with metrics.timed_lock(session.lock):
+        initial = api.state_body(session)
+
+    def stream():
+        try:
+            yield f"event: state\ndata: {initial}\n\n"
+            while subscriber in session.subscribers:
+                try:
+                    message = subscriber.get(timeout=EVENT_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"data: {message}\n\n"
+        finally:
+            session.unsubscribe(subscriber)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@game_routes('/legal_moves', methods=['GET'])
+def legal_moves(game_id):
+    session = get_session(game_id)
+    with metrics.timed_lock(session.lock):
+        payload, status = api.legal_moves(session, request.args.get('square'))
+    return jsonify(payload), status
+
+@game_routes('/fen', methods=['GET'])
+def get_fen(game_id):
+    session = get_session(game_id)
+    with metrics.timed_lock(session.lock):
+        payload, status = api.fen(session)
+    return jsonify(payload), status
+
+@game_routes('/ai_move', methods=['POST'])
+def ai_move(game_id):
+    session = get_session(game_id)
+    data = request_data()
+    time_limit, status = api.ai_time_limit(data)
+    if status != 200:
+        return jsonify(time_limit), status
+    with metrics.timed_lock(session.lock):
+        result = api.book_result(session.game, data)
+        if result is not None:
+            payload, status = api.ai_move(session, result, from_book=True)
+        else:
+            result = session.engine.search(session.game, time_limit=time_limit)
+            payload, status = api.ai_move(session, result)
+    return jsonify(payload), status
+
+@game_routes('/analysis', methods=['GET'])
+def analyze(game_id):
+    session = get_session(game_id)
+    with metrics.timed_lock(session.lock):
+        job, status = analysis.start(session, request.args.get('depth'))
+    if status != 200:
+        return jsonify(job), status
+    return Response(job.events(analysis.get_pool()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@game_routes('/book', methods=['GET'])
+def book_moves(game_id):
+    session = get_session(game_id)
+    with metrics.timed_lock(session.lock):
+        payload, status = api.book_moves(session)
+    return jsonify(payload), status
+
+action_route('/move', api.move)
+action_route('/merge', api.merge)
+action_route('/disintegrate', api.disintegrate)
+action_route('/undo', api.undo)
+action_route('/reset', api.reset)
+action_route('/load', api.load)
+action_route('/batch', api.batch)
+
 if __name__ == '__main__':
-    app.run(debug=True, use_reloader=False, host='0.0.0.0')
+    enable_persistence(os.environ.get('SYMBIOTIC_CHESS_DATA', 'data'))
+    api.enable_book(os.environ.get('SYMBIOTIC_CHESS_BOOK', 'book.bin'))
+    api.enable_tablebases(os.environ.get('SYMBIOTIC_CHESS_TABLEBASES', 'tablebases'))
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', use_reloader=False, host='0.0.0.0', threaded=True)
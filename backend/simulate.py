@@ -0,0 +1,206 @@
+"""Headless self-play for tuning max_merges and piece balance.
+
+Plays N games across a process pool and streams one JSON line per finished
+game (winner, length, merges used, special pieces created) to a file.
+
+    python simulate.py 1000 -o results.jsonl                    # random vs random on every core
+    python simulate.py 200 --white ai --black random --ai-nodes 5000
+    python simulate.py 500 --max-merges 5 --openings openings.txt
+
+A policy picks the next action for one side: 'random' plays a uniformly random
+legal action, 'ai' runs the search engine with a fixed node budget (so runs are
+reproducible), and --ai-random makes that share of its moves random instead.
+--openings plays scripted actions first: one opening per line,
+actions separated by commas (e.g. "e2e4, e7e5, merge b1 c1"); game i uses line
+i modulo the number of openings.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from game import SymbioticChessGame, MAX_MERGE_LIMIT, MERGE
+from engine import Engine
+
+# Games still running after this many actions are scored as draws
+MAX_PLIES = 300
+
+_engine = None
+
+
+def random_policy(game, rng, options):
+    moves = list(game.generate_moves())
+    return rng.choice(moves) if moves else None
+
+
+def ai_policy(game, rng, options):
+    # Some AI moves can be random, so that self-play games don't all repeat the same line
+    if options.get('ai_random') and rng.random() < options['ai_random']:
+        return random_policy(game, rng, options)
+    # One engine per worker process, reused across games
+    global _engine
+    if _engine is None:
+        _engine = Engine(time_limit=None, tt_size=1 << 16)
+    return _engine.search(game, max_depth=options['ai_depth'], max_nodes=options['ai_nodes']).move
+
+
+POLICIES = {
+    'random': random_policy,
+    'ai': ai_policy,
+}
+
+
+def special_piece_created(game, move):
+    # Name of the special piece a merge or promotion just created, if any
+    if move.kind == MERGE:
+        sq = move.start
+    elif move.promotion:
+        sq = move.end
+    else:
+        return None
+    info = game.board[sq >> 3][sq & 7].special_info
+    return info['name'] if info else None
+
+
+def play_game(task):
+    """Plays one game from an (index, seed, opening, options) task and returns its result dict."""
+    index, seed, opening, options = task
+    rng = random.Random(seed)
+    if _engine is not None:
+        _engine.tt.clear()  # So a game's result doesn't depend on the games before it
+    game = SymbioticChessGame(headless=True)
+    game.max_merges = options['max_merges']
+    policies = {'white': POLICIES[options['white']], 'black': POLICIES[options['black']]}
+    specials = {'white': Counter(), 'black': Counter()}
+    result = None
+
+    for ply in range(options['max_plies']):
+        color = game.current_turn
+        if ply < len(opening):
+            move = game.parse_action(opening[ply])
+            if move not in set(game.generate_moves()):
+                raise ValueError(f"Illegal opening action {opening[ply]!r} in game {index}")
+        else:
+            move = policies[color](game, rng, options)
+        if move is None:
+            result = 'no_moves'
+            break
+        game.apply_move(move)
+        special = special_piece_created(game, move)
+        if special:
+            specials[color][special] += 1
+        if game.outcome:
+            result = game.outcome
+            break
+
+    record = {
+        'game': index,
+        'seed': seed,
+        'white': options['white'],
+        'black': options['black'],
+        'max_merges': options['max_merges'],
+        'winner': game.winner,
+        'result': result or 'max_plies',
+        'plies': len(game.history),
+        'merges': dict(game.merge_count),
+        'special_pieces': {color: dict(counts) for color, counts in specials.items()},
+    }
+    if options.get('record_moves'):
+        record['moves'] = [str(undo.move) for undo in game.history]
+    return record
+
+
+def load_openings(path):
+    openings = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                openings.append([action.strip() for action in line.split(',') if action.strip()])
+    return openings
+
+
+def run(games, options, workers=None, seed=0, openings=None):
+    """Yields one result dict per game as the pool finishes them, in game order."""
+    openings = openings or [[]]
+    tasks = [(i, seed + i, openings[i % len(openings)], options) for i in range(games)]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        yield from map(play_game, tasks)
+        return
+    # Chunks keep the per-task overhead low without starving any worker at the end
+    chunksize = max(1, games // (workers * 8))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(play_game, tasks, chunksize=chunksize)
+
+
+def summarize(results, elapsed):
+    games = len(results)
+    wins = Counter(r['winner'] or 'draw' for r in results)
+    specials = Counter()
+    for r in results:
+        for counts in r['special_pieces'].values():
+            specials.update(counts)
+    lines = [
+        f"{games} games in {elapsed:.1f}s ({games / max(elapsed, 1e-9):.1f} games/s)",
+        f"white {wins['white']}, black {wins['black']}, draws {wins['draw']}",
+        f"average length {sum(r['plies'] for r in results) / max(games, 1):.1f} plies, "
+        f"average merges {sum(sum(r['merges'].values()) for r in results) / max(games, 1):.2f} per game",
+    ]
+    if specials:
+        lines.append("special pieces: " + ", ".join(f"{name} {n}" for name, n in specials.most_common()))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless Symbiotic Chess self-play")
+    parser.add_argument('games', type=int, help="number of games to play")
+    parser.add_argument('-o', '--output', help="JSON lines file for the results (default: stdout)")
+    parser.add_argument('-j', '--workers', type=int, help="worker processes (default: all cores)")
+    parser.add_argument('--white', choices=sorted(POLICIES), default='random', help="policy for White")
+    parser.add_argument('--black', choices=sorted(POLICIES), default='random', help="policy for Black")
+    parser.add_argument('--max-merges', type=int, default=3, help="merges allowed per player")
+    parser.add_argument('--max-plies', type=int, default=MAX_PLIES, help="actions before a game is a draw")
+    parser.add_argument('--ai-nodes', type=int, default=2000, help="search nodes per AI move")
+    parser.add_argument('--ai-depth', type=int, default=32, help="maximum search depth per AI move")
+    parser.add_argument('--ai-random', type=float, default=0.0, help="chance that an AI move is random instead")
+    parser.add_argument('--openings', help="file of scripted openings, one per line")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the first game; game i uses seed + i")
+    parser.add_argument('--record-moves', action='store_true', help="include every game's actions in its line")
+    args = parser.parse_args(argv)
+    if not 0 <= args.max_merges <= MAX_MERGE_LIMIT:
+        parser.error(f"--max-merges must be between 0 and {MAX_MERGE_LIMIT}")
+
+    options = {
+        'white': args.white,
+        'black': args.black,
+        'max_merges': args.max_merges,
+        'max_plies': args.max_plies,
+        'ai_nodes': args.ai_nodes,
+        'ai_depth': args.ai_depth,
+        'ai_random': args.ai_random,
+        'record_moves': args.record_moves,
+    }
+    openings = load_openings(args.openings) if args.openings else None
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    results = []
+    started = time.perf_counter()
+    try:
+        for result in run(args.games, options, args.workers, args.seed, openings):
+            out.write(json.dumps(result) + '\n')
+            out.flush()
+            results.append(result)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(summarize(results, time.perf_counter() - started), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
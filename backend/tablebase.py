@@ -0,0 +1,543 @@
+"""Endgame tablebases: win/draw/loss and distance to mate for every position of
+an ending with a few units, built by retrograde analysis.
+
+A unit is one piece on the board, so a merged piece counts once, and Kings count
+too: K+Chancellor vs K has three units. An ending is named by its units in FEN
+symbols, White's then Black's, e.g. K{RN}k, KQkr or KPk.
+
+    python tablebase.py build K{RN}k KQk KRkn       # and every table they lead to
+    python tablebase.py build KRNk --merges 1 0     # White still has a merge left
+    python tablebase.py probe "8/8/8/4k3/8/8/8/{RN}3K3 w 0 0 3"
+
+Merges and disintegrations change the units, and captures and promotions change
+the material. An action that leaves the ending leads into another table, and the
+generator builds those tables first. Remaining merges are part of a table's key
+wherever a side could still merge, because K+{RN} vs K with a merge left plays
+differently from the same position without one. The budget only goes down and
+the material only gets smaller, so the tables depend on each other without
+cycles.
+
+Limitations:
+
+- At most MAX_UNITS (4) units. A disintegration that would make a fifth unit is
+  left out of the table, and the table is marked incomplete, as is every table
+  that leads into an incomplete one. The servers and the engine only probe
+  complete tables. Every 4-unit table with a merged piece is
+  incomplete for this reason.
+- A 3-unit table with a merged piece depends on a 4-unit table (the piece can
+  disintegrate). 4-unit tables have about 5 million positions (17 million with a
+  pawn), so building one takes CPU-hours in Python and several GB of memory.
+  Use many workers (-j) on a batch machine. 3-unit tables take seconds to minutes.
+- Tables follow the game's rules as they are. A promoted piece keeps its new
+  type as a component (see check_pawn_promotion), so it can disintegrate like a
+  merged piece, and a pawn ending leads into 4-unit tables too.
+- There are no draw rules besides stalemate (no fifty-move rule or repetition),
+  so DRAW means neither side can force mate.
+- The distance to mate is in plies and assumes the winner mates as fast as
+  possible and the loser holds out as long as possible, across table changes.
+
+Each table file holds a header, then one WDL byte per index (LOSS, DRAW or WIN
+for the side to move, or ILLEGAL) and one little-endian uint16 DTM per index:
+
+    header  4s magic b'SCTB', H format version, B units, B flags (1 = incomplete),
+            B White's remaining merges, B Black's, 8s unit piece codes, Q index size
+
+The index is perfect (every position has exactly one index, with no hashing)
+but not minimal. It is the side to move, then the White King's square reduced
+by the board's symmetries (10 squares without pawns, 32 with), then the
+square of every other unit in material order. Indexes whose units overlap, or
+whose side not to move is in check, are ILLEGAL. Tables are memory-mapped, so
+probing one reads a few bytes.
+"""
+import argparse
+import mmap
+import os
+import struct
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from bitboard import PAWN, QUEEN, KING, iter_bits
+from game import SymbioticChessGame, PIECES, PIECE_FEN, FEN_CODES
+
+MAGIC = b'SCTB'
+TABLE_FORMAT = 1
+MAX_UNITS = 4
+INCOMPLETE = 1
+
+LOSS, DRAW, WIN, ILLEGAL = 0, 1, 2, 3
+WDL_NAMES = ['loss', 'draw', 'win', 'illegal']
+# What the worker finds in each position, besides its actions
+_NORMAL, _ILLEGAL, _MATED, _STALEMATE = 0, 1, 2, 3
+_NO_DISTANCE = 0xFFFF
+
+_HEADER = struct.Struct('<4sHBBBB8sQ')
+
+IS_KING = [bool(p and p.mask & KING) for p in PIECES]
+IS_WHITE = [bool(p and p.color == 'white') for p in PIECES]
+
+
+def _transform(sq, swap, flip_file, flip_rank):
+    row, col = sq >> 3, sq & 7
+    if swap:
+        row, col = 7 - col, 7 - row  # Reflect in the a1-h8 diagonal
+    if flip_file:
+        col = 7 - col
+    if flip_rank:
+        row = 7 - row
+    return row * 8 + col
+
+
+# The board's 8 symmetries as square maps; the first two are all a pawn allows
+TRANSFORMS = [[_transform(sq, swap, flip_file, flip_rank) for sq in range(64)]
+              for swap in (False, True) for flip_rank in (False, True) for flip_file in (False, True)]
+
+# Squares the White King is reduced to: the a1-d1-d4 triangle, or files a-d with pawns
+TRIANGLE = [sq for sq in range(64) if (sq & 7) <= 3 and 7 - (sq >> 3) <= (sq & 7)]
+HALF_BOARD = [sq for sq in range(64) if (sq & 7) <= 3]
+
+
+def _king_transforms(king_squares, transforms):
+    # For every square, the first symmetry that takes a King there into king_squares
+    allowed = set(king_squares)
+    return [next(t for t in transforms if t[sq] in allowed) for sq in range(64)]
+
+
+_KING_TRANSFORMS = {
+    False: (TRIANGLE, _king_transforms(TRIANGLE, TRANSFORMS)),
+    True: (HALF_BOARD, _king_transforms(HALF_BOARD, TRANSFORMS[:2])),
+}
+
+
+def _can_merge(codes):
+    # Whether a side with these units could ever merge: two units without a King
+    # or Queen, or a merged unit that can split into two
+    mergeable = [code for code in codes if not PIECES[code].mask & (KING | QUEEN)]
+    return len(mergeable) >= 2 or any(PIECES[code].combined_pieces for code in codes)
+
+
+def table_key(white, black, white_left, black_left):
+    """The key of the table for these unit codes: (material, White's merges left, Black's).
+
+    Each side's units are its King, then the rest by code. Remaining merges
+    that can't matter are counted as 0, so equivalent positions share a table.
+    """
+    white = sorted(white, key=lambda code: (not IS_KING[code], code))
+    black = sorted(black, key=lambda code: (not IS_KING[code], code))
+    return (tuple(white + black), white_left if _can_merge(white) else 0, black_left if _can_merge(black) else 0)
+
+
+def table_name(key):
+    material, white_left, black_left = key
+    return f"{''.join(PIECE_FEN[code] for code in material)}_{white_left}{black_left}"
+
+
+def parse_material(text):
+    """Unit codes from FEN symbols such as 'K{RN}k', or raises ValueError."""
+    codes, i = [], 0
+    while i < len(text):
+        if text[i] == '{':
+            end = text.find('}', i)
+            if end < 0:
+                raise ValueError(f"Unclosed piece in {text!r}")
+            letters = text[i + 1:end]
+            token = '{' + letters[:1] + ''.join(sorted(letters[1:])) + '}'
+            i = end + 1
+        else:
+            token = text[i]
+            i += 1
+        if token not in FEN_CODES:
+            raise ValueError(f"Unknown piece {token!r}")
+        codes.append(FEN_CODES[token])
+    white = [code for code in codes if IS_WHITE[code]]
+    black = [code for code in codes if not IS_WHITE[code]]
+    if sum(IS_KING[code] for code in white) != 1 or sum(IS_KING[code] for code in black) != 1:
+        raise ValueError(f"{text!r} needs exactly one King per side")
+    return white, black
+
+
+class Layout:
+    """The perfect index of one table: side to move, reduced White King square, other units' squares."""
+
+    def __init__(self, key):
+        self.key = key
+        self.material, self.white_left, self.black_left = key
+        self.units = len(self.material)
+        self.pawns = any(PIECES[code].mask & PAWN for code in self.material)
+        self.king_squares, self.king_transforms = _KING_TRANSFORMS[self.pawns]
+        self.king_slots = {sq: i for i, sq in enumerate(self.king_squares)}
+        self.white_units = sum(IS_WHITE[code] for code in self.material)
+        self.size = 2 * len(self.king_squares) * 64 ** (self.units - 1)
+
+    def decode(self, index):
+        # (side to move, the square of every unit in material order)
+        squares = []
+        for _ in range(self.units - 1):
+            index, sq = divmod(index, 64)
+            squares.append(sq)
+        index, slot = divmod(index, len(self.king_squares))
+        squares.append(self.king_squares[slot])
+        squares.reverse()
+        return ('white', 'black')[index], squares
+
+    def encode(self, turn, squares):
+        index = (turn == 'black') * len(self.king_squares) + self.king_slots[squares[0]]
+        for sq in squares[1:]:
+            index = index * 64 + sq
+        return index
+
+
+_layouts = {}
+_keys = {}  # (White's codes, Black's codes, merges left, merges left) -> table_key()
+
+
+def layout(key):
+    if key not in _layouts:
+        _layouts[key] = Layout(key)
+    return _layouts[key]
+
+
+def locate(game, max_units=MAX_UNITS):
+    """(table key, index) of the game's position, or None with more than max_units units."""
+    position = game.position
+    occupied = position.occupied
+    if (occupied[0] | occupied[1]).bit_count() > max_units:
+        return None
+    codes = game.codes
+    white = sorted((not IS_KING[codes[sq]], codes[sq], sq) for sq in iter_bits(occupied[0]))
+    black = sorted((not IS_KING[codes[sq]], codes[sq], sq) for sq in iter_bits(occupied[1]))
+    if not white or not black or white[0][0] or black[0][0]:
+        return None  # A King is missing
+    max_merges = game.max_merges
+    signature = (tuple(u[1] for u in white), tuple(u[1] for u in black),
+                 max(0, max_merges - game.merge_count['white']), max(0, max_merges - game.merge_count['black']))
+    key = _keys.get(signature)
+    if key is None:
+        key = _keys[signature] = table_key(*signature)
+    table = layout(key)
+    transform = table.king_transforms[white[0][2]]
+    # Units with the same code are interchangeable, so they go in square order
+    units = sorted((u[0], u[1], transform[u[2]]) for u in white) + \
+        sorted((u[0], u[1], transform[u[2]]) for u in black)
+    return key, table.encode(game.current_turn, [u[2] for u in units])
+
+
+_game = None
+
+
+def _generate(task):
+    """Worker: the positions [start, stop) of a table, with their actions.
+
+    Returns (position kinds, in-table edges as (position, successor) arrays,
+    exits as (position, table key, index) for actions that leave the table,
+    and the number of actions left out for making too many units).
+    """
+    global _game
+    key, start, stop, max_units = task
+    table = layout(key)
+    if _game is None:
+        _game = SymbioticChessGame(headless=True)
+    game = _game
+    material = table.material
+    max_merges = max(table.white_left, table.black_left)
+    kinds = bytearray(stop - start)
+    sources, targets = array('I'), array('I')
+    exits = []
+    ignored = 0
+    codes = bytearray(64)
+    for index in range(start, stop):
+        local = index - start
+        turn, squares = table.decode(index)
+        if len(set(squares)) < len(squares):
+            kinds[local] = _ILLEGAL  # Two units on one square
+            continue
+        codes[:] = bytes(64)
+        for code, sq in zip(material, squares):
+            codes[sq] = code
+        game.set_position(codes, turn, table.white_left, table.black_left, max_merges)
+        if game.is_in_check('black' if turn == 'white' else 'white'):
+            kinds[local] = _ILLEGAL
+            continue
+        moves = list(game.generate_moves())
+        if not moves:
+            kinds[local] = _MATED if game.is_in_check() else _STALEMATE
+            continue
+        for move in moves:
+            game.make(move)
+            child = locate(game, max_units)
+            game.unmake()
+            if child is None:
+                ignored += 1
+            elif child[0] == key:
+                sources.append(local)
+                targets.append(child[1])
+            else:
+                exits.append((local, child[0], child[1]))
+    return kinds, sources, targets, exits, ignored
+
+
+class Table:
+    """One memory-mapped table file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, units, self.flags, white_left, black_left, material, self.size = \
+            _HEADER.unpack_from(self.data)
+        if magic != MAGIC or version != TABLE_FORMAT:
+            self.data.close()
+            raise ValueError(f"{path} is not a tablebase in format {TABLE_FORMAT}")
+        self.key = (tuple(material[:units]), white_left, black_left)
+        self.complete = not self.flags & INCOMPLETE
+
+    def probe(self, index):
+        # (WDL, DTM in plies) for the side to move
+        wdl = self.data[_HEADER.size + index]
+        dtm = struct.unpack_from('<H', self.data, _HEADER.size + self.size + 2 * index)[0]
+        return wdl, dtm
+
+    def close(self):
+        self.data.close()
+
+
+def table_path(directory, key):
+    return os.path.join(directory, table_name(key) + '.sctb')
+
+
+class Tablebases:
+    """The tables in a directory, opened the first time they're probed."""
+
+    def __init__(self, directory, include_incomplete=False):
+        self.directory = directory
+        self.include_incomplete = include_incomplete
+        self.max_units = MAX_UNITS
+        self.tables = {}  # key -> Table, or None if there is no usable table
+
+    def table(self, key):
+        if key not in self.tables:
+            path = table_path(self.directory, key)
+            table = Table(path) if os.path.exists(path) else None
+            if table is not None and not table.complete and not self.include_incomplete:
+                table = None
+            self.tables[key] = table
+        return self.tables[key]
+
+    def probe(self, game):
+        """(WDL, DTM) for the game's side to move, or None if no table covers the position."""
+        if game.outcome:
+            return None
+        located = locate(game, self.max_units)
+        if located is None:
+            return None
+        table = self.table(located[0])
+        return table.probe(located[1]) if table is not None else None
+
+    def best_move(self, game):
+        """(Move, WDL, DTM) of the fastest win, a draw, or the longest loss, or None without full coverage."""
+        best, best_rank = None, None
+        for move in list(game.generate_moves()):
+            game.make(move)
+            result = self.probe(game)
+            game.unmake()
+            if result is None:
+                return None
+            wdl, dtm = result
+            # From the mover's side: prefer the opponent's fastest loss, then a draw, then its slowest win
+            rank = (wdl, dtm if wdl == LOSS else -dtm)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = (move, 2 - wdl, dtm + 1), rank
+        return best
+
+
+def _read_exit(tablebases, key, index):
+    table = tablebases.table(key)
+    wdl, dtm = table.probe(index)
+    if wdl == ILLEGAL:
+        raise RuntimeError(f"An action leads to an illegal position in {table_name(key)}")
+    return wdl, dtm
+
+
+def build(key, directory, executor, workers, max_units=MAX_UNITS, building=(), log=print):
+    """Writes the table for `key` to `directory` after the tables it leads to, unless it's already there."""
+    path = table_path(directory, key)
+    if os.path.exists(path):
+        return path
+    if key in building:
+        raise RuntimeError(f"Tables depend on each other: {table_name(key)}")
+    table = layout(key)
+    size = table.size
+    started = time.perf_counter()
+
+    # Forward pass in the workers: every position's actions
+    chunk = max(1024, size // (workers * 16))
+    tasks = [(key, start, min(start + chunk, size), max_units) for start in range(0, size, chunk)]
+    kinds = bytearray()
+    successors = array('I', bytes(4 * size))  # In-table actions per position
+    chunks, exits, ignored = [], [], 0
+    for start, (chunk_kinds, sources, targets, chunk_exits, chunk_ignored) in \
+            zip(range(0, size, chunk), executor.map(_generate, tasks)):
+        kinds += chunk_kinds
+        for local in sources:
+            successors[start + local] += 1
+        chunks.append((start, sources, targets))
+        exits += [(start + local, child_key, child_index) for local, child_key, child_index in chunk_exits]
+        ignored += chunk_ignored
+
+    # The tables the exits lead to come first
+    tablebases = Tablebases(directory, include_incomplete=True)
+    incomplete = bool(ignored)
+    for child_key in sorted({child_key for _, child_key, _ in exits}):
+        build(child_key, directory, executor, workers, max_units, building + (key,), log)
+        incomplete = incomplete or not tablebases.table(child_key).complete
+
+    # Predecessors, grouped by position (counting sort of the edges by target)
+    offsets = array('Q', bytes(8 * (size + 1)))
+    for _, _, targets in chunks:
+        for target in targets:
+            offsets[target + 1] += 1
+    for i in range(size):
+        offsets[i + 1] += offsets[i]
+    predecessors = array('I', bytes(4 * offsets[size]))
+    fill = array('Q', offsets)
+    for start, sources, targets in chunks:
+        for source, target in zip(sources, targets):
+            predecessors[fill[target]] = start + source
+            fill[target] += 1
+    del chunks, fill
+
+    # What each position can reach through its exits
+    win_exit = array('H', [_NO_DISTANCE]) * size    # Shortest win through an exit
+    loss_exit = array('H', bytes(2 * size))         # Longest loss through an exit
+    draw_exit = bytearray(size)
+    for position, child_key, child_index in exits:
+        wdl, dtm = _read_exit(tablebases, child_key, child_index)
+        if wdl == LOSS:
+            win_exit[position] = min(win_exit[position], dtm + 1)
+        elif wdl == WIN:
+            loss_exit[position] = max(loss_exit[position], dtm + 1)
+        else:
+            draw_exit[position] = 1
+    del exits
+
+    # Retrograde pass: positions are settled in order of distance, so the first
+    # win found for a position is its fastest and a loss waits for its last action
+    wdl = bytearray([DRAW]) * size
+    dtm = array('H', bytes(2 * size))
+    settled = bytearray(size)
+    longest = array('H', bytes(2 * size))  # Longest opponent win seen among the in-table actions
+    buckets = {}
+
+    def push(position, value, distance):
+        buckets.setdefault(distance, []).append((position, value))
+
+    def loses(position):
+        return win_exit[position] == _NO_DISTANCE and not draw_exit[position]
+
+    for position in range(size):
+        kind = kinds[position]
+        if kind == _ILLEGAL:
+            wdl[position] = ILLEGAL
+            settled[position] = 1
+        elif kind == _MATED:
+            push(position, LOSS, 0)
+        elif kind == _STALEMATE:
+            settled[position] = 1
+        else:
+            if win_exit[position] != _NO_DISTANCE:
+                push(position, WIN, win_exit[position])
+            elif not successors[position] and loses(position):
+                push(position, LOSS, loss_exit[position])
+    distance = 0
+    while buckets:
+        for position, value in buckets.pop(distance, ()):
+            if settled[position]:
+                continue
+            settled[position] = 1
+            wdl[position], dtm[position] = value, distance
+            for i in range(offsets[position], offsets[position + 1]):
+                parent = predecessors[i]
+                if settled[parent]:
+                    continue
+                if value == LOSS:
+                    push(parent, WIN, distance + 1)
+                else:
+                    successors[parent] -= 1
+                    longest[parent] = max(longest[parent], distance)
+                    if not successors[parent] and loses(parent):
+                        push(parent, LOSS, max(longest[parent], loss_exit[parent] - 1) + 1)
+        distance += 1
+
+    flags = INCOMPLETE if incomplete else 0
+    material = bytes(table.material)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, TABLE_FORMAT, table.units, flags, table.white_left, table.black_left,
+                             material, size))
+        f.write(wdl)
+        f.write(dtm.tobytes() if sys.byteorder == 'little' else _swapped(dtm))
+    os.replace(tmp_path, path)
+    counts = [wdl.count(value) for value in (WIN, DRAW, LOSS)]
+    log(f"{table_name(key)}: {size:,} indexes, {counts[0]:,} wins, {counts[1]:,} draws, {counts[2]:,} losses, "
+        f"longest mate {max(dtm)} plies{' (incomplete)' if incomplete else ''} in {time.perf_counter() - started:.1f}s")
+    return path
+
+
+def _swapped(values):
+    values = array(values.typecode, values)
+    values.byteswap()
+    return values.tobytes()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or probe Symbiotic Chess endgame tablebases")
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build', help="build tables and every table they lead to")
+    build_parser.add_argument('endings', nargs='+', help="units in FEN symbols, e.g. K{RN}k")
+    build_parser.add_argument('--merges', type=int, nargs=2, default=(0, 0), metavar=('WHITE', 'BLACK'),
+                              help="remaining merges of each side (default: 0 0)")
+    build_parser.add_argument('-o', '--output', default='tablebases', help="table directory")
+    build_parser.add_argument('-j', '--workers', type=int, help="worker processes (default: all cores)")
+    build_parser.add_argument('--max-units', type=int, default=MAX_UNITS, choices=range(2, MAX_UNITS + 1),
+                              help="units beyond which actions are left out (tables become incomplete)")
+    probe_parser = commands.add_parser('probe', help="look up a position")
+    probe_parser.add_argument('fen', help="position in Symbiotic FEN")
+    probe_parser.add_argument('-d', '--directory', default='tablebases', help="table directory")
+    args = parser.parse_args(argv)
+
+    if args.command == 'probe':
+        tablebases = Tablebases(args.directory, include_incomplete=True)
+        game = SymbioticChessGame.from_fen(args.fen, headless=True)
+        located = locate(game)
+        result = tablebases.probe(game)
+        if result is None:
+            print("No table covers this position.")
+            return 1
+        wdl, dtm = result
+        table = tablebases.table(located[0])
+        print(f"{table_name(located[0])}: {game.current_turn} to move: {WDL_NAMES[wdl]}"
+              f"{f' in {dtm} plies' if wdl != DRAW else ''}{'' if table.complete else ' (incomplete table)'}")
+        best = tablebases.best_move(game)
+        if best:
+            print(f"best action: {best[0]}")
+        return 0
+
+    keys = []
+    for ending in args.endings:
+        try:
+            white, black = parse_material(ending)
+        except ValueError as e:
+            parser.error(str(e))
+        if len(white) + len(black) > args.max_units:
+            parser.error(f"{ending} has more than {args.max_units} units")
+        keys.append(table_key(white, black, *args.merges))
+    os.makedirs(args.output, exist_ok=True)
+    workers = args.workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for key in keys:
+            build(key, args.output, executor, workers, args.max_units, log=lambda line: print(line, file=sys.stderr))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,39 @@
+# Zobrist keys for SymbioticChessGame.position_hash.
+#
+# A piece is keyed by its color, its primary piece_type and the set of its
+# combined_pieces, so a Chancellor built from a Rook differs from one built from
+# a Knight, and a promoted pawn (combined_pieces == [promotion]) differs from an
+# original piece of the same type.
+import random
+
+from bitboard import COLOR_INDEX, PIECE_TYPES, types_mask
+
+# Highest merge limit a FEN may set; the binary state (encoding.py) stores merge counts in one byte
+MAX_MERGE_LIMIT = 255
+
+# Fixed seed so hashes are stable across processes and restarts
+_rng = random.Random(0x5EED)
+
+PIECE_KEYS = [[_rng.getrandbits(64) for _ in range(2 * 6 * 64)] for _ in range(64)]
+MERGE_KEYS = [[_rng.getrandbits(64) for _ in range(17)] for _ in range(2)]
+BLACK_TO_MOVE_KEY = _rng.getrandbits(64)
+# Budgets above 16 are keyed after the keys above, which the opening book and tablebases were built with
+for _keys in MERGE_KEYS:
+    _keys.extend(_rng.getrandbits(64) for _ in range(MAX_MERGE_LIMIT - 16))
+
+
+def _zobrist_index(piece):
+    # Index of the piece's key among a square's PIECE_KEYS (not game.piece_code, a PIECES code)
+    return (COLOR_INDEX[piece.color] * 6 + PIECE_TYPES.index(piece.piece_type)) * 64 + \
+        types_mask(piece.combined_pieces)
+
+
+def piece_key(sq, piece):
+    if piece is None:
+        return 0
+    return PIECE_KEYS[sq][_zobrist_index(piece)]
+
+
+def merge_key(color, merges_left):
+    # A budget lowered below the merges already made counts as none left, as in to_fen
+    return MERGE_KEYS[COLOR_INDEX[color]][max(0, merges_left)]
@@ -1,28 +1,88 @@
 // Get API_URL from URL parameter or default to localhost
 const urlParams = new URLSearchParams(window.location.search);
 const API_URL = urlParams.get('api') || 'http://127.0.0.1:5000';
+// Optional game ID (from POST /games); without it the server's default game is used
+const GAME_ID = urlParams.get('game');
+const GAME_URL = GAME_ID ? `${API_URL}/games/${encodeURIComponent(GAME_ID)}` : API_URL;
 
 let selectedSquares = [];
+// Legal actions for the current position, fetched once per state and shared by every selection
+let legalMovesCache = null;
+// Last rendered state, patched in place by pushed updates
+let currentState = null;
+let eventSource = null;
 
 document.addEventListener('DOMContentLoaded', () => {
     fetchGameState();
+    subscribeToUpdates();
     document.getElementById('move-button').addEventListener('click', handleMove);
     document.getElementById('merge-button').addEventListener('click', handleMerge);
     document.getElementById('disintegrate-button').addEventListener('click', handleDisintegrate);
+    document.getElementById('ai-button').addEventListener('click', handleAiMove);
+    document.getElementById('undo-button').addEventListener('click', handleUndo);
     document.getElementById('reset-button').addEventListener('click', handleReset);
 });
 
 async function fetchGameState() {
+    legalMovesCache = null;
     try {
-        const response = await fetch(`${API_URL}/state`);
+        // Once we have a state, only ask for what changed since its version
+        const since = currentState ? `?since=${currentState.version}` : '';
+        const response = await fetch(`${GAME_URL}/state${since}`);
         const state = await response.json();
-        renderBoard(state);
+        if (state.board) {
+            renderBoard(state);
+        } else {
+            applyUpdate(state);
+        }
     } catch (error) {
         console.error('Error fetching game state:', error);
     }
 }
 
+// The server pushes the full state once, then a small update after every action
+// in this game (including the opponent's), so the board never has to be polled.
+function subscribeToUpdates() {
+    if (!window.EventSource) {
+        return;
+    }
+    eventSource = new EventSource(`${GAME_URL}/events`);
+    eventSource.addEventListener('state', event => {
+        legalMovesCache = null;
+        renderBoard(JSON.parse(event.data));
+    });
+    eventSource.onmessage = event => applyUpdate(JSON.parse(event.data));
+}
+
+function isStreaming() {
+    return eventSource !== null && eventSource.readyState === EventSource.OPEN;
+}
+
+function applyUpdate(update) {
+    if (currentState === null) {
+        return;
+    }
+    for (const [algebraic, piece] of Object.entries(update.squares)) {
+        const [col, row] = algebraicToColRow(algebraic);
+        currentState.board[row][col] = piece;
+    }
+    delete update.squares;
+    delete update.since;
+    Object.assign(currentState, update);
+    legalMovesCache = null;
+    resetSelection();
+    renderBoard(currentState);
+}
+
+// Without an open event stream, fall back to fetching the state after each action
+function refreshAfterAction() {
+    if (!isStreaming()) {
+        fetchGameState();
+    }
+}
+
 function renderBoard(state) {
+    currentState = state;
     const chessboard = document.getElementById('chessboard');
     chessboard.innerHTML = '';
     
@@ -93,6 +153,7 @@ function handleSquareClick(row, col) {
     if (selectedSquares.length === 0) {
         selectedSquares.push(algebraic);
         highlightSquare(row, col, true);
+        highlightTargets(algebraic);
     } else if (selectedSquares.length === 1) {
         selectedSquares.push(algebraic);
         moveInput.value = selectedSquares.join('');
@@ -109,6 +170,36 @@ function highlightSquare(row, col, isSelected) {
     }
 }
 
+async function getLegalMoves() {
+    if (legalMovesCache === null) {
+        try {
+            const response = await fetch(`${GAME_URL}/legal_moves`);
+            legalMovesCache = (await response.json()).moves;
+        } catch (error) {
+            console.error('Error fetching legal moves:', error);
+            return [];
+        }
+    }
+    return legalMovesCache;
+}
+
+async function highlightTargets(algebraic) {
+    const moves = await getLegalMoves();
+    // The selection may have changed while the request was in flight
+    if (selectedSquares[0] !== algebraic) {
+        return;
+    }
+    moves.filter(m => m.kind === 'move' && m.from === algebraic).forEach(m => {
+        const [col, row] = algebraicToColRow(m.to);
+        const square = document.querySelector(`.square[data-row='${row}'][data-col='${col}']`);
+        square.classList.add('target');
+    });
+}
+
+function algebraicToColRow(algebraic) {
+    return [algebraic.charCodeAt(0) - 'a'.charCodeAt(0), 8 - parseInt(algebraic[1])];
+}
+
 function colRowToAlgebraic(col, row) {
     const file = String.fromCharCode('a'.charCodeAt(0) + col);
     const rank = 8 - row;
@@ -118,13 +209,13 @@ function colRowToAlgebraic(col, row) {
 async function handleMove() {
     const move = document.getElementById('move-input').value;
     if (move.length === 4) {
-        await fetch(`${API_URL}/move`, {
+        await fetch(`${GAME_URL}/move`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ move })
         });
         resetSelection();
-        fetchGameState();
+        refreshAfterAction();
     }
 }
 
@@ -133,13 +224,13 @@ async function handleMerge() {
     if (move.length === 4) {
         const pos1 = move.substring(0, 2);
         const pos2 = move.substring(2, 4);
-        await fetch(`${API_URL}/merge`, {
+        await fetch(`${GAME_URL}/merge`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ pos1, pos2 })
         });
         resetSelection();
-        fetchGameState();
+        refreshAfterAction();
     }
 }
 
@@ -148,26 +239,39 @@ async function handleDisintegrate() {
     if (move.length === 4) {
         const pos = move.substring(0, 2);
         const target_pos = move.substring(2, 4);
-        await fetch(`${API_URL}/disintegrate`, {
+        await fetch(`${GAME_URL}/disintegrate`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
             body: JSON.stringify({ pos, target_pos })
         });
         resetSelection();
-        fetchGameState();
+        refreshAfterAction();
     }
 }
 
+async function handleAiMove() {
+    await fetch(`${GAME_URL}/ai_move`, { method: 'POST' });
+    resetSelection();
+    refreshAfterAction();
+}
+
+async function handleUndo() {
+    await fetch(`${GAME_URL}/undo`, { method: 'POST' });
+    resetSelection();
+    refreshAfterAction();
+}
+
 async function handleReset() {
-    await fetch(`${API_URL}/reset`, { method: 'POST' });
+    await fetch(`${GAME_URL}/reset`, { method: 'POST' });
     resetSelection();
-    fetchGameState();
+    refreshAfterAction();
 }
 
 function resetSelection() {
     document.getElementById('move-input').value = '';
     selectedSquares = [];
     document.querySelectorAll('.square.selected').forEach(s => s.classList.remove('selected'));
+    document.querySelectorAll('.square.target').forEach(s => s.classList.remove('target'));
 }
 
 function updateGameInfo(state) {
@@ -2,7 +2,18 @@
 
 echo "Starting backend server in the background..."
 cd backend
-./venv/Scripts/python server.py &
+# One ASGI worker per core behind router.py (BACKEND_WORKERS=n to choose), one ASGI
+# process on a single core, or the Flask server if Starlette/uvicorn aren't installed
+BACKEND_WORKERS=${BACKEND_WORKERS:-$(nproc 2>/dev/null || echo 1)}
+if ./venv/Scripts/python -c "import starlette, uvicorn" 2>/dev/null; then
+    if [ "$BACKEND_WORKERS" -gt 1 ]; then
+        ./venv/Scripts/python router.py --workers "$BACKEND_WORKERS" &
+    else
+        ./venv/Scripts/python asgi.py &
+    fi
+else
+    ./venv/Scripts/python server.py &
+fi
 BACKEND_PID=$!
 cd ..
 